@@ -0,0 +1,430 @@
+"""
+Buyer Preference Index
+In-memory listing -> buyer prefilter over active buyer preferences, so a
+new listing is only scored against buyers who could reach their threshold
+"""
+import math
+import os
+import time
+import logging
+from typing import Any, Dict, Iterable, NamedTuple, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+BUYER_INDEX_REFRESH_SECONDS = float(os.getenv("BUYER_INDEX_REFRESH_SECONDS", "30"))
+# Full rebuilds also drop buyers whose rows were deleted
+BUYER_INDEX_REBUILD_SECONDS = float(os.getenv("BUYER_INDEX_REBUILD_SECONDS", "3600"))
+BUYER_INDEX_PAGE_SIZE = 1000
+
+# (table, buyer id column, record part, columns)
+PREFERENCE_SOURCES = (
+    ("buyer_profiles", "user_id", "profile", "user_id, preferences, updated_at"),
+    ("user_preferences", "user_id", "preferences",
+     "user_id, budget_min, budget_max, preferred_location, preferred_property_type, updated_at"),
+    ("buyer_match_preferences", "buyer_id", "match", "buyer_id, active, min_match_score, updated_at"),
+)
+
+DEFAULT_MIN_MATCH_SCORE = 70.0
+# match_buyers_for_listing rounds each factor and the total to 2 decimals
+SCORE_ROUNDING_MARGIN = 0.01
+URGENCY_SCORES = {"immediate": 100, "within_3_months": 80, "within_6_months": 60}
+# Price buckets grow geometrically; 1.5^64 covers any listing price in rupees
+PRICE_BUCKET_RATIO = 1.5
+PRICE_BUCKETS = 64
+
+
+def _norm(value: Any) -> Optional[str]:
+    if value is None:
+        return None
+    text = str(value).strip().lower()
+    return text or None
+
+
+def _number(value: Any) -> Optional[float]:
+    try:
+        return float(value) if value is not None and value != "" else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _int(value: Any) -> Optional[int]:
+    number = _number(value)
+    return int(number) if number is not None else None
+
+
+class PostingIndex:
+    """Key -> buyer posting lists, plus the buyers with no preference on this dimension"""
+
+    def __init__(self):
+        self.postings: Dict[Any, Set[str]] = {}
+        self.wildcard: Set[str] = set()
+        self._keys: Dict[str, Tuple[Any, ...]] = {}
+
+    def add(self, buyer_id: str, keys: Iterable[Any]):
+        self.remove(buyer_id)
+        keys = tuple(keys)
+        self._keys[buyer_id] = keys
+        if not keys:
+            self.wildcard.add(buyer_id)
+        for key in keys:
+            self.postings.setdefault(key, set()).add(buyer_id)
+
+    def remove(self, buyer_id: str):
+        self.wildcard.discard(buyer_id)
+        for key in self._keys.pop(buyer_id, ()):
+            posting = self.postings.get(key)
+            if posting is not None:
+                posting.discard(buyer_id)
+                if not posting:
+                    del self.postings[key]
+
+
+def _price_bucket(price: float) -> int:
+    if price < PRICE_BUCKET_RATIO:
+        return 0
+    return min(PRICE_BUCKETS - 1, int(math.log(price, PRICE_BUCKET_RATIO)))
+
+
+class PriceIntervalIndex:
+    """
+    Buyer -> price interval, answering "whose interval may contain this price".
+
+    A segment tree over geometric price buckets: each interval is stored on
+    at most 2*log2(PRICE_BUCKETS) nodes and a lookup unions the sets on one
+    leaf-to-root path. Results are bucket-accurate, so callers re-check the
+    exact bounds.
+    """
+
+    def __init__(self):
+        self.nodes: Dict[int, Set[str]] = {}
+        self._nodes_of: Dict[str, Tuple[int, ...]] = {}
+
+    def add(self, buyer_id: str, low: float, high: float):
+        self.remove(buyer_id)
+        if high < low:
+            return
+        nodes = []
+        left, right = _price_bucket(low) + PRICE_BUCKETS, _price_bucket(high) + PRICE_BUCKETS + 1
+        while left < right:
+            if left & 1:
+                nodes.append(left)
+                left += 1
+            if right & 1:
+                right -= 1
+                nodes.append(right)
+            left >>= 1
+            right >>= 1
+        self._nodes_of[buyer_id] = tuple(nodes)
+        for node in nodes:
+            self.nodes.setdefault(node, set()).add(buyer_id)
+
+    def remove(self, buyer_id: str):
+        for node in self._nodes_of.pop(buyer_id, ()):
+            members = self.nodes.get(node)
+            if members is not None:
+                members.discard(buyer_id)
+                if not members:
+                    del self.nodes[node]
+
+    def stab(self, price: float) -> Set[str]:
+        matched: Set[str] = set()
+        node = _price_bucket(price) + PRICE_BUCKETS
+        while node:
+            matched |= self.nodes.get(node, set())
+            node >>= 1
+        return matched
+
+
+class BuyerBounds(NamedTuple):
+    """The parts of a buyer's preferences that match_buyers_for_listing scores on"""
+    preferred_location: Optional[str]
+    preferred_type: Optional[str]
+    budget_min: Optional[float]
+    budget_max: Optional[float]
+    min_bedrooms: Optional[int]
+    max_bedrooms: Optional[int]
+    timing_match: float
+    min_match_score: float
+
+
+# =============================================
+# SCORE CEILINGS
+# =============================================
+# Mirrors of the factors in match_buyers_for_listing. Budget, size and
+# timing are exact; location and amenities depend on recent behavior the
+# index does not hold, so they use the best value behavior could give.
+
+def budget_match(price: Optional[float], budget_min: Optional[float], budget_max: Optional[float]) -> float:
+    if budget_max is None or price is None:
+        return 50.0
+    low = budget_min or 0.0
+    if low <= price <= budget_max:
+        return 100.0
+    if price < low:
+        return max(0.0, 100 - (low - price) / low * 100)
+    if budget_max == 0:
+        return 0.0
+    return max(0.0, 100 - (price - budget_max) / budget_max * 100)
+
+
+def size_match(bedrooms: Optional[int], min_bedrooms: Optional[int], max_bedrooms: Optional[int]) -> float:
+    if bedrooms is None:
+        return 50.0
+    if min_bedrooms is None:
+        return 70.0
+    high = max_bedrooms if max_bedrooms is not None else 10
+    if min_bedrooms <= bedrooms <= high:
+        return 100.0
+    if bedrooms < min_bedrooms:
+        return max(0.0, 100 - (min_bedrooms - bedrooms) * 20)
+    return max(0.0, 100 - (bedrooms - high) * 15)
+
+
+def location_match_ceiling(listing: Dict[str, Any], preferred_location: Optional[str]) -> float:
+    if preferred_location is not None:
+        if listing.get("location") == preferred_location:
+            return 100.0
+        if listing.get("locality") == preferred_location:
+            return 90.0
+        if listing.get("city") == preferred_location:
+            return 70.0
+    # Otherwise recently searched locations can still give 80
+    return 80.0
+
+
+def property_type_match(listing_type: Optional[str], preferred_type: Optional[str]) -> float:
+    if preferred_type is None:
+        return 50.0
+    if listing_type is None:
+        return 20.0
+    if listing_type == preferred_type:
+        return 100.0
+    if preferred_type.lower() in listing_type.lower() or "%" in preferred_type or "_" in preferred_type:
+        return 80.0  # ILIKE '%' || type || '%' (wildcards in the preference may match anything)
+    return 20.0
+
+
+AMENITY_MATCH_CEILING = 70.0
+
+
+def match_ceiling(listing: Dict[str, Any], bounds: BuyerBounds) -> float:
+    """Best score match_buyers_for_listing could give this buyer for the listing"""
+    return (
+        0.25 * budget_match(_number(listing.get("price")), bounds.budget_min, bounds.budget_max)
+        + 0.25 * location_match_ceiling(listing, bounds.preferred_location)
+        + 0.20 * property_type_match(listing.get("property_type"), bounds.preferred_type)
+        + 0.15 * size_match(_int(listing.get("bedrooms")), bounds.min_bedrooms, bounds.max_bedrooms)
+        + 0.10 * AMENITY_MATCH_CEILING
+        + 0.05 * bounds.timing_match
+    )
+
+
+def required_budget_match(bounds: BuyerBounds) -> float:
+    """
+    Budget factor a buyer needs when the listing hits none of their posting
+    lists: location then scores at most 80 (as for a search match), the
+    property type as for any other type, and size its best case
+    """
+    other_type = property_type_match(None, bounds.preferred_type)
+    best_without_budget = (
+        0.25 * 80.0 + 0.20 * other_type + 0.15 * 100.0
+        + 0.10 * AMENITY_MATCH_CEILING + 0.05 * bounds.timing_match
+    )
+    return (bounds.min_match_score - SCORE_ROUNDING_MARGIN - best_without_budget) / 0.25
+
+
+def budget_match_interval(bounds: BuyerBounds, required: float) -> Tuple[float, float]:
+    """Prices whose budget_match is at least `required` (a superset when budget_min > budget_max)"""
+    low = bounds.budget_min or 0.0
+    share = required / 100
+    return low * share, max(low, bounds.budget_max * (2 - share))
+
+
+class BuyerPreferenceIndex:
+    """
+    In-memory prefilter over active buyers' preferences.
+
+    Buyers are posted under their exact preferred location and property
+    type. A buyer the listing hits on neither list can score at most 80 for
+    location and the "other type" value for type, so they can only reach
+    their threshold through a good enough budget match; that turns into a
+    price interval per buyer (PriceIntervalIndex). Buyers whose threshold
+    is reachable whatever the budget are kept in one bounded set.
+    candidates(listing) scores only the buyers those lookups return and
+    keeps the ones whose best possible match_buyers_for_listing score
+    reaches their own min_match_score, so it only skips buyers the RPC
+    would have rejected anyway. The index is loaded once and then kept
+    current from rows whose updated_at moved since the last sync;
+    upsert_buyer/remove_buyer apply changes immediately.
+    """
+
+    def __init__(
+        self,
+        refresh_seconds: float = BUYER_INDEX_REFRESH_SECONDS,
+        rebuild_seconds: float = BUYER_INDEX_REBUILD_SECONDS,
+    ):
+        self.refresh_seconds = refresh_seconds
+        self.rebuild_seconds = rebuild_seconds
+        self._reset()
+
+    def _reset(self):
+        self._records: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._bounds: Dict[str, BuyerBounds] = {}
+        self.locations = PostingIndex()
+        self.property_types = PostingIndex()
+        self.budgets = PriceIntervalIndex()
+        # Reachable without a posting match at any price / when the listing has no price
+        self._any_price: Set[str] = set()
+        self._unpriced: Set[str] = set()
+        self._watermarks: Dict[str, Optional[str]] = {}
+        self._last_refresh = float("-inf")
+        self._last_rebuild = float("-inf")
+
+    def __len__(self) -> int:
+        return len(self._bounds)
+
+    # =============================================
+    # MAINTENANCE
+    # =============================================
+
+    def upsert_buyer(self, buyer_id: str, part: str, row: Dict[str, Any]):
+        """Merge one source row ('profile', 'preferences' or 'match') and re-index the buyer"""
+        self._records.setdefault(buyer_id, {})[part] = row
+        self._reindex(buyer_id)
+
+    def remove_buyer(self, buyer_id: str):
+        self._records.pop(buyer_id, None)
+        self._unindex(buyer_id)
+
+    def _unindex(self, buyer_id: str):
+        self._bounds.pop(buyer_id, None)
+        self.locations.remove(buyer_id)
+        self.property_types.remove(buyer_id)
+        self.budgets.remove(buyer_id)
+        self._any_price.discard(buyer_id)
+        self._unpriced.discard(buyer_id)
+
+    def _reindex(self, buyer_id: str):
+        record = self._records.get(buyer_id, {})
+        match = record.get("match") or {}
+        # Only buyers with a profile and without paused matching are candidates
+        if "profile" not in record or match.get("active") is False:
+            self._unindex(buyer_id)
+            return
+
+        prefs = record.get("preferences") or {}
+        profile_prefs = (record["profile"] or {}).get("preferences") or {}
+
+        # Exact values: the RPC compares locations and types as stored
+        location = prefs.get("preferred_location")
+        self.locations.add(buyer_id, [location] if location is not None else [])
+        property_type = prefs.get("preferred_property_type")
+        self.property_types.add(buyer_id, [property_type] if property_type is not None else [])
+
+        min_match_score = _number(match.get("min_match_score"))
+        bounds = BuyerBounds(
+            preferred_location=location,
+            preferred_type=property_type,
+            budget_min=_number(prefs.get("budget_min")),
+            budget_max=_number(prefs.get("budget_max")),
+            min_bedrooms=_int(profile_prefs.get("min_bedrooms")),
+            max_bedrooms=_int(profile_prefs.get("max_bedrooms")),
+            timing_match=float(URGENCY_SCORES.get(profile_prefs.get("buying_urgency"), 40)),
+            min_match_score=DEFAULT_MIN_MATCH_SCORE if min_match_score is None else min_match_score,
+        )
+        self._bounds[buyer_id] = bounds
+
+        # Budget the buyer needs when no posting list matches (budget_match
+        # is 50 without a budget_max or a listing price)
+        required = required_budget_match(bounds)
+        self.budgets.remove(buyer_id)
+        self._any_price.discard(buyer_id)
+        self._unpriced.discard(buyer_id)
+        if bounds.budget_max is None:
+            if required <= 50:
+                self._any_price.add(buyer_id)
+        elif required <= 0:
+            self._any_price.add(buyer_id)
+        elif required <= 100:
+            self.budgets.add(buyer_id, *budget_match_interval(bounds, required))
+            if required <= 50:
+                self._unpriced.add(buyer_id)
+
+    # =============================================
+    # SYNC
+    # =============================================
+
+    def ensure_fresh(self, client: Any):
+        """Rebuild or incrementally refresh from Supabase when due"""
+        now = time.monotonic()
+        if now - self._last_rebuild >= self.rebuild_seconds:
+            self.rebuild(client)
+        elif now - self._last_refresh >= self.refresh_seconds:
+            self.refresh(client)
+
+    def rebuild(self, client: Any):
+        self._reset()
+        self._last_rebuild = time.monotonic()
+        self.refresh(client)
+        logger.info(f"Buyer preference index rebuilt with {len(self)} active buyers")
+
+    def refresh(self, client: Any):
+        """Apply rows changed since the last sync of each source table"""
+        self._last_refresh = time.monotonic()
+        for table, id_column, part, columns in PREFERENCE_SOURCES:
+            watermark = self._watermarks.get(table)
+            for row in self._fetch_since(client, table, columns, watermark):
+                buyer_id = row.get(id_column)
+                if not buyer_id:
+                    continue
+                self.upsert_buyer(buyer_id, part, row)
+                updated_at = row.get("updated_at")
+                if updated_at and (watermark is None or updated_at > watermark):
+                    watermark = updated_at
+            self._watermarks[table] = watermark
+
+    def _fetch_since(self, client: Any, table: str, columns: str, watermark: Optional[str]) -> Iterable[Dict[str, Any]]:
+        start = 0
+        while True:
+            query = client.table(table).select(columns)
+            if watermark:
+                # gte: rows sharing the watermark timestamp are re-applied, never missed
+                query = query.gte("updated_at", watermark)
+            page = query.order("updated_at").range(start, start + BUYER_INDEX_PAGE_SIZE - 1).execute().data or []
+            yield from page
+            if len(page) < BUYER_INDEX_PAGE_SIZE:
+                return
+            start += BUYER_INDEX_PAGE_SIZE
+
+    # =============================================
+    # QUERY
+    # =============================================
+
+    def candidates(self, listing: Dict[str, Any]) -> Set[str]:
+        """Buyers who could score at or above their min_match_score for the listing"""
+        return {
+            buyer_id for buyer_id in self._lookup(listing)
+            if match_ceiling(listing, self._bounds[buyer_id]) + SCORE_ROUNDING_MARGIN
+            >= self._bounds[buyer_id].min_match_score
+        }
+
+    def _lookup(self, listing: Dict[str, Any]) -> Set[str]:
+        """Every buyer that can reach their threshold: posting matches plus the budget fallbacks"""
+        found: Set[str] = set(self._any_price)
+        # Locality and exact location beat the 80 any buyer may get (a city match gives less)
+        for key in {listing.get("location"), listing.get("locality")} - {None}:
+            found |= self.locations.postings.get(key, set())
+        # Few distinct types are stored; ILIKE matches need each of them checked
+        listing_type = listing.get("property_type")
+        for key, buyers in self.property_types.postings.items():
+            if property_type_match(listing_type, key) > property_type_match(None, key):
+                found |= buyers
+        price = _number(listing.get("price"))
+        found |= self._unpriced if price is None else self.budgets.stab(price)
+        return found
+
+
+# =============================================
+# INITIALIZE INDEX
+# =============================================
+buyer_preference_index = BuyerPreferenceIndex()
@@ -4,11 +4,16 @@ Auto-match new listings to qualified buyers in real-time
 """
 from typing import List, Dict, Any, Optional
 from datetime import datetime
+import asyncio
 import os
 import logging
 import anthropic
 from supabase import create_client
 
+from .buyer_index import buyer_preference_index
+from .notification_fanout import NotificationFanout
+from .listing_digest import send_listing_digests
+
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
 CLAUDE_MODEL = "claude-3-5-sonnet-20241022"
 
@@ -51,64 +56,31 @@ class SmartDistributionEngine:
                     "success": False
                 }
             
-            # Get all active buyers with preferences
-            # First, get all buyer_profiles
-            buyers_response = self.supabase.table("buyer_profiles")\
-                .select("*, profiles!inner(*)")\
-                .execute()
-            
-            matched_buyers = []
-            
-            for buyer_profile in buyers_response.data:
-                buyer_user_id = buyer_profile.get("user_id")
-                if not buyer_user_id:
-                    continue
-                
-                # Check if buyer has active match preferences
-                prefs_response = self.supabase.table("buyer_match_preferences")\
-                    .select("*")\
-                    .eq("buyer_id", buyer_user_id)\
-                    .eq("active", True)\
-                    .maybe_single()\
-                    .execute()
-                
-                # Skip if preferences exist but inactive, or use defaults if no preferences
-                if prefs_response.data and not prefs_response.data.get("active", True):
-                    continue
-                
-                # Calculate match score using DB function
-                try:
-                    score_result = self.supabase.rpc(
-                        "calculate_match_score",
-                        {
-                            "p_listing_id": listing_id,
-                            "p_buyer_id": buyer_user_id
-                        }
-                    ).execute()
-                    
-                    if score_result.data and len(score_result.data) > 0:
-                        match_score = float(score_result.data[0].get("match_score", 0))
-                        match_factors = score_result.data[0].get("match_factors", {})
-                        
-                        # Get buyer's minimum threshold (default 70)
-                        min_score = 70.0
-                        if prefs_response.data:
-                            min_score = float(prefs_response.data.get("min_match_score", 70.0))
-                        
-                        if match_score >= min_score:
-                            profile = buyer_profile.get("profiles", {})
-                            matched_buyers.append({
-                                "buyer_id": buyer_user_id,
-                                "buyer_email": profile.get("email"),
-                                "buyer_phone": profile.get("phone"),
-                                "match_score": match_score,
-                                "match_factors": match_factors,
-                                "preferred_channels": prefs_response.data.get("preferred_channels", ["email"]) if prefs_response.data else ["email"],
-                                "notification_frequency": prefs_response.data.get("notification_frequency", "instant") if prefs_response.data else "instant"
-                            })
-                except Exception as e:
-                    logger.error(f"Error calculating match score for buyer {buyer_user_id}: {e}")
-                    continue
+            # Skip buyers who cannot reach their min_match_score for this listing,
+            # then score the rest in one set-based query; buyers at or above
+            # their own min_match_score come back, best match first
+            buyer_preference_index.ensure_fresh(self.supabase)
+            candidate_ids = buyer_preference_index.candidates(listing)
+            
+            matches = []
+            if candidate_ids:
+                matches = self.supabase.rpc(
+                    "match_buyers_for_listing",
+                    {"p_listing_id": listing_id, "p_buyer_ids": sorted(candidate_ids)}
+                ).execute().data or []
+            
+            matched_buyers = [
+                {
+                    "buyer_id": row["buyer_id"],
+                    "buyer_email": row.get("buyer_email"),
+                    "buyer_phone": row.get("buyer_phone"),
+                    "match_score": float(row.get("match_score") or 0),
+                    "match_factors": row.get("match_factors") or {},
+                    "preferred_channels": row.get("preferred_channels") or ["email"],
+                    "notification_frequency": row.get("notification_frequency") or "instant"
+                }
+                for row in matches
+            ]
             
             # Sort by match score (highest first)
             matched_buyers.sort(key=lambda x: x["match_score"], reverse=True)
@@ -119,40 +91,49 @@ class SmartDistributionEngine:
             
             distribution_results = {
                 "listing_id": listing_id,
+                "candidates_scored": len(candidate_ids),
                 "total_matches": len(matched_buyers),
                 "instant_sent": 0,
                 "daily_queued": len(daily_buyers),
                 "channels_used": {}
             }
             
-            # Send instant notifications
-            for buyer in instant_buyers:
-                for channel in buyer["preferred_channels"]:
-                    try:
-                        await self._send_notification(
-                            channel=channel,
-                            buyer=buyer,
-                            listing=listing,
-                            match_score=buyer["match_score"],
-                            match_factors=buyer["match_factors"]
-                        )
-                        distribution_results["instant_sent"] += 1
-                        distribution_results["channels_used"][channel] = distribution_results["channels_used"].get(channel, 0) + 1
-                    except Exception as e:
-                        logger.error(f"Error sending notification via {channel} to {buyer['buyer_id']}: {e}")
+            # Render once per score band and send in per-channel batches
+            delivered = set()
+            if instant_buyers:
+                fanout = NotificationFanout(
+                    render=lambda buyer: self._generate_personalized_message(
+                        buyer=buyer,
+                        listing=listing,
+                        match_score=buyer["match_score"],
+                        match_factors=buyer["match_factors"]
+                    )
+                )
+                channel_stats = await fanout.send(instant_buyers)
+                distribution_results["instant_sent"] = sum(stats["sent"] for stats in channel_stats.values())
+                distribution_results["channels_used"] = {
+                    channel: stats["sent"] for channel, stats in channel_stats.items()
+                }
+                distribution_results["channel_throughput"] = channel_stats
+                delivered = fanout.delivered
+                distribution_results["instant_failed"] = len(instant_buyers) - len(delivered)
             
             # Log all distributions
             distribution_records = []
             for buyer in matched_buyers:
-                is_instant = buyer in instant_buyers
+                # Instant buyers no channel reached are recorded as failed, not sent
+                if buyer in instant_buyers:
+                    status = "sent" if buyer["buyer_id"] in delivered else "failed"
+                else:
+                    status = "queued"
                 distribution_records.append({
                     "listing_id": listing_id,
                     "buyer_id": buyer["buyer_id"],
                     "match_score": buyer["match_score"],
                     "match_factors": buyer["match_factors"],
                     "distribution_channel": ",".join(buyer["preferred_channels"]),
-                    "conversion_status": "sent" if is_instant else "queued",
-                    "sent_at": datetime.now().isoformat() if is_instant else None
+                    "conversion_status": status,
+                    "sent_at": datetime.now().isoformat() if status == "sent" else None
                 })
             
             if distribution_records:
@@ -165,30 +146,18 @@ class SmartDistributionEngine:
             logger.error(f"Error in distribute_listing: {e}", exc_info=True)
             return {"error": str(e), "success": False}
     
-    async def _send_notification(
-        self, 
-        channel: str, 
-        buyer: Dict, 
-        listing: Dict, 
-        match_score: float,
-        match_factors: Dict
-    ):
-        """Send notification via specific channel with AI-generated content"""
-        
-        # Generate personalized message using AI
-        message_content = await self._generate_personalized_message(
-            buyer=buyer,
-            listing=listing,
-            match_score=match_score,
-            match_factors=match_factors
-        )
-        
-        if channel == "email":
-            await self._send_email(buyer["buyer_email"], message_content, listing)
-        elif channel == "whatsapp":
-            await self._send_whatsapp(buyer["buyer_phone"], message_content, listing)
-        elif channel == "sms":
-            await self._send_sms(buyer["buyer_phone"], message_content, listing)
+    async def send_daily_digests(self) -> Dict[str, Any]:
+        """
+        Roll every queued match for daily_digest buyers up into one message
+        per buyer, ranked by match score, and send them in batches
+        """
+        try:
+            result = await send_listing_digests(self.supabase, "daily_digest")
+            result["success"] = True
+            return result
+        except Exception as e:
+            logger.error(f"Error in send_daily_digests: {e}", exc_info=True)
+            return {"error": str(e), "success": False}
     
     async def _generate_personalized_message(
         self,
@@ -242,7 +211,9 @@ BODY: <email body>
 Use Indian English. Be personal and highlight why this property matches the buyer."""
 
                 client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
-                response = client.messages.create(
+                # Off the event loop so the fan-out can render several bands at once
+                response = await asyncio.to_thread(
+                    client.messages.create,
                     model=CLAUDE_MODEL,
                     max_tokens=500,
                     messages=[{"role": "user", "content": prompt}]
@@ -279,84 +250,3 @@ Best regards,
 Tharaga Team
 """
         return {"subject": subject, "body": body}
-    
-    async def _send_email(self, email: str, content: Dict, listing: Dict):
-        """Integrate with existing Resend API via Next.js endpoint"""
-        try:
-            try:
-                import httpx
-            except ImportError:
-                logger.warning("httpx not available, skipping email send")
-                return
-            
-            api_url = os.getenv("NEXT_PUBLIC_API_URL") or os.getenv("FRONTEND_URL", "http://localhost:3000")
-            
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    f"{api_url}/api/messaging/send",
-                    json={
-                        "to": email,
-                        "subject": content["subject"],
-                        "body": content["body"],
-                        "type": "email"
-                    }
-                )
-                if response.status_code != 200:
-                    logger.error(f"Email sending failed: {response.text}")
-        except Exception as e:
-            logger.error(f"Error sending email: {e}")
-    
-    async def _send_whatsapp(self, phone: str, content: Dict, listing: Dict):
-        """Integrate with existing Twilio WhatsApp via Next.js endpoint"""
-        if not phone:
-            return
-        
-        try:
-            try:
-                import httpx
-            except ImportError:
-                logger.warning("httpx not available, skipping WhatsApp send")
-                return
-            
-            api_url = os.getenv("NEXT_PUBLIC_API_URL") or os.getenv("FRONTEND_URL", "http://localhost:3000")
-            
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    f"{api_url}/api/messaging/whatsapp",
-                    json={
-                        "to": phone,
-                        "body": content["body"]
-                    }
-                )
-                if response.status_code != 200:
-                    logger.error(f"WhatsApp sending failed: {response.text}")
-        except Exception as e:
-            logger.error(f"Error sending WhatsApp: {e}")
-    
-    async def _send_sms(self, phone: str, content: Dict, listing: Dict):
-        """Integrate with existing Twilio SMS via Next.js endpoint"""
-        if not phone:
-            return
-        
-        try:
-            try:
-                import httpx
-            except ImportError:
-                logger.warning("httpx not available, skipping SMS send")
-                return
-            
-            api_url = os.getenv("NEXT_PUBLIC_API_URL") or os.getenv("FRONTEND_URL", "http://localhost:3000")
-            
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    f"{api_url}/api/messaging/sms",
-                    json={
-                        "to": phone,
-                        "body": content["body"][:160]  # SMS length limit
-                    }
-                )
-                if response.status_code != 200:
-                    logger.error(f"SMS sending failed: {response.text}")
-        except Exception as e:
-            logger.error(f"Error sending SMS: {e}")
-
@@ -0,0 +1,149 @@
+"""
+Listing Digest
+Rolls queued listing matches up into one message per buyer per day
+"""
+import os
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from .notification_fanout import NotificationFanout
+
+logger = logging.getLogger(__name__)
+
+DIGEST_MAX_LISTINGS = int(os.getenv("DIGEST_MAX_LISTINGS", "10"))
+DIGEST_BUYERS_PER_CLAIM = int(os.getenv("DIGEST_BUYERS_PER_CLAIM", "1000"))
+# A run that dies mid-send leaves rows claimed; they are retried after this
+DIGEST_LEASE_SECONDS = int(os.getenv("DIGEST_LEASE_SECONDS", "900"))
+DIGEST_UPDATE_CHUNK = 500
+
+
+def _price(listing: Dict[str, Any]) -> str:
+    price = listing.get("price") or 0
+    try:
+        return f"₹{float(price):,.0f}" if float(price) > 0 else "Price on request"
+    except (TypeError, ValueError):
+        return "Price on request"
+
+
+def render_digest(rows: List[Dict[str, Any]], max_listings: int = DIGEST_MAX_LISTINGS) -> Dict[str, str]:
+    """One digest message for a buyer's queued matches, best match first"""
+    ranked = sorted(rows, key=lambda r: float(r.get("match_score") or 0), reverse=True)
+    shown = ranked[:max_listings]
+
+    lines = []
+    for position, row in enumerate(shown, 1):
+        listing = row.get("listing") or {}
+        location = listing.get("location") or listing.get("locality") or listing.get("city") or "Location"
+        bedrooms = f"{listing['bedrooms']}BHK, " if listing.get("bedrooms") else ""
+        lines.append(
+            f"{position}. {listing.get('title') or 'New Property'} - {_price(listing)}\n"
+            f"   {bedrooms}{location} · {float(row.get('match_score') or 0):.0f}% match\n"
+            f"   https://tharaga.co.in/properties/{row.get('listing_id')}"
+        )
+    if len(ranked) > len(shown):
+        lines.append(f"...and {len(ranked) - len(shown)} more matches waiting for you on Tharaga.")
+
+    count = len(ranked)
+    subject = f"🏠 {count} new property match{'es' if count != 1 else ''} for you today"
+    body = "Hi there!\n\nHere are today's properties that match your preferences:\n\n" + \
+        "\n\n".join(lines) + "\n\nBest regards,\nTharaga Team\n"
+    return {"subject": subject, "body": body}
+
+
+def _group_by_buyer(rows: List[Dict[str, Any]]) -> Dict[str, Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+    grouped: Dict[str, Tuple[Dict[str, Any], List[Dict[str, Any]]]] = {}
+    for row in rows:
+        if row["buyer_id"] not in grouped:
+            buyer = {
+                "buyer_id": row["buyer_id"],
+                "buyer_email": row.get("buyer_email"),
+                "buyer_phone": row.get("buyer_phone"),
+                "preferred_channels": row.get("preferred_channels") or ["email"],
+            }
+            grouped[row["buyer_id"]] = (buyer, [])
+        grouped[row["buyer_id"]][1].append(row)
+    return grouped
+
+
+def _set_status(client: Any, distribution_ids: List[str], values: Dict[str, Any]):
+    for start in range(0, len(distribution_ids), DIGEST_UPDATE_CHUNK):
+        chunk = distribution_ids[start:start + DIGEST_UPDATE_CHUNK]
+        client.table("listing_distributions").update(values).in_("id", chunk).execute()
+
+
+async def send_listing_digests(
+    client: Any,
+    frequency: str = "daily_digest",
+    fanout: Optional[NotificationFanout] = None,
+    buyers_per_claim: int = DIGEST_BUYERS_PER_CLAIM,
+) -> Dict[str, Any]:
+    """
+    Claim queued distributions buyer by buyer, send one digest each and
+    mark the rows sent. Rows for buyers that could not be reached stay
+    claimed until the lease runs out, so a later run retries them.
+    """
+    fanout = fanout or NotificationFanout()
+    summary: Dict[str, Any] = {
+        "frequency": frequency,
+        "buyers": 0,
+        "listings_rolled_up": 0,
+        "messages_sent": 0,
+        "buyers_failed": 0,
+        "expired": 0,
+        "channels": {},
+    }
+
+    while True:
+        rows = client.rpc("claim_digest_distributions", {
+            "p_frequency": frequency,
+            "p_buyer_limit": buyers_per_claim,
+            "p_lease_seconds": DIGEST_LEASE_SECONDS,
+        }).execute().data or []
+        if not rows:
+            break
+
+        # Listings that went off the market since they were queued are dropped
+        live, expired = [], []
+        for row in rows:
+            if (row.get("listing") or {}).get("listing_status", "active") == "active":
+                live.append(row)
+            else:
+                expired.append(row["distribution_id"])
+        if expired:
+            _set_status(client, expired, {"conversion_status": "expired", "digest_claimed_at": None})
+            summary["expired"] += len(expired)
+
+        grouped = _group_by_buyer(live)
+        messages = [(buyer, render_digest(buyer_rows)) for buyer, buyer_rows in grouped.values()]
+        channel_stats = await fanout.send_messages(messages)
+
+        sent_ids = [
+            row["distribution_id"]
+            for buyer_id in fanout.delivered
+            for row in grouped[buyer_id][1]
+        ]
+        if sent_ids:
+            _set_status(client, sent_ids, {
+                "conversion_status": "sent",
+                "sent_at": datetime.now().isoformat(),
+                "digest_claimed_at": None,
+            })
+
+        summary["buyers"] += len(grouped)
+        summary["listings_rolled_up"] += len(live)
+        summary["buyers_failed"] += len(grouped) - len(fanout.delivered)
+        for channel, stats in channel_stats.items():
+            totals = summary["channels"].setdefault(channel, {"sent": 0, "failed": 0, "skipped": 0, "requests": 0})
+            for key in totals:
+                totals[key] += stats.get(key, 0)
+            summary["messages_sent"] += stats["sent"]
+
+        if len({r["buyer_id"] for r in rows}) < buyers_per_claim:
+            break
+
+    logger.info(
+        f"{frequency}: {summary['listings_rolled_up']} matches rolled up into "
+        f"{summary['messages_sent']} messages for {summary['buyers']} buyers"
+    )
+    return summary
@@ -0,0 +1,246 @@
+"""
+Notification Fan-out
+Concurrent, channel-batched delivery of listing match notifications
+"""
+import asyncio
+import os
+import time
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import httpx
+
+from services.outbound_messaging import outbound_messenger
+
+logger = logging.getLogger(__name__)
+
+# Buyers whose scores fall in the same band (and share top match reasons)
+# get one generated message between them
+DISTRIBUTION_SCORE_BAND = float(os.getenv("DISTRIBUTION_SCORE_BAND", "5"))
+DISTRIBUTION_RENDER_CONCURRENCY = int(os.getenv("DISTRIBUTION_RENDER_CONCURRENCY", "4"))
+# Resend batch and /api/messaging/bulk both accept at most 100 recipients
+DISTRIBUTION_BATCH_SIZE = int(os.getenv("DISTRIBUTION_BATCH_SIZE", "100"))
+RESEND_API_KEY = os.getenv("RESEND_API_KEY")
+RESEND_BATCH_URL = "https://api.resend.com/emails/batch"
+DISTRIBUTION_FROM_EMAIL = os.getenv("DISTRIBUTION_FROM_EMAIL", "Tharaga <noreply@tharaga.co.in>")
+
+PROVIDERS = {"email": "resend", "whatsapp": "twilio_whatsapp", "sms": "twilio_sms"}
+
+RenderFn = Callable[[Dict[str, Any]], Awaitable[Dict[str, str]]]
+# (buyer_id, address, rendered content)
+Outgoing = Tuple[str, str, Dict[str, str]]
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Shared pooled client for notification sends"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(timeout=30.0)
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+def _api_url() -> str:
+    return os.getenv("NEXT_PUBLIC_API_URL") or os.getenv("FRONTEND_URL", "http://localhost:3000")
+
+
+def message_key(buyer: Dict[str, Any], band: Optional[float] = None) -> Tuple[int, Tuple[str, ...]]:
+    """Score band plus the top three match reasons the message would mention"""
+    band = band or DISTRIBUTION_SCORE_BAND
+    factors = buyer.get("match_factors") or {}
+    top = sorted(
+        (name for name, score in factors.items() if isinstance(score, (int, float))),
+        key=lambda name: factors[name],
+        reverse=True
+    )[:3]
+    return int(buyer["match_score"] // band), tuple(top)
+
+
+def _chunks(items: List[Any], size: int) -> List[List[Any]]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class NotificationFanout:
+    """
+    Renders and sends instant match notifications for one listing.
+
+    Buyers are grouped by message_key and one message is rendered per
+    group (using its lowest score, so nobody is over-promised) with at
+    most `render_concurrency` generations in flight. Each channel then
+    sends its groups in provider-sized batches, all channels at once,
+    through the shared rate-limited outbound messenger.
+    """
+
+    def __init__(
+        self,
+        render: Optional[RenderFn] = None,
+        render_concurrency: Optional[int] = None,
+        batch_size: Optional[int] = None,
+        client: Optional[httpx.AsyncClient] = None,
+    ):
+        self.render = render
+        self.render_concurrency = render_concurrency or DISTRIBUTION_RENDER_CONCURRENCY
+        self.batch_size = batch_size or DISTRIBUTION_BATCH_SIZE
+        self._client = client
+        self.delivered: Set[str] = set()
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        return self._client or get_http_client()
+
+    async def send(self, buyers: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        """Notify `buyers` on their preferred channels; returns per-channel stats"""
+        groups: Dict[Tuple[int, Tuple[str, ...]], List[Dict[str, Any]]] = {}
+        for buyer in buyers:
+            groups.setdefault(message_key(buyer), []).append(buyer)
+
+        slots = asyncio.Semaphore(self.render_concurrency)
+
+        async def render_group(members: List[Dict[str, Any]]) -> Dict[str, str]:
+            async with slots:
+                return await self.render(min(members, key=lambda b: b["match_score"]))
+
+        contents = await asyncio.gather(*(render_group(members) for members in groups.values()))
+        return await self.send_messages([
+            (buyer, content) for members, content in zip(groups.values(), contents) for buyer in members
+        ])
+
+    async def send_messages(self, messages: List[Tuple[Dict[str, Any], Dict[str, str]]]) -> Dict[str, Dict[str, Any]]:
+        """
+        Send already rendered (buyer, content) pairs on each buyer's
+        preferred channels. Buyers reached on at least one channel are
+        left in self.delivered.
+        """
+        outgoing: Dict[str, List[Outgoing]] = {}
+        skipped: Dict[str, int] = {}
+        for buyer, content in messages:
+            for channel in buyer["preferred_channels"]:
+                address = buyer.get("buyer_email") if channel == "email" else buyer.get("buyer_phone")
+                if address:
+                    outgoing.setdefault(channel, []).append((buyer["buyer_id"], address, content))
+                else:
+                    skipped[channel] = skipped.get(channel, 0) + 1
+
+        self.delivered = set()
+        channels = list(set(outgoing) | set(skipped))
+        results = await asyncio.gather(*(
+            self._send_channel(channel, self._batches(channel, outgoing.get(channel, []))) for channel in channels
+        ))
+        stats = dict(zip(channels, results))
+        for channel, count in skipped.items():
+            stats[channel]["skipped"] = count
+        return stats
+
+    def _batches(self, channel: str, items: List[Outgoing]) -> List[List[Outgoing]]:
+        """Provider-sized batches; bulk SMS/WhatsApp batches share one message body"""
+        if channel == "email":
+            # Resend batch items each carry their own subject and body
+            return _chunks(items, self.batch_size)
+        runs: Dict[int, List[Outgoing]] = {}
+        for item in items:
+            runs.setdefault(id(item[2]), []).append(item)
+        return [batch for run in runs.values() for batch in _chunks(run, self.batch_size)]
+
+    async def _send_channel(self, channel: str, batches: List[List[Outgoing]]) -> Dict[str, Any]:
+        started = time.monotonic()
+        outcomes = await asyncio.gather(
+            *(self._send_batch(channel, batch) for batch in batches),
+            return_exceptions=True
+        )
+        sent = failed = 0
+        for batch, outcome in zip(batches, outcomes):
+            if isinstance(outcome, Exception):
+                logger.error(f"Error sending {channel} batch of {len(batch)}: {outcome}")
+                failed += len(batch)
+            else:
+                self.delivered.update(outcome)
+                sent += len(outcome)
+                failed += len(batch) - len(outcome)
+        elapsed = time.monotonic() - started
+        return {
+            "sent": sent,
+            "failed": failed,
+            "skipped": 0,
+            "requests": len(batches),
+            "seconds": round(elapsed, 3),
+            "per_second": round(sent / elapsed, 1) if elapsed > 0 else float(sent),
+        }
+
+    # =============================================
+    # CHANNEL SENDERS
+    # =============================================
+
+    async def _send_batch(self, channel: str, batch: List[Outgoing]) -> List[str]:
+        """Send one batch; returns the buyer ids the provider accepted"""
+        if channel == "email":
+            if RESEND_API_KEY:
+                return await self._send_email_batch(batch)
+            return await self._send_each(channel, batch)
+        if channel in ("whatsapp", "sms"):
+            if len({id(content) for _, _, content in batch}) == 1:
+                return await self._send_bulk(channel, batch)
+            return await self._send_each(channel, batch)
+        logger.warning(f"Unsupported notification channel: {channel}")
+        return []
+
+    async def _send_email_batch(self, batch: List[Outgoing]) -> List[str]:
+        async def post():
+            return await self.client.post(
+                RESEND_BATCH_URL,
+                headers={"Authorization": f"Bearer {RESEND_API_KEY}"},
+                json=[
+                    {"from": DISTRIBUTION_FROM_EMAIL, "to": [email], "subject": content["subject"], "text": content["body"]}
+                    for _, email, content in batch
+                ]
+            )
+
+        response = await outbound_messenger.send("resend", "distribution", post)
+        if response.status_code != 200:
+            logger.error(f"Email batch sending failed: {response.text}")
+            return []
+        return [buyer_id for buyer_id, _, _ in batch]
+
+    async def _send_bulk(self, channel: str, batch: List[Outgoing]) -> List[str]:
+        content = batch[0][2]
+        body = content["body"][:160] if channel == "sms" else content["body"]
+
+        async def post():
+            return await self.client.post(
+                f"{_api_url()}/api/messaging/bulk",
+                json={"type": channel, "recipients": [address for _, address, _ in batch], "message": body}
+            )
+
+        response = await outbound_messenger.send(PROVIDERS[channel], "bulk", post)
+        if response.status_code != 200:
+            logger.error(f"{channel} bulk sending failed: {response.text}")
+            return []
+        return [buyer_id for buyer_id, _, _ in batch]
+
+    async def _send_each(self, channel: str, batch: List[Outgoing]) -> List[str]:
+        """Per-recipient sends through the Next.js messaging endpoint"""
+        async def send_one(address: str, content: Dict[str, str]) -> bool:
+            payload = {"to": address, "body": content["body"][:160] if channel == "sms" else content["body"], "type": channel}
+            if channel == "email":
+                payload["subject"] = content["subject"]
+
+            async def post():
+                return await self.client.post(f"{_api_url()}/api/messaging/send", json=payload)
+
+            response = await outbound_messenger.send(PROVIDERS[channel], "default", post)
+            if response.status_code != 200:
+                logger.error(f"{channel} sending failed: {response.text}")
+            return response.status_code == 200
+
+        outcomes = await asyncio.gather(
+            *(send_one(address, content) for _, address, content in batch),
+            return_exceptions=True
+        )
+        return [buyer_id for (buyer_id, _, _), outcome in zip(batch, outcomes) if outcome is True]
@@ -0,0 +1,67 @@
+"""
+Lead Dedup Index
+In-process Bloom filter over leads.phone_hash, so lead ingest only asks the
+database about phones it may already have seen
+"""
+import hashlib
+import logging
+import math
+import os
+from typing import Iterable
+
+logger = logging.getLogger(__name__)
+
+LEAD_DEDUP_CAPACITY = int(os.getenv("LEAD_DEDUP_CAPACITY", "2000000"))
+LEAD_DEDUP_ERROR_RATE = float(os.getenv("LEAD_DEDUP_ERROR_RATE", "0.01"))
+
+
+class PhoneDedupIndex:
+    """
+    Bloom filter answering "definitely new" for a phone hash. False
+    positives (about error_rate while under capacity) only cost the DB
+    lookup the caller would have made anyway. Until warmed, every phone
+    counts as a possible duplicate.
+    """
+
+    def __init__(self, capacity: int = LEAD_DEDUP_CAPACITY, error_rate: float = LEAD_DEDUP_ERROR_RATE):
+        self.capacity = capacity
+        self.num_bits = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+        self.ready = False
+
+    def _positions(self, phone_hash: str) -> Iterable[int]:
+        digest = hashlib.blake2b(phone_hash.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:], "big") | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, phone_hash: str):
+        for position in self._positions(phone_hash):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+        if self.count == self.capacity + 1:
+            logger.warning(
+                f"Lead dedup index passed its capacity of {self.capacity}; "
+                f"raise LEAD_DEDUP_CAPACITY to keep the false positive rate down"
+            )
+
+    def might_contain(self, phone_hash: str) -> bool:
+        if not self.ready:
+            return True
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(phone_hash))
+
+    def load(self, phone_hashes: Iterable[str]):
+        for phone_hash in phone_hashes:
+            self.add(phone_hash)
+
+    def mark_ready(self):
+        self.ready = True
+        logger.info(f"Lead dedup index ready: {self.count} phones, {len(self.bits) / 1e6:.1f} MB")
+
+
+# =============================================
+# INITIALIZE INDEX
+# =============================================
+phone_dedup_index = PhoneDedupIndex()
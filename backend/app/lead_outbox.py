@@ -0,0 +1,317 @@
+"""
+Lead Outbox Dispatcher
+Drains lead_outbox (sql/lead_outbox.sql) in batches: Lead events through
+the CAPI batcher, one SmartScore batch call, then in-process distribution
+"""
+import asyncio
+import logging
+import os
+import random
+import time
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+SUPABASE_URL = os.getenv("SUPABASE_URL", "")
+SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY", "")
+SMARTSCORE_URL = os.getenv("SMARTSCORE_SERVICE_URL", "http://localhost:8001")
+
+LEAD_OUTBOX_BATCH_SIZE = int(os.getenv("LEAD_OUTBOX_BATCH_SIZE", "100"))
+# Upper bound on each step for a whole batch; a step that runs over counts as failed
+LEAD_OUTBOX_STEP_TIMEOUTS = {
+    "capi": float(os.getenv("LEAD_OUTBOX_CAPI_TIMEOUT_SECONDS", "60")),
+    "score": float(os.getenv("LEAD_OUTBOX_SCORE_TIMEOUT_SECONDS", "120")),
+    "distribute": float(os.getenv("LEAD_OUTBOX_DISTRIBUTE_TIMEOUT_SECONDS", "180")),
+}
+# The lease must outlast every step of a batch plus the claim/apply calls,
+# or another dispatcher reclaims the rows and runs the steps again
+LEAD_OUTBOX_LEASE_SECONDS = int(os.getenv(
+    "LEAD_OUTBOX_LEASE_SECONDS", str(int(sum(LEAD_OUTBOX_STEP_TIMEOUTS.values())) + 120)
+))
+LEAD_OUTBOX_POLL_SECONDS = float(os.getenv("LEAD_OUTBOX_POLL_SECONDS", "5"))
+LEAD_OUTBOX_MAX_ATTEMPTS = int(os.getenv("LEAD_OUTBOX_MAX_ATTEMPTS", "8"))
+LEAD_OUTBOX_BACKOFF_BASE_SECONDS = float(os.getenv("LEAD_OUTBOX_BACKOFF_BASE_SECONDS", "10"))
+LEAD_OUTBOX_BACKOFF_MAX_SECONDS = float(os.getenv("LEAD_OUTBOX_BACKOFF_MAX_SECONDS", "3600"))
+LEAD_OUTBOX_DISTRIBUTE_CONCURRENCY = int(os.getenv("LEAD_OUTBOX_DISTRIBUTE_CONCURRENCY", "10"))
+
+SUPABASE_HEADERS = {
+    "apikey": SUPABASE_SERVICE_ROLE_KEY,
+    "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}",
+    "Content-Type": "application/json",
+}
+
+# Run in this order; distribution needs the ML score. CAPI reporting is
+# independent, so a Meta outage never holds back scoring or assignment
+STEPS = ("capi", "score", "distribute")
+STEP_REQUIRES = {"distribute": ("score",)}
+
+
+def _supabase_rest(path: str) -> str:
+    return f"{SUPABASE_URL}/rest/v1/{path}"
+
+
+def _iso(epoch: float) -> str:
+    return datetime.fromtimestamp(epoch, timezone.utc).isoformat()
+
+
+def backoff_seconds(attempts: int) -> float:
+    """Delay before retry number `attempts` (1-based), jittered +/-25%"""
+    delay = min(LEAD_OUTBOX_BACKOFF_MAX_SECONDS, LEAD_OUTBOX_BACKOFF_BASE_SECONDS * (2 ** (attempts - 1)))
+    return delay * random.uniform(0.75, 1.25)
+
+
+def capi_lead_event(lead: Dict[str, Any]) -> Dict[str, Any]:
+    """Meta Conversions API Lead event for a leads row"""
+    user_data: Dict[str, Any] = {}
+    if lead.get("email_hash"):
+        user_data["em"] = [lead["email_hash"]]
+    if lead.get("phone_hash"):
+        user_data["ph"] = [lead["phone_hash"]]
+    if lead.get("fbc"):
+        user_data["fbc"] = lead["fbc"]
+    if lead.get("fbp"):
+        user_data["fbp"] = lead["fbp"]
+    return {
+        "event_name": "Lead",
+        "event_time": int(time.time()),
+        "event_id": lead.get("event_id") or lead["id"],
+        "action_source": "website",
+        "user_data": user_data,
+        "custom_data": {
+            "content_name": lead.get("preferred_location") or "Chennai Property",
+            "currency": "INR",
+            "value": (lead.get("budget") or 0) * 100000,  # lakhs → INR
+        },
+    }
+
+
+# =============================================
+# STEPS
+# =============================================
+# Each step takes the batch's leads and returns the lead ids it handled;
+# leads missing from the result are retried on the next attempt.
+
+async def send_capi_leads(client: httpx.AsyncClient, leads: List[Dict[str, Any]]) -> Set[str]:
+    """Queue the batch's Lead events on the shared CAPI batcher (which sets capi_lead_fired)"""
+    from .routes import capi
+
+    if not capi.META_ACCESS_TOKEN or not capi.META_PIXEL_ID:
+        return {lead["id"] for lead in leads}
+    futures = [capi.capi_batcher.enqueue(capi_lead_event(lead), lead["id"]) for lead in leads]
+    results = await asyncio.gather(*futures)
+    return {
+        lead["id"] for lead, result in zip(leads, results)
+        if result.get("status") in ("fired", "duplicate")
+    }
+
+
+async def score_leads(client: httpx.AsyncClient, leads: List[Dict[str, Any]]) -> Set[str]:
+    """Score the whole batch with one SmartScore /score/batch call"""
+    ids = [lead["id"] for lead in leads]
+    resp = await client.post(f"{SMARTSCORE_URL}/score/batch", json=ids, timeout=LEAD_OUTBOX_STEP_TIMEOUTS["score"])
+    if resp.status_code != 200:
+        logger.warning(f"Batch SmartScore failed ({resp.status_code}): {resp.text}")
+        return set()
+    return set(ids)
+
+
+async def distribute_leads(client: httpx.AsyncClient, leads: List[Dict[str, Any]]) -> Set[str]:
+    """Assign each lead in-process (assign_lead RPC), a few at a time"""
+    from fastapi import HTTPException
+    from .routes.distribution import distribute_lead_internal
+
+    # assign_lead is not idempotent (it re-assigns and bumps counters), so leads
+    # already assigned by an earlier attempt whose outcome was not recorded are skipped
+    resp = await client.get(
+        _supabase_rest("leads"),
+        headers=SUPABASE_HEADERS,
+        params={"id": "in.(" + ",".join(lead["id"] for lead in leads) + ")", "select": "id,assigned_to"},
+    )
+    resp.raise_for_status()
+    done: Set[str] = {row["id"] for row in resp.json() if row.get("assigned_to")}
+    semaphore = asyncio.Semaphore(LEAD_OUTBOX_DISTRIBUTE_CONCURRENCY)
+
+    async def distribute(lead_id: str):
+        async with semaphore:
+            try:
+                await distribute_lead_internal(lead_id)
+            except HTTPException as e:
+                if e.status_code != 404:
+                    raise
+                logger.warning(f"Lead {lead_id} deleted before distribution")
+            done.add(lead_id)
+
+    results = await asyncio.gather(
+        *(distribute(lead["id"]) for lead in leads if lead["id"] not in done), return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning(f"Distribution failed: {result}")
+    return done
+
+
+# =============================================
+# DISPATCHER
+# =============================================
+class LeadOutboxDispatcher:
+    """
+    Drains lead_outbox in the background.
+
+    Each drain claims a batch (leased, so several API processes can share
+    one outbox), runs every step still pending for it batch-wide and
+    writes all outcomes back in one call.
+    """
+
+    def __init__(
+        self,
+        steps: Optional[Dict[str, Callable[[httpx.AsyncClient, List[Dict]], Awaitable[Set[str]]]]] = None,
+        client: Optional[httpx.AsyncClient] = None,
+        batch_size: int = LEAD_OUTBOX_BATCH_SIZE,
+        lease_seconds: int = LEAD_OUTBOX_LEASE_SECONDS,
+        poll_seconds: float = LEAD_OUTBOX_POLL_SECONDS,
+        max_attempts: int = LEAD_OUTBOX_MAX_ATTEMPTS,
+    ):
+        self.steps = steps or {"capi": send_capi_leads, "score": score_leads, "distribute": distribute_leads}
+        self._client = client
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.max_attempts = max_attempts
+
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+        self.processed = 0
+        self.dead = 0
+
+    # =============================================
+    # LIFECYCLE
+    # =============================================
+
+    def start(self):
+        """Start the drain loop (idempotent; needs a running event loop)"""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._task is None or self._task.done():
+            self._stopping = False
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+            logger.info("Lead outbox dispatcher started")
+
+    def wake(self):
+        """New rows were written: drain now instead of at the next poll"""
+        self.start()
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def stop(self):
+        if self._task:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                drained = await self.drain_once()
+            except Exception as e:
+                logger.error(f"Lead outbox drain failed: {str(e)}")
+                drained = 0
+            if drained >= self.batch_size:
+                continue  # more may be due right away
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    # =============================================
+    # PROCESSING
+    # =============================================
+
+    async def drain_once(self) -> int:
+        """Claim one batch of due rows, run their pending steps and record outcomes"""
+        if self._client is not None:
+            return await self._drain(self._client)
+        async with httpx.AsyncClient(timeout=30) as client:
+            return await self._drain(client)
+
+    async def _drain(self, client: httpx.AsyncClient) -> int:
+        resp = await client.post(
+            _supabase_rest("rpc/claim_lead_outbox"),
+            headers=SUPABASE_HEADERS,
+            json={"p_limit": self.batch_size, "p_lease_seconds": self.lease_seconds},
+        )
+        resp.raise_for_status()
+        rows = resp.json() or []
+        if not rows:
+            return 0
+
+        completed = {row["id"]: set(row.get("completed_steps") or []) for row in rows}
+        errors: Dict[str, str] = {}
+        for step in STEPS:
+            # A step only runs for leads whose prerequisite steps succeeded
+            todo = [
+                row for row in rows
+                if step not in completed[row["id"]] and set(STEP_REQUIRES.get(step, ())) <= completed[row["id"]]
+            ]
+            if not todo:
+                continue
+            leads = [{**(row.get("payload") or {}), "id": row["lead_id"]} for row in todo]
+            try:
+                handled = await asyncio.wait_for(
+                    self.steps[step](client, leads), timeout=LEAD_OUTBOX_STEP_TIMEOUTS.get(step)
+                )
+            except asyncio.TimeoutError:
+                logger.warning(f"Lead outbox step {step} timed out for {len(todo)} leads")
+                handled = set()
+            except Exception as e:
+                logger.warning(f"Lead outbox step {step} failed for {len(todo)} leads: {e}")
+                handled = set()
+            for row in todo:
+                if row["lead_id"] in handled:
+                    completed[row["id"]].add(step)
+                else:
+                    errors.setdefault(row["id"], f"{step} failed")
+
+        results = [self._outcome(row, completed[row["id"]], errors.get(row["id"])) for row in rows]
+        resp = await client.post(
+            _supabase_rest("rpc/apply_lead_outbox_results"),
+            headers=SUPABASE_HEADERS,
+            json={"p_results": results},
+        )
+        resp.raise_for_status()
+        return len(rows)
+
+    def _outcome(self, row: Dict, completed: Set[str], error: Optional[str]) -> Dict:
+        steps = [step for step in STEPS if step in completed]
+        if len(steps) == len(STEPS):
+            self.processed += 1
+            return {"id": row["id"], "status": "done", "completed_steps": steps, "processed_at": _iso(time.time())}
+
+        attempts = (row.get("attempts") or 0) + 1
+        if attempts >= self.max_attempts:
+            self.dead += 1
+            logger.warning(f"Lead outbox row for lead {row['lead_id']} dead-lettered after {attempts} attempts: {error}")
+            return {"id": row["id"], "status": "dead", "attempts": attempts, "completed_steps": steps,
+                    "last_error": error}
+        return {
+            "id": row["id"],
+            "status": "pending",
+            "attempts": attempts,
+            "next_attempt_at": _iso(time.time() + backoff_seconds(attempts)),
+            "completed_steps": steps,
+            "last_error": error,
+        }
+
+
+# =============================================
+# INITIALIZE DISPATCHER
+# =============================================
+lead_outbox_dispatcher = LeadOutboxDispatcher()
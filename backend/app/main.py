@@ -736,6 +736,26 @@ async def distribute_listing(request: Request):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/ai/distribution/digest")
+async def send_distribution_digest():
+    """Send the daily digest to daily_digest buyers (called by cron once a day)"""
+    try:
+        from .ai.distribution_engine import SmartDistributionEngine
+        
+        engine = SmartDistributionEngine()
+        result = await engine.send_daily_digests()
+        
+        if not result.get("success"):
+            raise HTTPException(status_code=500, detail=result.get("error", "Digest failed"))
+        
+        return result
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Digest error: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 # ===========================================
 # AI Virtual Staging Endpoints
 # ===========================================
@@ -3,17 +3,20 @@ Module 8: Meta Conversions API Helper
 Server-side event firing for offline conversions (site visit, booking/purchase).
 SHA-256 hashes email + phone; fbc/fbp sent as-is (not hashed per Meta spec).
 Deduplication via shared eventID between browser pixel and server CAPI.
+Events are queued and sent in batches (one request per flush, flags coalesced).
 """
 from __future__ import annotations
 
+import asyncio
 import hashlib
 import logging
 import os
 import time
+from functools import lru_cache
 from typing import Any
 
 import httpx
-from fastapi import APIRouter, BackgroundTasks, HTTPException
+from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 
 logger = logging.getLogger(__name__)
@@ -23,6 +26,9 @@ META_ACCESS_TOKEN = os.getenv("META_ACCESS_TOKEN", "")
 META_PIXEL_ID = os.getenv("META_PIXEL_ID", "")
 META_TEST_EVENT_CODE = os.getenv("META_TEST_EVENT_CODE", "")
 CAPI_ENDPOINT = f"https://graph.facebook.com/v19.0/{META_PIXEL_ID}/events"
+CAPI_BATCH_MAX_EVENTS = int(os.getenv("CAPI_BATCH_MAX_EVENTS", "500"))
+CAPI_BATCH_MAX_WAIT_SECONDS = float(os.getenv("CAPI_BATCH_MAX_WAIT_SECONDS", "1"))
+CAPI_DEDUP_TTL_SECONDS = float(os.getenv("CAPI_DEDUP_TTL_SECONDS", "3600"))
 
 SUPABASE_URL = os.getenv("SUPABASE_URL", "")
 SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY", "")
@@ -33,6 +39,24 @@ SUPABASE_HEADERS = {
 }
 
 
+# Shared pooled client for CAPI and the leads flag updates
+_http_client: httpx.AsyncClient | None = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(timeout=15)
+    return _http_client
+
+
+async def close_http_client() -> None:
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
 def _sha256(value: str) -> str:
     return hashlib.sha256(value.strip().lower().encode()).hexdigest()
 
@@ -57,12 +81,24 @@ class CAPIEventPayload(BaseModel):
     visit_id: str | None = None
 
 
-async def _fire_capi_event(payload: CAPIEventPayload) -> dict:
-    if not META_ACCESS_TOKEN or not META_PIXEL_ID:
-        return {"status": "skipped", "reason": "Meta CAPI not configured"}
+# leads column set once an event of this name was accepted for the lead
+CAPI_FLAGS = {
+    "Lead": "capi_lead_fired",
+    "Schedule": "capi_visit_fired",
+    "Purchase": "capi_purchase_fired",
+}
+
 
+@lru_cache(maxsize=1024)
+def _sha256_location(value: str) -> str:
+    """Country/state/city repeat across events: hash each distinct value once."""
+    return _sha256(value)
+
+
+def build_capi_event(payload: CAPIEventPayload) -> dict[str, Any]:
+    """CAPI `data` entry for a payload; PII is hashed here, once, at enqueue time."""
     user_data: dict[str, Any] = {
-        "country": [_sha256(payload.country)],
+        "country": [_sha256_location(payload.country)],
     }
     if payload.email:
         user_data["em"] = [_sha256(payload.email)]
@@ -73,9 +109,9 @@ async def _fire_capi_event(payload: CAPIEventPayload) -> dict:
     if payload.fbp:
         user_data["fbp"] = payload.fbp   # NOT hashed
     if payload.city:
-        user_data["ct"] = [_sha256(payload.city)]
+        user_data["ct"] = [_sha256_location(payload.city)]
     if payload.state:
-        user_data["st"] = [_sha256(payload.state)]
+        user_data["st"] = [_sha256_location(payload.state)]
 
     custom_data: dict[str, Any] = {
         "currency": payload.currency,
@@ -88,58 +124,172 @@ async def _fire_capi_event(payload: CAPIEventPayload) -> dict:
     if payload.content_type:
         custom_data["content_type"] = payload.content_type
 
-    event_body: dict[str, Any] = {
-        "data": [{
-            "event_name": payload.event_name,
-            "event_time": int(time.time()),
-            "event_id": payload.event_id,
-            "action_source": payload.action_source,
-            "user_data": user_data,
-            "custom_data": custom_data,
-        }]
-    }
-    if META_TEST_EVENT_CODE:
-        event_body["test_event_code"] = META_TEST_EVENT_CODE
-
-    async with httpx.AsyncClient(timeout=10) as client:
-        resp = await client.post(
-            CAPI_ENDPOINT,
-            params={"access_token": META_ACCESS_TOKEN},
-            json=event_body,
-        )
-        if resp.status_code != 200:
-            logger.warning("CAPI event %s failed: %s", payload.event_name, resp.text)
-            return {"status": "error", "detail": resp.text}
-        return {"status": "fired", "event": payload.event_name, "event_id": payload.event_id}
-
-
-async def _update_lead_capi_flag(lead_id: str, event_name: str) -> None:
-    flag_map = {
-        "Lead": "capi_lead_fired",
-        "Schedule": "capi_visit_fired",
-        "Purchase": "capi_purchase_fired",
+    return {
+        "event_name": payload.event_name,
+        "event_time": int(time.time()),
+        "event_id": payload.event_id,
+        "action_source": payload.action_source,
+        "user_data": user_data,
+        "custom_data": custom_data,
     }
-    flag = flag_map.get(event_name)
-    if not flag or not lead_id:
-        return
-    async with httpx.AsyncClient(timeout=5) as client:
-        await client.patch(
-            f"{SUPABASE_URL}/rest/v1/leads?id=eq.{lead_id}",
-            headers=SUPABASE_HEADERS,
-            json={flag: True},
-        )
+
+
+# ── Batcher ───────────────────────────────────────────────────────────────────
+class CAPIBatcher:
+    """
+    Queues CAPI events in-process and sends them up to CAPI_BATCH_MAX_EVENTS
+    per request, flushing when a batch fills or CAPI_BATCH_MAX_WAIT_SECONDS
+    after its first event. Events are deduplicated by (event_name, event_id)
+    while queued and for CAPI_DEDUP_TTL_SECONDS after they were accepted.
+    The leads flag PATCHes of a flush go out as one bulk update per flag.
+    A batch rejected with 400 is split in halves and resent, so one invalid
+    event does not fail the events batched with it.
+    """
+
+    def __init__(
+        self,
+        max_events: int = CAPI_BATCH_MAX_EVENTS,
+        max_wait_seconds: float = CAPI_BATCH_MAX_WAIT_SECONDS,
+        dedup_ttl_seconds: float = CAPI_DEDUP_TTL_SECONDS,
+        client: httpx.AsyncClient | None = None,
+    ) -> None:
+        self.max_events = min(max_events, 1000)  # Conversions API limit per request
+        self.max_wait_seconds = max_wait_seconds
+        self.dedup_ttl_seconds = dedup_ttl_seconds
+        self._client = client
+        self._queue: list[tuple[dict[str, Any], str | None]] = []
+        self._pending: dict[tuple[str, str], asyncio.Future] = {}
+        self._sent: dict[tuple[str, str], float] = {}
+        self._timer: asyncio.Task | None = None
+        self._flushes: set[asyncio.Task] = set()
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        return self._client or get_http_client()
+
+    def enqueue(self, event: dict[str, Any], lead_id: str | None = None) -> asyncio.Future:
+        """Queue a built event; the future resolves with its flush result."""
+        key = (event["event_name"], event["event_id"])
+        if key in self._pending:
+            return self._pending[key]
+        future = asyncio.get_running_loop().create_future()
+        if self._sent.get(key, 0) > time.monotonic():
+            future.set_result({"status": "duplicate", "event": key[0], "event_id": key[1]})
+            return future
+
+        self._pending[key] = future
+        self._queue.append((event, lead_id))
+        if len(self._queue) >= self.max_events:
+            self._spawn_flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+        return future
+
+    async def send(self, payload: CAPIEventPayload) -> dict:
+        if not META_ACCESS_TOKEN or not META_PIXEL_ID:
+            return {"status": "skipped", "reason": "Meta CAPI not configured"}
+        return await self.enqueue(build_capi_event(payload), payload.lead_id)
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.max_wait_seconds)
+        self._timer = None
+        await self.flush()
+
+    def _spawn_flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        task = asyncio.create_task(self.flush())
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def flush(self) -> None:
+        while self._queue:
+            batch, self._queue = self._queue[:self.max_events], self._queue[self.max_events:]
+            await self._send_batch(batch)
+
+    async def _send_batch(self, batch: list[tuple[dict[str, Any], str | None]]) -> None:
+        keys = [(event["event_name"], event["event_id"]) for event, _ in batch]
+        body: dict[str, Any] = {"data": [event for event, _ in batch]}
+        if META_TEST_EVENT_CODE:
+            body["test_event_code"] = META_TEST_EVENT_CODE
+        status_code = None
+        try:
+            resp = await self.client.post(CAPI_ENDPOINT, params={"access_token": META_ACCESS_TOKEN}, json=body)
+            status_code = resp.status_code
+            error = None if status_code == 200 else resp.text
+        except Exception as exc:
+            error = str(exc)
+
+        if status_code == 400 and len(batch) > 1:
+            # Meta rejects the whole request for one invalid event; split until
+            # only the offending events fail
+            mid = len(batch) // 2
+            await self._send_batch(batch[:mid])
+            await self._send_batch(batch[mid:])
+            return
+
+        if error is not None:
+            logger.warning("CAPI batch of %d events failed: %s", len(batch), error)
+        else:
+            expires = time.monotonic() + self.dedup_ttl_seconds
+            self._sent.update((key, expires) for key in keys)
+            await self._update_lead_flags(batch)
+            if len(self._sent) > 10 * self.max_events:
+                now = time.monotonic()
+                self._sent = {k: t for k, t in self._sent.items() if t > now}
+
+        for key in keys:
+            future = self._pending.pop(key)
+            if not future.done():
+                future.set_result(
+                    {"status": "error", "detail": error} if error is not None
+                    else {"status": "fired", "event": key[0], "event_id": key[1]}
+                )
+
+    async def _update_lead_flags(self, batch: list[tuple[dict[str, Any], str | None]]) -> None:
+        by_flag: dict[str, set[str]] = {}
+        for event, lead_id in batch:
+            flag = CAPI_FLAGS.get(event["event_name"])
+            if flag and lead_id:
+                by_flag.setdefault(flag, set()).add(lead_id)
+        for flag, lead_ids in by_flag.items():
+            try:
+                await self.client.patch(
+                    f"{SUPABASE_URL}/rest/v1/leads",
+                    headers=SUPABASE_HEADERS,
+                    params={"id": f"in.({','.join(sorted(lead_ids))})"},
+                    json={flag: True},
+                )
+            except Exception as exc:
+                logger.warning("CAPI flag update (%s) failed: %s", flag, exc)
+
+    async def close(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await self.flush()
+        await asyncio.gather(*self._flushes, return_exceptions=True)
+
+
+capi_batcher = CAPIBatcher()
+
+
+@router.on_event("shutdown")
+async def flush_capi_batcher() -> None:
+    await capi_batcher.close()
+    await close_http_client()
+
+
+async def _fire_capi_event(payload: CAPIEventPayload) -> dict:
+    return await capi_batcher.send(payload)
 
 
 @router.post("/fire")
-async def fire_capi_event(
-    payload: CAPIEventPayload,
-    background_tasks: BackgroundTasks,
-) -> dict:
+async def fire_capi_event(payload: CAPIEventPayload) -> dict:
     """Fire a Meta CAPI event for any conversion point."""
-    result = await _fire_capi_event(payload)
-    if payload.lead_id:
-        background_tasks.add_task(_update_lead_capi_flag, payload.lead_id, payload.event_name)
-    return result
+    # The batcher sets the lead's capi_*_fired flag once Meta accepts the event
+    return await _fire_capi_event(payload)
 
 
 @router.post("/view-content")
@@ -176,7 +326,6 @@ async def fire_purchase(
     phone: str | None = None,
     fbc: str | None = None,
     fbp: str | None = None,
-    background_tasks: BackgroundTasks = None,
 ) -> dict:
     """Fire Purchase event when booking token is paid (₹25,000)."""
     payload = CAPIEventPayload(
@@ -194,7 +343,4 @@ async def fire_purchase(
         lead_id=lead_id,
         visit_id=visit_id,
     )
-    result = await _fire_capi_event(payload)
-    if background_tasks and lead_id:
-        background_tasks.add_task(_update_lead_capi_flag, lead_id, "Purchase")
-    return result
+    return await _fire_capi_event(payload)
@@ -3,15 +3,14 @@ Module 5: Lead Distribution Engine
 Lion (≥70) → top exec by conversion_rate
 Monkey (40-69) → round-robin by last_assigned_at
 Dog (<40) → channel partner network
-SLA: Lion=15min, Monkey=2h → breach triggers re-assignment + WhatsApp alert
+SLA: Lion=15min, Monkey=2h → periodic sweep re-assigns breaches + WhatsApp alert
 """
 from __future__ import annotations
 
 import asyncio
 import logging
 import os
-from datetime import datetime, timedelta, timezone
-from typing import Any
+import time
 
 import httpx
 from fastapi import APIRouter, BackgroundTasks, HTTPException
@@ -32,6 +31,11 @@ SUPABASE_HEADERS = {
 }
 
 SLA_MINUTES = {"lion": 15, "monkey": 120, "dog": 480}
+SLA_SWEEP_INTERVAL_SECONDS = float(os.getenv("SLA_SWEEP_INTERVAL_SECONDS", "30"))
+SLA_SWEEP_BATCH_SIZE = int(os.getenv("SLA_SWEEP_BATCH_SIZE", "100"))
+# Older breaches are left alone (e.g. the first sweep after a long outage)
+SLA_SWEEP_MAX_OVERDUE_HOURS = int(os.getenv("SLA_SWEEP_MAX_OVERDUE_HOURS", "24"))
+STATS_RECONCILE_SECONDS = float(os.getenv("DISTRIBUTION_STATS_RECONCILE_SECONDS", "300"))
 
 
 def _supabase(path: str) -> str:
@@ -52,245 +56,223 @@ class DistributeResponse(BaseModel):
 
 
 # ── Core distribution logic ───────────────────────────────────────────────────
-async def _get_lead(lead_id: str) -> dict | None:
+async def _assign_lead(lead_id: str, force_reassign: bool = False) -> dict | None:
+    """
+    Pick an assignee, take capacity, update the lead and log the event in
+    one transaction (assign_lead RPC). Returns None if the lead is missing.
+    """
     async with httpx.AsyncClient(timeout=10) as client:
-        resp = await client.get(
-            _supabase("leads"),
+        resp = await client.post(
+            _supabase("rpc/assign_lead"),
             headers=SUPABASE_HEADERS,
-            params={"id": f"eq.{lead_id}", "select": "*", "limit": "1"},
+            json={
+                "p_lead_id": lead_id,
+                "p_sla_minutes": SLA_MINUTES,
+                "p_force_reassign": force_reassign,
+            },
         )
-        data = resp.json()
-        return data[0] if data and isinstance(data, list) else None
+        resp.raise_for_status()
+        return resp.json() or None
 
 
-async def _assign_to_top_exec(lead: dict) -> dict | None:
-    """Lion tier: assign to exec with highest conversion_rate."""
-    async with httpx.AsyncClient(timeout=10) as client:
-        resp = await client.get(
-            _supabase("sales_team"),
-            headers=SUPABASE_HEADERS,
-            params={
-                "is_active": "eq.true",
-                "select": "id,name,phone,whatsapp_number,conversion_rate",
-                "order": "conversion_rate.desc",
-                "limit": "5",
-            },
-        )
-        execs = resp.json()
-        if not execs or not isinstance(execs, list):
-            return None
-        # Pick first available (capacity check)
-        for exec_rec in execs:
-            cap_resp = await client.get(
-                _supabase("sales_team"),
-                headers=SUPABASE_HEADERS,
-                params={
-                    "id": f"eq.{exec_rec['id']}",
-                    "select": "max_daily_leads,current_daily_count,count_reset_date",
-                    "limit": "1",
-                },
-            )
-            cap = cap_resp.json()
-            if not cap:
-                continue
-            cap = cap[0]
-            today = datetime.now(timezone.utc).date().isoformat()
-            if cap.get("count_reset_date") != today:
-                # Reset counter
-                await client.patch(
-                    _supabase(f"sales_team?id=eq.{exec_rec['id']}"),
-                    headers=SUPABASE_HEADERS,
-                    json={"current_daily_count": 0, "count_reset_date": today},
-                )
-                cap["current_daily_count"] = 0
-            if cap.get("current_daily_count", 0) < cap.get("max_daily_leads", 20):
-                return exec_rec
-        return execs[0] if execs else None  # fallback to top exec
-
-
-async def _assign_round_robin(lead: dict) -> dict | None:
-    """Monkey tier: round-robin by last_assigned_at (nulls first)."""
-    async with httpx.AsyncClient(timeout=10) as client:
-        resp = await client.get(
-            _supabase("sales_team"),
-            headers=SUPABASE_HEADERS,
-            params={
-                "is_active": "eq.true",
-                "select": "id,name,phone,whatsapp_number",
-                "order": "last_assigned_at.asc.nullsfirst",
-                "limit": "1",
-            },
-        )
-        execs = resp.json()
-        return execs[0] if execs and isinstance(execs, list) else None
+async def _send_whatsapp_alert(phone: str, message: str) -> None:
+    """Send WhatsApp via the shared outbound sender (fire and forget)."""
+    try:
+        # Called in-process rather than over HTTP so the alert goes through
+        # the shared Twilio rate limiter exactly once
+        from .whatsapp import OutboundMessagePayload, send_whatsapp
+
+        result = await send_whatsapp(OutboundMessagePayload(
+            to_phone=phone,
+            template="lion_alert",
+            variables={"message": message, "name": "Team"},
+        ))
+        if result.get("status") != "sent":
+            logger.warning("WhatsApp alert not sent: %s", result.get("detail"))
+    except Exception as exc:
+        logger.warning("WhatsApp alert failed: %s", exc)
 
 
-async def _assign_to_cp_network(lead: dict) -> dict | None:
-    """Dog tier: channel partner round-robin."""
-    async with httpx.AsyncClient(timeout=10) as client:
-        resp = await client.get(
-            _supabase("channel_partners"),
-            headers=SUPABASE_HEADERS,
-            params={
-                "is_active": "eq.true",
-                "select": "id,name,phone,whatsapp_number",
-                "order": "last_assigned_at.asc.nullsfirst",
-                "limit": "1",
-            },
-        )
-        partners = resp.json()
-        return partners[0] if partners and isinstance(partners, list) else None
+async def _alert_assignee(assignment: dict) -> None:
+    """WhatsApp the new assignee of a Lion lead."""
+    lead = assignment.get("lead") or {}
+    assignee_phone = assignment.get("assignee_phone")
+    if assignment.get("classification") == "lion" and assignment.get("assigned_to") and assignee_phone:
+        await _send_whatsapp_alert(assignee_phone, f"🦁 HIGH PRIORITY lead assigned: {lead.get('name')} — {lead.get('phone')}. Budget: {lead.get('budget')} lakhs. Respond within 15 minutes!")
+
+
+# ── Stats ─────────────────────────────────────────────────────────────────────
+class DistributionStats:
+    """
+    In-memory distribution counters behind GET /stats.
+
+    Bumped as this process assigns leads and replaced wholesale by the
+    distribution_stats RPC snapshot every STATS_RECONCILE_SECONDS, which
+    picks up everything the counters can't see (status changes by sales,
+    other replicas, manual edits).
+    """
+
+    def __init__(self) -> None:
+        self.pipeline = {"lion_count": 0, "monkey_count": 0, "dog_count": 0}
+        self.sales_team: list[dict] = []
+        self.assignees: dict[str, int] = {}
+        self.sla = {"open": 0, "breaches_24h": 0}
+        self.reconciled_at: float | None = None
+        self._sales_by_id: dict[str, dict] = {}
+
+    def load(self, snapshot: dict) -> None:
+        self.pipeline = {**self.pipeline, **(snapshot.get("pipeline") or {})}
+        self.sales_team = snapshot.get("sales_team") or []
+        self._sales_by_id = {str(member["id"]): member for member in self.sales_team}
+        self.assignees = {str(k): int(v) for k, v in (snapshot.get("assignees") or {}).items()}
+        self.sla = {**self.sla, **(snapshot.get("sla") or {})}
+        self.reconciled_at = time.time()
+
+    def record_assignment(self, assignment: dict) -> None:
+        assignee = assignment.get("assigned_to")
+        if not assignee:
+            # assign_lead leaves the lead as it was when nobody can take it
+            return
+        assignee = str(assignee)
+        lead = assignment.get("lead") or {}  # the row as it was before assignment
+        previous = str(lead["assigned_to"]) if lead.get("assigned_to") else None
+        was_open = previous is not None and lead.get("status", "new") == "new"
+
+        if previous is None:
+            key = f"{assignment.get('classification') or 'dog'}_count"
+            self.pipeline[key] = self.pipeline.get(key, 0) + 1
+        if was_open:
+            remaining = self.assignees.get(previous, 0) - 1
+            if remaining > 0:
+                self.assignees[previous] = remaining
+            else:
+                self.assignees.pop(previous, None)
+        else:
+            self.sla["open"] += 1
+        self.assignees[assignee] = self.assignees.get(assignee, 0) + 1
+
+        member = self._sales_by_id.get(assignee)
+        if member is not None:
+            member["leads_handled"] = (member.get("leads_handled") or 0) + 1
+
+    def record_breaches(self, count: int) -> None:
+        self.sla["breaches_24h"] += count
+
+    def snapshot(self) -> dict:
+        return {
+            "pipeline": self.pipeline,
+            "sales_team": self.sales_team,
+            "assignees": self.assignees,
+            "sla": self.sla,
+            "reconciled_at": self.reconciled_at,
+        }
 
 
-async def _update_assignee(assignee_id: str, table: str, lead_id: str) -> None:
-    """Increment assignment count and update last_assigned_at."""
-    async with httpx.AsyncClient(timeout=10) as client:
-        # Update last_assigned_at
-        await client.patch(
-            _supabase(f"{table}?id=eq.{assignee_id}"),
-            headers=SUPABASE_HEADERS,
-            json={
-                "last_assigned_at": datetime.now(timezone.utc).isoformat(),
-                "leads_handled": None,  # DB trigger increments
-            },
-        )
-        # For sales_team: increment current_daily_count
-        if table == "sales_team":
-            # Use rpc or just patch with increment
-            resp = await client.get(
-                _supabase(f"sales_team?id=eq.{assignee_id}&select=current_daily_count"),
-                headers=SUPABASE_HEADERS,
-            )
-            data = resp.json()
-            if data:
-                count = data[0].get("current_daily_count", 0)
-                await client.patch(
-                    _supabase(f"sales_team?id=eq.{assignee_id}"),
-                    headers=SUPABASE_HEADERS,
-                    json={"current_daily_count": count + 1},
-                )
-
-
-async def _log_lead_event(lead_id: str, event_type: str, new_value: dict) -> None:
-    async with httpx.AsyncClient(timeout=5) as client:
-        await client.post(
-            _supabase("lead_events"),
-            headers=SUPABASE_HEADERS,
-            json={
-                "lead_id": lead_id,
-                "event_type": event_type,
-                "actor_type": "system",
-                "new_value": new_value,
-            },
-        )
+distribution_stats_cache = DistributionStats()
 
 
-async def _send_whatsapp_alert(phone: str, message: str) -> None:
-    """Send WhatsApp via internal route (fire and forget)."""
-    try:
-        async with httpx.AsyncClient(timeout=10) as client:
-            await client.post(
-                "http://localhost:8000/api/whatsapp/send",
+async def reconcile_stats() -> None:
+    """Replace the in-memory counters with a fresh DB snapshot."""
+    async with httpx.AsyncClient(timeout=30) as client:
+        resp = await client.post(_supabase("rpc/distribution_stats"), headers=SUPABASE_HEADERS, json={})
+        resp.raise_for_status()
+        distribution_stats_cache.load(resp.json() or {})
+
+
+# ── SLA sweeper ───────────────────────────────────────────────────────────────
+async def sweep_sla_breaches() -> dict:
+    """
+    Re-assign every lead still 'new' past its sla_deadline.
+
+    Each sweep_sla_breaches RPC call logs the breach and re-assigns a batch
+    in one transaction (SKIP LOCKED, so replicas and overlapping cron calls
+    split the work); alerts for the batch then go out concurrently.
+    """
+    breached = reassigned = 0
+    async with httpx.AsyncClient(timeout=30) as client:
+        while True:
+            resp = await client.post(
+                _supabase("rpc/sweep_sla_breaches"),
+                headers=SUPABASE_HEADERS,
                 json={
-                    "to_phone": phone,
-                    "template": "lion_alert",
-                    "variables": {"message": message, "name": "Team"},
+                    "p_limit": SLA_SWEEP_BATCH_SIZE,
+                    "p_sla_minutes": SLA_MINUTES,
+                    "p_max_overdue_hours": SLA_SWEEP_MAX_OVERDUE_HOURS,
                 },
             )
-    except Exception as exc:
-        logger.warning("WhatsApp alert failed: %s", exc)
+            resp.raise_for_status()
+            assignments = resp.json() or []
+            if not assignments:
+                break
+
+            breached += len(assignments)
+            reassigned += sum(1 for a in assignments if a.get("assigned_to"))
+            distribution_stats_cache.record_breaches(len(assignments))
+            for assignment in assignments:
+                distribution_stats_cache.record_assignment(assignment)
+                logger.warning("SLA breach for lead %s (classification=%s)",
+                               (assignment.get("lead") or {}).get("id"), assignment.get("classification"))
+            # N8N SLA breach trigger stays DISCONNECTED (Ultra Automation handles this)
+            await asyncio.gather(*(_alert_assignee(a) for a in assignments), return_exceptions=True)
+
+            if len(assignments) < SLA_SWEEP_BATCH_SIZE:
+                break
+
+    return {"breached": breached, "reassigned": reassigned}
 
 
-async def _check_sla_breach(lead_id: str, classification: str, assignee_phone: str | None) -> None:
-    """Wait for SLA duration, then check if lead is still 'new' and re-assign."""
-    sla_minutes = SLA_MINUTES.get(classification, 120)
-    await asyncio.sleep(sla_minutes * 60)
+async def _run_periodically(job, interval: float, name: str) -> None:
+    while True:
+        try:
+            await job()
+        except Exception as exc:
+            logger.error("%s failed: %s", name, exc)
+        await asyncio.sleep(interval)
 
-    lead = await _get_lead(lead_id)
-    if not lead or lead.get("status") not in ("new",):
-        return  # Already contacted — no breach
 
-    logger.warning("SLA breach for lead %s (classification=%s)", lead_id, classification)
+_background_tasks: list[asyncio.Task] = []
 
-    # Log breach event
-    await _log_lead_event(lead_id, "sla_breach", {"sla_minutes": sla_minutes, "classification": classification})
 
-    # ── N8N SLA breach trigger — DISCONNECTED (Ultra Automation is active instead) ──
-    # if N8N_WEBHOOK_SLA_BREACH:
-    #     try:
-    #         async with httpx.AsyncClient(timeout=10) as client:
-    #             await client.post(
-    #                 N8N_WEBHOOK_SLA_BREACH,
-    #                 json={"lead_id": lead_id, "classification": classification, "sla_minutes": sla_minutes},
-    #             )
-    #     except Exception:
-    #         pass
+@router.on_event("startup")
+async def start_background_jobs() -> None:
+    if not SUPABASE_URL or _background_tasks:
+        return
+    _background_tasks.extend([
+        asyncio.create_task(_run_periodically(sweep_sla_breaches, SLA_SWEEP_INTERVAL_SECONDS, "SLA sweep")),
+        asyncio.create_task(_run_periodically(reconcile_stats, STATS_RECONCILE_SECONDS, "Stats reconcile")),
+    ])
 
-    # Re-assign: rotate to next available person
-    await distribute_lead_internal(lead_id, force_reassign=True)
+
+@router.on_event("shutdown")
+async def stop_background_jobs() -> None:
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
 
 
 # ── Main distribution function ────────────────────────────────────────────────
 async def distribute_lead_internal(lead_id: str, force_reassign: bool = False) -> dict:
-    lead = await _get_lead(lead_id)
-    if not lead:
+    assignment = await _assign_lead(lead_id, force_reassign=force_reassign)
+    if not assignment:
         raise HTTPException(status_code=404, detail="Lead not found")
 
-    classification = lead.get("classification", "dog")
-    assignee = None
-    assignment_type = None
-    table = "sales_team"
-
-    if classification == "lion":
-        assignee = await _assign_to_top_exec(lead)
-        assignment_type = "sales_exec"
-        table = "sales_team"
-    elif classification == "monkey":
-        assignee = await _assign_round_robin(lead)
-        assignment_type = "sales_exec"
-        table = "sales_team"
-    else:  # dog
-        assignee = await _assign_to_cp_network(lead)
-        assignment_type = "channel_partner"
-        table = "channel_partners"
-
-    now = datetime.now(timezone.utc)
-    sla_deadline = (now + timedelta(minutes=SLA_MINUTES.get(classification, 120))).isoformat()
-
-    if assignee:
-        assigned_id = assignee["id"]
-        async with httpx.AsyncClient(timeout=10) as client:
-            await client.patch(
-                _supabase(f"leads?id=eq.{lead_id}"),
-                headers=SUPABASE_HEADERS,
-                json={
-                    "assigned_to": assigned_id,
-                    "assignment_type": assignment_type,
-                    "sla_deadline": sla_deadline,
-                    "updated_at": now.isoformat(),
-                },
-            )
-        await _update_assignee(assigned_id, table, lead_id)
-        await _log_lead_event(lead_id, "assigned", {
-            "assignee_id": assigned_id,
-            "assignment_type": assignment_type,
-            "classification": classification,
-        })
-
-        # Schedule SLA breach check (fire and forget)
-        assignee_phone = assignee.get("whatsapp_number") or assignee.get("phone")
-        asyncio.create_task(_check_sla_breach(lead_id, classification, assignee_phone))
+    classification = assignment["classification"]
+    assigned_id = assignment.get("assigned_to")
+    if assigned_id is None and assignment.get("assignees_available"):
+        # Retryable (the lead outbox keeps the distribute step pending)
+        raise HTTPException(status_code=503, detail="No assignee picked; retry")
 
-        # Send WhatsApp alert for Lion leads
-        if classification == "lion" and assignee_phone:
-            await _send_whatsapp_alert(assignee_phone, f"🦁 HIGH PRIORITY lead assigned: {lead.get('name')} — {lead.get('phone')}. Budget: {lead.get('budget')} lakhs. Respond within 15 minutes!")
+    distribution_stats_cache.record_assignment(assignment)
+    # SLA breaches are picked up by the periodic sweeper from sla_deadline
+    await _alert_assignee(assignment)
 
     return {
         "lead_id": lead_id,
-        "assigned_to": assignee["id"] if assignee else None,
-        "assignment_type": assignment_type,
+        "assigned_to": assigned_id,
+        "assignment_type": assignment.get("assignment_type"),
         "classification": classification,
-        "sla_deadline": sla_deadline,
+        "sla_deadline": assignment.get("sla_deadline"),
     }
 
 
@@ -305,35 +287,19 @@ async def distribute_lead(
     return DistributeResponse(**result)
 
 
+@router.post("/sla/sweep")
+async def sla_sweep() -> dict:
+    """Run an SLA breach sweep now (the in-process sweeper also runs every SLA_SWEEP_INTERVAL_SECONDS)."""
+    return await sweep_sla_breaches()
+
+
 @router.get("/stats")
 async def distribution_stats() -> dict:
-    """Get distribution pipeline stats."""
-    async with httpx.AsyncClient(timeout=10) as client:
-        lion_resp = await client.get(
-            _supabase("leads"),
-            headers=SUPABASE_HEADERS,
-            params={"classification": "eq.lion", "select": "id", "head": "true"},
-        )
-        monkey_resp = await client.get(
-            _supabase("leads"),
-            headers=SUPABASE_HEADERS,
-            params={"classification": "eq.monkey", "select": "id", "head": "true"},
-        )
-        dog_resp = await client.get(
-            _supabase("leads"),
-            headers=SUPABASE_HEADERS,
-            params={"classification": "eq.dog", "select": "id", "head": "true"},
-        )
-        sales_resp = await client.get(
-            _supabase("sales_team"),
-            headers=SUPABASE_HEADERS,
-            params={"is_active": "eq.true", "select": "id,name,leads_handled,conversion_rate"},
-        )
-        return {
-            "pipeline": {
-                "lion_count": lion_resp.headers.get("Content-Range", "0").split("/")[-1],
-                "monkey_count": monkey_resp.headers.get("Content-Range", "0").split("/")[-1],
-                "dog_count": dog_resp.headers.get("Content-Range", "0").split("/")[-1],
-            },
-            "sales_team": sales_resp.json() if sales_resp.status_code == 200 else [],
-        }
+    """Get distribution pipeline stats (served from memory; reconciled against the DB in the background)."""
+    if distribution_stats_cache.reconciled_at is None:
+        # First call before the reconciler has run
+        try:
+            await reconcile_stats()
+        except Exception as exc:
+            logger.error("Stats reconcile failed: %s", exc)
+    return distribution_stats_cache.snapshot()
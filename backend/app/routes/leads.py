@@ -2,26 +2,32 @@
 Module 2: Lead Ingest Engine
 FastAPI route for capturing leads with:
 - Phone dedup by phone_normalized (E.164)
-- Meta CAPI server-side event firing
-- SmartScore trigger (async)
+- Lead outbox: Meta CAPI, SmartScore and distribution follow-ups (batched, retried)
 - N8N welcome workflow trigger
 - Meta Lead Ads webhook handler
+- Streaming bulk CSV/NDJSON ingest
 """
 from __future__ import annotations
 
 import asyncio
+import codecs
+import csv
 import hashlib
+import json
 import logging
 import os
 import re
-import time
 import uuid
-from datetime import datetime, timezone
-from typing import Any
+from typing import Any, AsyncIterator
 
 import httpx
-from fastapi import APIRouter, BackgroundTasks, HTTPException, Request
-from pydantic import BaseModel, field_validator
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Query, Request
+from pydantic import BaseModel, ValidationError, field_validator
+
+from services.webhook_inbox import RecentKeys
+
+from ..lead_dedup import phone_dedup_index
+from ..lead_outbox import lead_outbox_dispatcher
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/api/leads", tags=["leads"])
@@ -30,10 +36,10 @@ router = APIRouter(prefix="/api/leads", tags=["leads"])
 SUPABASE_URL = os.getenv("SUPABASE_URL", "")
 SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY", "")
 META_ACCESS_TOKEN = os.getenv("META_ACCESS_TOKEN", "")
-META_PIXEL_ID = os.getenv("META_PIXEL_ID", "")
-META_TEST_EVENT_CODE = os.getenv("META_TEST_EVENT_CODE", "")  # for testing
 # N8N_WEBHOOK_NEW_LEAD = os.getenv("N8N_WEBHOOK_NEW_LEAD", "")  # DISCONNECTED: Ultra Automation handles this
-SMARTSCORE_URL = os.getenv("SMARTSCORE_SERVICE_URL", "http://localhost:8001")
+BULK_INGEST_CHUNK_SIZE = int(os.getenv("BULK_INGEST_CHUNK_SIZE", "500"))
+BULK_INGEST_MAX_ERRORS = 100  # row errors echoed back in the response
+META_GRAPH_BATCH_SIZE = 50  # ids per Graph multi-id lookup
 
 SUPABASE_HEADERS = {
     "apikey": SUPABASE_SERVICE_ROLE_KEY,
@@ -41,6 +47,10 @@ SUPABASE_HEADERS = {
     "Content-Type": "application/json",
     "Prefer": "return=representation",
 }
+LEAD_DEDUP_WARM_PAGE_SIZE = 1000
+
+# Leadgen ids seen by this process (Meta redelivers webhooks it considers unacknowledged)
+_recent_leadgen_ids = RecentKeys(ttl_seconds=3600)
 
 
 # ── helpers ───────────────────────────────────────────────────────────────────
@@ -109,57 +119,10 @@ class LeadIngestResponse(BaseModel):
     classification: str | None = None
 
 
-# ── background tasks ──────────────────────────────────────────────────────────
-async def _fire_meta_capi_lead(lead: dict[str, Any]) -> None:
-    """Fire Meta Conversions API Lead event server-side."""
-    if not META_ACCESS_TOKEN or not META_PIXEL_ID:
-        return
-    try:
-        user_data: dict[str, Any] = {}
-        if lead.get("email_hash"):
-            user_data["em"] = [lead["email_hash"]]
-        if lead.get("phone_hash"):
-            user_data["ph"] = [lead["phone_hash"]]
-        if lead.get("fbc"):
-            user_data["fbc"] = lead["fbc"]
-        if lead.get("fbp"):
-            user_data["fbp"] = lead["fbp"]
-
-        payload: dict[str, Any] = {
-            "data": [{
-                "event_name": "Lead",
-                "event_time": int(time.time()),
-                "event_id": lead.get("event_id") or lead["id"],
-                "action_source": "website",
-                "user_data": user_data,
-                "custom_data": {
-                    "content_name": lead.get("preferred_location", "Chennai Property"),
-                    "currency": "INR",
-                    "value": (lead.get("budget") or 0) * 100000,  # lakhs → INR
-                },
-            }]
-        }
-        if META_TEST_EVENT_CODE:
-            payload["test_event_code"] = META_TEST_EVENT_CODE
-
-        async with httpx.AsyncClient(timeout=10) as client:
-            resp = await client.post(
-                f"https://graph.facebook.com/v19.0/{META_PIXEL_ID}/events",
-                params={"access_token": META_ACCESS_TOKEN},
-                json=payload,
-            )
-            if resp.status_code != 200:
-                logger.warning("CAPI Lead event failed: %s", resp.text)
-            else:
-                # Mark capi_lead_fired in DB
-                await client.patch(
-                    _supabase_rest(f"leads?id=eq.{lead['id']}"),
-                    headers=SUPABASE_HEADERS,
-                    json={"capi_lead_fired": True},
-                )
-    except Exception as exc:
-        logger.error("CAPI fire error: %s", exc)
-
+# ── follow-up work ────────────────────────────────────────────────────────────
+# CAPI, SmartScore and distribution for new leads run from the lead outbox
+# (app/lead_outbox.py): insert_leads_with_outbox writes the outbox row in
+# the same transaction as the lead.
 
 # ── N8N new-lead trigger — DISCONNECTED (Ultra Automation is active instead) ──
 # async def _trigger_n8n_new_lead(lead: dict[str, Any]) -> None:
@@ -170,56 +133,138 @@ async def _fire_meta_capi_lead(lead: dict[str, Any]) -> None:
 #             await client.post(N8N_WEBHOOK_NEW_LEAD, json={"lead": lead})
 #     except Exception as exc:
 #         logger.warning("N8N trigger failed: %s", exc)
-async def _trigger_n8n_new_lead(lead: dict[str, Any]) -> None:
-    """Stub — N8N disconnected. Ultra Automation pipeline handles lead events."""
-    return  # noqa: intentional no-op
 
 
-async def _trigger_smartscore(lead_id: str) -> None:
-    """Call SmartScore service to score this lead asynchronously."""
-    await asyncio.sleep(2)  # small delay to ensure DB write is committed
-    try:
-        async with httpx.AsyncClient(timeout=30) as client:
-            resp = await client.post(
-                f"{SMARTSCORE_URL}/score",
-                json={"lead_id": lead_id},
-            )
-            if resp.status_code == 200:
-                data = resp.json()
-                # Patch lead with score result
-                await client.patch(
-                    _supabase_rest(f"leads?id=eq.{lead_id}"),
-                    headers=SUPABASE_HEADERS,
-                    json={
-                        "smartscore": data.get("smartscore", 0),
-                        "classification": data.get("classification"),
-                        "score_breakdown": data.get("score_breakdown", {}),
-                    },
-                )
-    except Exception as exc:
-        logger.warning("SmartScore trigger failed for %s: %s", lead_id, exc)
+async def _insert_leads(client: httpx.AsyncClient, rows: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """
+    Insert leads with their outbox rows in one transaction. Phones that
+    already exist are skipped by the unique index and left out of the result.
+    """
+    resp = await client.post(
+        _supabase_rest("rpc/insert_leads_with_outbox"),
+        headers=SUPABASE_HEADERS,
+        json={"p_leads": rows},
+    )
+    if resp.status_code not in (200, 201):
+        logger.error("Lead insert failed: %s", resp.text)
+        raise HTTPException(status_code=500, detail="Failed to save lead")
+    created = resp.json() or []
+    if created:
+        lead_outbox_dispatcher.wake()
+    return created
+
+
+@router.on_event("startup")
+async def start_lead_outbox() -> None:
+    if SUPABASE_URL:
+        lead_outbox_dispatcher.start()
+
+
+@router.on_event("shutdown")
+async def stop_lead_outbox() -> None:
+    await lead_outbox_dispatcher.stop()
+
+
+async def _find_lead_by_phone(client: httpx.AsyncClient, phone_normalized: str) -> dict[str, Any] | None:
+    resp = await client.get(
+        _supabase_rest("leads"),
+        headers=SUPABASE_HEADERS,
+        params={
+            "phone_normalized": f"eq.{phone_normalized}",
+            "select": "id,smartscore,classification",
+            "limit": "1",
+        },
+    )
+    existing = resp.json()
+    return existing[0] if existing and isinstance(existing, list) else None
 
 
-async def _trigger_distribution(lead_id: str) -> None:
-    """Trigger lead distribution 30s after creation."""
-    await asyncio.sleep(30)
+async def warm_phone_dedup_index() -> None:
+    """Load every lead's phone hash into the local dedup index (keyset-paged)."""
+    last_id = None
     try:
-        async with httpx.AsyncClient(timeout=15) as client:
-            await client.post(
-                _supabase_rest(f"rpc/distribute_lead"),
-                headers=SUPABASE_HEADERS,
-                json={"p_lead_id": lead_id},
-            )
+        async with httpx.AsyncClient(timeout=30) as client:
+            while True:
+                params = {
+                    "select": "id,phone_hash,phone_normalized",
+                    "phone_normalized": "not.is.null",
+                    "order": "id",
+                    "limit": str(LEAD_DEDUP_WARM_PAGE_SIZE),
+                }
+                if last_id:
+                    params["id"] = f"gt.{last_id}"
+                resp = await client.get(_supabase_rest("leads"), headers=SUPABASE_HEADERS, params=params)
+                resp.raise_for_status()
+                rows = resp.json()
+                phone_dedup_index.load(row.get("phone_hash") or sha256(row["phone_normalized"]) for row in rows)
+                if len(rows) < LEAD_DEDUP_WARM_PAGE_SIZE:
+                    break
+                last_id = rows[-1]["id"]
+        phone_dedup_index.mark_ready()
     except Exception as exc:
-        logger.warning("Distribution trigger failed for %s: %s", lead_id, exc)
+        # Stays in fallback mode: every ingest checks the DB as before
+        logger.error("Lead dedup index warm-up failed: %s", exc)
+
+
+@router.on_event("startup")
+async def start_phone_dedup_warmup() -> None:
+    if SUPABASE_URL:
+        asyncio.create_task(warm_phone_dedup_index())
+
+
+def _build_lead_record(payload: LeadIngestPayload, phone_normalized: str) -> dict[str, Any]:
+    """leads row for a validated payload, with the rule-based initial SmartScore."""
+    lead_data: dict[str, Any] = {
+        "id": str(uuid.uuid4()),
+        "name": payload.name,
+        "phone": payload.phone,
+        "phone_normalized": phone_normalized,
+        "phone_hash": sha256(phone_normalized),
+        "email_hash": sha256(payload.email) if payload.email else None,
+        "source": payload.utm_source or "organic",
+        "utm_source": payload.utm_source,
+        "utm_medium": payload.utm_medium,
+        "utm_campaign": payload.utm_campaign,
+        "utm_content": payload.utm_content,
+        "utm_term": payload.utm_term,
+        "fbclid": payload.fbclid,
+        "gclid": payload.gclid,
+        "fbc": payload.fbc,
+        "fbp": payload.fbp,
+        "event_id": payload.event_id,
+        "message": payload.message,
+        "status": "new",
+        "smartscore": 0,
+    }
+    if payload.email:
+        lead_data["email"] = payload.email
+    if payload.property_id:
+        lead_data["property_id"] = payload.property_id
+    if payload.builder_id:
+        lead_data["builder_id"] = payload.builder_id
+    if payload.budget is not None:
+        lead_data["budget"] = payload.budget
+    if payload.preferred_location:
+        lead_data["preferred_location"] = payload.preferred_location
+    if payload.timeline_months is not None:
+        lead_data["timeline_months"] = payload.timeline_months
+    if payload.property_type_interest:
+        lead_data["property_type_interest"] = payload.property_type_interest
+    if payload.purpose:
+        lead_data["purpose"] = payload.purpose
+    if payload.loan_required is not None:
+        lead_data["loan_required"] = payload.loan_required
+
+    # Initial rule-based SmartScore before ML kicks in
+    initial_score = _rule_based_initial_score(payload)
+    lead_data["smartscore"] = initial_score
+    lead_data["classification"] = _classify(initial_score)
+    return lead_data
 
 
 # ── main endpoint ─────────────────────────────────────────────────────────────
 @router.post("/ingest", response_model=LeadIngestResponse)
-async def ingest_lead(
-    payload: LeadIngestPayload,
-    background_tasks: BackgroundTasks,
-) -> LeadIngestResponse:
+async def ingest_lead(payload: LeadIngestPayload) -> LeadIngestResponse:
     """
     Ingest a new lead from any source (web form, API, Meta Lead Ads).
     Deduplicates by phone_normalized (E.164).
@@ -229,95 +274,36 @@ async def ingest_lead(
         raise HTTPException(status_code=422, detail="Invalid phone number")
 
     phone_hash = sha256(phone_normalized)
-    email_hash = sha256(payload.email) if payload.email else None
 
-    # ── Dedup check ───────────────────────────────────────────────────────────
     async with httpx.AsyncClient(timeout=10) as client:
-        dedup_resp = await client.get(
-            _supabase_rest("leads"),
-            headers=SUPABASE_HEADERS,
-            params={
-                "phone_normalized": f"eq.{phone_normalized}",
-                "select": "id,smartscore,classification",
-                "limit": "1",
-            },
-        )
-        existing = dedup_resp.json()
-        if existing and isinstance(existing, list) and len(existing) > 0:
-            ex = existing[0]
+        # ── Dedup check (only when the local index can't rule it out) ────────
+        if phone_dedup_index.might_contain(phone_hash):
+            existing = await _find_lead_by_phone(client, phone_normalized)
+            if existing:
+                return LeadIngestResponse(
+                    lead_id=existing["id"],
+                    status="deduplicated",
+                    smartscore=existing.get("smartscore"),
+                    classification=existing.get("classification"),
+                )
+
+        lead_data = _build_lead_record(payload, phone_normalized)
+        initial_score = lead_data["smartscore"]
+
+        # ── Insert lead + outbox row (the unique index catches phones the index missed)
+        created = await _insert_leads(client, [lead_data])
+        phone_dedup_index.add(phone_hash)
+        if not created:
+            existing = await _find_lead_by_phone(client, phone_normalized)
+            if not existing:
+                raise HTTPException(status_code=500, detail="Failed to save lead")
             return LeadIngestResponse(
-                lead_id=ex["id"],
+                lead_id=existing["id"],
                 status="deduplicated",
-                smartscore=ex.get("smartscore"),
-                classification=ex.get("classification"),
+                smartscore=existing.get("smartscore"),
+                classification=existing.get("classification"),
             )
-
-        # ── Build lead record ─────────────────────────────────────────────────
-        lead_data: dict[str, Any] = {
-            "id": str(uuid.uuid4()),
-            "name": payload.name,
-            "phone": payload.phone,
-            "phone_normalized": phone_normalized,
-            "phone_hash": phone_hash,
-            "email_hash": email_hash,
-            "source": payload.utm_source or "organic",
-            "utm_source": payload.utm_source,
-            "utm_medium": payload.utm_medium,
-            "utm_campaign": payload.utm_campaign,
-            "utm_content": payload.utm_content,
-            "utm_term": payload.utm_term,
-            "fbclid": payload.fbclid,
-            "gclid": payload.gclid,
-            "fbc": payload.fbc,
-            "fbp": payload.fbp,
-            "event_id": payload.event_id,
-            "message": payload.message,
-            "status": "new",
-            "smartscore": 0,
-        }
-        if payload.email:
-            lead_data["email"] = payload.email
-        if payload.property_id:
-            lead_data["property_id"] = payload.property_id
-        if payload.builder_id:
-            lead_data["builder_id"] = payload.builder_id
-        if payload.budget is not None:
-            lead_data["budget"] = payload.budget
-        if payload.preferred_location:
-            lead_data["preferred_location"] = payload.preferred_location
-        if payload.timeline_months is not None:
-            lead_data["timeline_months"] = payload.timeline_months
-        if payload.property_type_interest:
-            lead_data["property_type_interest"] = payload.property_type_interest
-        if payload.purpose:
-            lead_data["purpose"] = payload.purpose
-        if payload.loan_required is not None:
-            lead_data["loan_required"] = payload.loan_required
-
-        # Initial rule-based SmartScore before ML kicks in
-        initial_score = _rule_based_initial_score(payload)
-        lead_data["smartscore"] = initial_score
-        lead_data["classification"] = _classify(initial_score)
-
-        # ── Insert ────────────────────────────────────────────────────────────
-        insert_resp = await client.post(
-            _supabase_rest("leads"),
-            headers=SUPABASE_HEADERS,
-            json=lead_data,
-        )
-        if insert_resp.status_code not in (200, 201):
-            logger.error("Lead insert failed: %s", insert_resp.text)
-            raise HTTPException(status_code=500, detail="Failed to save lead")
-
-        created = insert_resp.json()
-        if isinstance(created, list):
-            created = created[0]
-
-    # ── Fire background tasks ─────────────────────────────────────────────────
-    background_tasks.add_task(_fire_meta_capi_lead, created)
-    background_tasks.add_task(_trigger_n8n_new_lead, created)
-    background_tasks.add_task(_trigger_smartscore, created["id"])
-    background_tasks.add_task(_trigger_distribution, created["id"])
+        created = created[0]
 
     return LeadIngestResponse(
         lead_id=created["id"],
@@ -327,6 +313,165 @@ async def ingest_lead(
     )
 
 
+# ── bulk ingest ───────────────────────────────────────────────────────────────
+class BulkIngestResponse(BaseModel):
+    rows: int
+    created: int
+    deduplicated: int
+    invalid: int
+    errors: list[dict[str, Any]]
+
+
+async def _stream_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Decode a byte stream into lines (newline kept) without buffering the body."""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    pending = ""
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        *complete, pending = pending.split("\n")
+        for line in complete:
+            yield line + "\n"
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+async def _iter_records(chunks: AsyncIterator[bytes], fmt: str) -> AsyncIterator[dict[str, Any] | str]:
+    """
+    Yield one dict per CSV/NDJSON record, or an error string for a record
+    that can't be parsed. CSV columns are LeadIngestPayload field names.
+    """
+    header: list[str] | None = None
+    record = ""
+    async for line in _stream_lines(chunks):
+        if fmt == "ndjson":
+            if not line.strip():
+                continue
+            try:
+                value = json.loads(line)
+            except ValueError as exc:
+                yield f"Invalid JSON: {exc}"
+                continue
+            yield value if isinstance(value, dict) else "Expected a JSON object"
+            continue
+
+        # A quoted CSV field may span lines: wait for the quotes to balance
+        record += line
+        if record.count('"') % 2:
+            continue
+        text, record = record, ""
+        if not text.strip():
+            continue
+        values = next(csv.reader([text]))
+        if header is None:
+            header = [column.strip() for column in values]
+            continue
+        yield dict(zip(header, values))
+    if record.strip():
+        yield "Unterminated quoted CSV field"
+
+
+def _payload_from_record(record: dict[str, Any]) -> LeadIngestPayload:
+    fields = LeadIngestPayload.model_fields
+    cleaned = {
+        key: value.strip() if isinstance(value, str) else value
+        for key, value in record.items()
+        if key in fields
+    }
+    return LeadIngestPayload(**{k: v for k, v in cleaned.items() if v not in ("", None)})
+
+
+async def _insert_lead_chunk(
+    client: httpx.AsyncClient,
+    leads: list[dict[str, Any]],
+) -> tuple[list[dict[str, Any]], int]:
+    """
+    Insert a chunk of new leads with at most one dedup lookup (for phones
+    the local index can't rule out) and one insert_leads_with_outbox call.
+    Returns (created rows, count that already existed).
+    """
+    possible = [lead["phone_normalized"] for lead in leads if phone_dedup_index.might_contain(lead["phone_hash"])]
+    existing: set[str] = set()
+    if possible:
+        resp = await client.get(
+            _supabase_rest("leads"),
+            headers=SUPABASE_HEADERS,
+            params={"phone_normalized": f"in.({','.join(possible)})", "select": "phone_normalized"},
+        )
+        resp.raise_for_status()
+        existing = {row["phone_normalized"] for row in resp.json()}
+    fresh = [lead for lead in leads if lead["phone_normalized"] not in existing]
+    if not fresh:
+        return [], len(leads)
+
+    # Rows another writer inserted first come back missing, not as errors
+    created = await _insert_leads(client, fresh)
+    for lead in fresh:
+        phone_dedup_index.add(lead["phone_hash"])
+    return created, len(leads) - len(created)
+
+
+@router.post("/ingest/bulk", response_model=BulkIngestResponse)
+async def ingest_leads_bulk(
+    request: Request,
+    fmt: str | None = Query(None, alias="format"),
+) -> BulkIngestResponse:
+    """
+    Bulk-ingest leads from a CSV (text/csv) or NDJSON (application/x-ndjson)
+    request body. The body is parsed as it streams in; every
+    BULK_INGEST_CHUNK_SIZE rows are deduplicated against existing leads in
+    one lookup and inserted, with their outbox rows, in one request.
+    """
+    content_type = request.headers.get("content-type", "")
+    fmt = fmt or ("ndjson" if "ndjson" in content_type or "jsonl" in content_type else "csv")
+    if fmt not in ("csv", "ndjson"):
+        raise HTTPException(status_code=415, detail="Expected CSV or NDJSON")
+
+    summary = {"rows": 0, "created": 0, "deduplicated": 0, "invalid": 0}
+    errors: list[dict[str, Any]] = []
+    seen: set[str] = set()
+    pending: list[dict[str, Any]] = []
+
+    def reject(row: int, error: str) -> None:
+        summary["invalid"] += 1
+        if len(errors) < BULK_INGEST_MAX_ERRORS:
+            errors.append({"row": row, "error": error})
+
+    async with httpx.AsyncClient(timeout=30) as client:
+
+        async def flush() -> None:
+            created, duplicates = await _insert_lead_chunk(client, pending)
+            summary["created"] += len(created)
+            summary["deduplicated"] += duplicates
+            pending.clear()
+
+        async for record in _iter_records(request.stream(), fmt):
+            summary["rows"] += 1
+            if isinstance(record, str):
+                reject(summary["rows"], record)
+                continue
+            try:
+                payload = _payload_from_record(record)
+            except ValidationError as exc:
+                reject(summary["rows"], "; ".join(e["msg"] for e in exc.errors()))
+                continue
+
+            phone_normalized = normalize_phone(payload.phone)
+            if phone_normalized in seen:
+                summary["deduplicated"] += 1
+                continue
+            seen.add(phone_normalized)
+            pending.append(_build_lead_record(payload, phone_normalized))
+            if len(pending) >= BULK_INGEST_CHUNK_SIZE:
+                await flush()
+
+        if pending:
+            await flush()
+
+    logger.info("Bulk ingest: %s", summary)
+    return BulkIngestResponse(**summary, errors=errors)
+
+
 # ── Meta Lead Ads webhook ─────────────────────────────────────────────────────
 @router.get("/meta-webhook")
 async def meta_webhook_verify(
@@ -343,49 +488,100 @@ async def meta_webhook_verify(
 
 @router.post("/meta-webhook")
 async def meta_webhook_receive(request: Request, background_tasks: BackgroundTasks) -> dict:
-    """Receive Meta Lead Ads leads via webhook and ingest them."""
+    """
+    Receive Meta Lead Ads leads via webhook. All leadgen ids in the
+    delivery are fetched and ingested together in one background pass.
+    """
     body = await request.json()
-    leads_ingested = 0
-    for entry in body.get("entry", []):
-        for change in entry.get("changes", []):
-            if change.get("field") != "leadgen":
-                continue
-            lead_data = change.get("value", {})
-            # Fetch full lead from Meta Lead Ads API
-            background_tasks.add_task(_fetch_and_ingest_meta_lead, lead_data)
-            leads_ingested += 1
-    return {"status": "ok", "leads_queued": leads_ingested}
+    leadgen_ids = [
+        str(change["value"]["leadgen_id"])
+        for entry in body.get("entry", [])
+        for change in entry.get("changes", [])
+        if change.get("field") == "leadgen" and (change.get("value") or {}).get("leadgen_id")
+    ]
+    # Meta retries deliveries: skip ids this process is already handling
+    fresh = [lid for lid in dict.fromkeys(leadgen_ids) if _recent_leadgen_ids.add(lid)]
+    if fresh:
+        background_tasks.add_task(_ingest_meta_leads, fresh)
+    return {"status": "ok", "leads_queued": len(fresh)}
+
+
+def _meta_lead_payload(leadgen_id: str, meta_lead: dict[str, Any]) -> LeadIngestPayload | None:
+    fields = {f["name"]: f["values"][0] if f["values"] else "" for f in meta_lead.get("field_data", [])}
+    if not fields.get("phone_number"):
+        logger.warning("Meta lead %s has no phone number, skipped", leadgen_id)
+        return None
+    try:
+        return LeadIngestPayload(
+            name=fields.get("full_name", fields.get("name", "Meta Lead")),
+            phone=fields["phone_number"],
+            email=fields.get("email"),
+            utm_source="meta_lead_ads",
+            utm_medium="paid_social",
+            budget=float(fields.get("budget", 0)) if fields.get("budget") else None,
+            event_id=leadgen_id,  # idempotency key, and the CAPI dedup id
+        )
+    except (ValidationError, ValueError) as exc:
+        logger.warning("Meta lead %s rejected: %s", leadgen_id, exc)
+        return None
 
 
-async def _fetch_and_ingest_meta_lead(lead_data: dict) -> None:
-    """Fetch full lead details from Meta and ingest."""
-    lead_id = lead_data.get("leadgen_id")
-    if not lead_id or not META_ACCESS_TOKEN:
+async def _fetch_meta_leads(client: httpx.AsyncClient, leadgen_ids: list[str]) -> dict[str, dict[str, Any]]:
+    """Lead details for many leadgen ids via Graph multi-id lookups (?ids=...)."""
+    leads: dict[str, dict[str, Any]] = {}
+    for start in range(0, len(leadgen_ids), META_GRAPH_BATCH_SIZE):
+        chunk = leadgen_ids[start:start + META_GRAPH_BATCH_SIZE]
+        resp = await client.get(
+            "https://graph.facebook.com/v19.0/",
+            params={"ids": ",".join(chunk), "access_token": META_ACCESS_TOKEN, "fields": "field_data,created_time"},
+        )
+        if resp.status_code != 200:
+            logger.warning("Meta lead fetch failed for %d leads: %s", len(chunk), resp.text)
+            continue
+        leads.update(resp.json())
+    return leads
+
+
+async def _ingest_meta_leads(leadgen_ids: list[str]) -> None:
+    """Fetch leadgen leads in batches and push them through the bulk insert path."""
+    if not META_ACCESS_TOKEN:
         return
     try:
         async with httpx.AsyncClient(timeout=15) as client:
+            # Leadgen ids already ingested (e.g. before a restart) are stored as event_id
             resp = await client.get(
-                f"https://graph.facebook.com/v19.0/{lead_id}",
-                params={"access_token": META_ACCESS_TOKEN, "fields": "field_data,created_time"},
+                _supabase_rest("leads"),
+                headers=SUPABASE_HEADERS,
+                params={"event_id": f"in.({','.join(leadgen_ids)})", "select": "event_id"},
             )
-            if resp.status_code != 200:
-                logger.warning("Meta lead fetch failed: %s", resp.text)
+            resp.raise_for_status()
+            known = {row["event_id"] for row in resp.json()}
+            todo = [lid for lid in leadgen_ids if lid not in known]
+            if not todo:
                 return
-            meta_lead = resp.json()
-            fields = {f["name"]: f["values"][0] if f["values"] else "" for f in meta_lead.get("field_data", [])}
-            payload = LeadIngestPayload(
-                name=fields.get("full_name", fields.get("name", "Meta Lead")),
-                phone=fields.get("phone_number", "0000000000"),
-                email=fields.get("email"),
-                utm_source="meta_lead_ads",
-                utm_medium="paid_social",
-                budget=float(fields.get("budget", 0)) if fields.get("budget") else None,
-            )
-            # Re-use ingest logic
-            from fastapi import BackgroundTasks as BT
-            bt = BT()
-            await ingest_lead(payload, bt)
+
+            meta_leads = await _fetch_meta_leads(client, todo)
+            records: dict[str, dict[str, Any]] = {}
+            for leadgen_id in todo:
+                if leadgen_id not in meta_leads:
+                    # Not fetched: let a redelivery try again
+                    _recent_leadgen_ids.discard(leadgen_id)
+                    continue
+                payload = _meta_lead_payload(leadgen_id, meta_leads[leadgen_id])
+                if payload:
+                    phone_normalized = normalize_phone(payload.phone)
+                    records.setdefault(phone_normalized, _build_lead_record(payload, phone_normalized))
+
+            batch = list(records.values())
+            created = deduplicated = 0
+            for start in range(0, len(batch), BULK_INGEST_CHUNK_SIZE):
+                rows, duplicates = await _insert_lead_chunk(client, batch[start:start + BULK_INGEST_CHUNK_SIZE])
+                created += len(rows)
+                deduplicated += duplicates
+            logger.info("Meta leadgen: %d ids, %d created, %d deduplicated", len(leadgen_ids), created, deduplicated)
     except Exception as exc:
+        for leadgen_id in leadgen_ids:
+            _recent_leadgen_ids.discard(leadgen_id)
         logger.error("Meta lead ingest error: %s", exc)
 
 
@@ -13,6 +13,7 @@ WhatsApp rules:
 """
 from __future__ import annotations
 
+import asyncio
 import json
 import logging
 import os
@@ -25,6 +26,11 @@ import anthropic
 import httpx
 from fastapi import APIRouter, Form, Request, Response
 from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel
+
+from services.outbound_messaging import outbound_messenger
+
+from ..whatsapp_state import conversation_cache, conversation_writer
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/api/whatsapp", tags=["whatsapp"])
@@ -36,6 +42,9 @@ TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID", "")
 TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN", "")
 TWILIO_WHATSAPP_NUMBER = os.getenv("TWILIO_WHATSAPP_NUMBER", "whatsapp:+14155238886")
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY", "")
+ANTHROPIC_TIMEOUT_SECONDS = float(os.getenv("ANTHROPIC_TIMEOUT_SECONDS", "20"))
+ANTHROPIC_MAX_RETRIES = int(os.getenv("ANTHROPIC_MAX_RETRIES", "2"))
+ANTHROPIC_MAX_CONCURRENCY = int(os.getenv("ANTHROPIC_MAX_CONCURRENCY", "8"))
 # N8N_WEBHOOK_QUALIFIED = os.getenv("N8N_WEBHOOK_QUALIFIED_LEAD", "")  # DISCONNECTED: Ultra Automation handles this
 
 SUPABASE_HEADERS = {
@@ -122,8 +131,26 @@ def _next_stage(current: str, extracted_data: dict) -> str:
     return "complete"
 
 
+def _new_conversation(phone: str) -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "phone": phone,
+        "qualification_stage": "greeting",
+        "extracted_data": {},
+        "messages": [],
+        "window_expires_at": (datetime.now(timezone.utc) + timedelta(hours=24)).isoformat(),
+    }
+
+
 async def _get_or_create_conversation(phone: str) -> dict:
-    """Fetch existing WhatsApp conversation or create a new one."""
+    """Cached conversation for an active chat, else fetch it or start a new one.
+
+    New conversations are not inserted here; the write-behind queue upserts
+    them together with the first exchange.
+    """
+    cached = conversation_cache.get(phone)
+    if cached is not None:
+        return cached
     async with httpx.AsyncClient(timeout=10) as client:
         resp = await client.get(
             _supabase("whatsapp_conversations"),
@@ -131,48 +158,91 @@ async def _get_or_create_conversation(phone: str) -> dict:
             params={"phone": f"eq.{phone}", "limit": "1"},
         )
         existing = resp.json()
-        if existing and isinstance(existing, list) and len(existing) > 0:
-            return existing[0]
-        # Create new
-        new_conv = {
-            "id": str(uuid.uuid4()),
-            "phone": phone,
-            "qualification_stage": "greeting",
-            "extracted_data": {},
-            "messages": [],
-            "last_message_at": datetime.now(timezone.utc).isoformat(),
-            "window_expires_at": (datetime.now(timezone.utc) + timedelta(hours=24)).isoformat(),
-        }
-        create_resp = await client.post(
-            _supabase("whatsapp_conversations"),
-            headers=SUPABASE_HEADERS,
-            json=new_conv,
-        )
-        created = create_resp.json()
-        return created[0] if isinstance(created, list) else new_conv
+    if existing and isinstance(existing, list) and len(existing) > 0:
+        return existing[0]
+    return _new_conversation(phone)
 
 
-async def _update_conversation(conv_id: str, updates: dict) -> None:
+async def _update_conversation(phone: str, updates: dict) -> None:
     async with httpx.AsyncClient(timeout=10) as client:
         await client.patch(
-            _supabase(f"whatsapp_conversations?id=eq.{conv_id}"),
+            _supabase("whatsapp_conversations"),
             headers=SUPABASE_HEADERS,
+            params={"phone": f"eq.{phone}"},
             json=updates,
         )
 
 
+# ── Claude client ─────────────────────────────────────────────────────────────
+# One pooled async client per process; the semaphore caps in-flight calls so a
+# burst of inbound messages queues here instead of tripping Anthropic rate limits.
+_anthropic_client: anthropic.AsyncAnthropic | None = None
+_claude_semaphore: asyncio.Semaphore | None = None
+
+
+def get_anthropic_client() -> anthropic.AsyncAnthropic:
+    global _anthropic_client
+    if _anthropic_client is None:
+        _anthropic_client = anthropic.AsyncAnthropic(
+            api_key=ANTHROPIC_API_KEY,
+            timeout=ANTHROPIC_TIMEOUT_SECONDS,
+            max_retries=ANTHROPIC_MAX_RETRIES,
+        )
+    return _anthropic_client
+
+
+def _get_claude_semaphore() -> asyncio.Semaphore:
+    global _claude_semaphore
+    if _claude_semaphore is None:
+        _claude_semaphore = asyncio.Semaphore(ANTHROPIC_MAX_CONCURRENCY)
+    return _claude_semaphore
+
+
+@router.on_event("shutdown")
+async def flush_conversation_writes() -> None:
+    await conversation_writer.stop()
+
+
+@router.on_event("shutdown")
+async def close_anthropic_client() -> None:
+    global _anthropic_client
+    if _anthropic_client is not None:
+        await _anthropic_client.close()
+        _anthropic_client = None
+
+
+def _cached_messages(messages: list[dict]) -> list[dict]:
+    """
+    Copy of `messages` with a prompt-cache breakpoint on the newest turn.
+
+    SYSTEM_PROMPT alone is shorter than the model's minimum cacheable prefix
+    (1024 tokens), so a breakpoint on it would never be used. Marking the end
+    of the history instead caches system prompt + conversation so far; the
+    next message of the same chat reads that prefix from the cache once it
+    is long enough. Shorter chats are simply sent uncached.
+    """
+    if not messages:
+        return messages
+    *history, last = messages
+    content = last["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    content = [*content[:-1], {**content[-1], "cache_control": {"type": "ephemeral"}}]
+    return [*history, {**last, "content": content}]
+
+
 async def _call_claude(messages: list[dict], stage: str) -> str:
     """Call Claude claude-sonnet-4-6 with conversation history."""
     if not ANTHROPIC_API_KEY:
         return "Hi! I'm Priya from Tharaga. What's your budget for your Chennai home?"
-    client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
     try:
-        response = client.messages.create(
-            model="claude-sonnet-4-6",
-            max_tokens=300,
-            system=SYSTEM_PROMPT,
-            messages=messages,
-        )
+        async with _get_claude_semaphore():
+            response = await get_anthropic_client().messages.create(
+                model="claude-sonnet-4-6",
+                max_tokens=300,
+                system=SYSTEM_PROMPT,
+                messages=_cached_messages(messages),
+            )
         return response.content[0].text
     except Exception as exc:
         logger.error("Claude error: %s", exc)
@@ -264,7 +334,7 @@ async def _complete_qualification(conv: dict, phone: str) -> None:
             )
 
         # Mark conversation complete
-        await _update_conversation(conv["id"], {
+        await _update_conversation(conv["phone"], {
             "qualification_stage": "complete",
             "lead_id": lead_id,
             "is_active": False,
@@ -287,7 +357,9 @@ async def whatsapp_webhook(
 ) -> str:
     """
     Twilio TwiML webhook for incoming WhatsApp messages.
-    Returns TwiML XML with Priya's reply.
+    Returns TwiML XML with Priya's reply as soon as it is ready; the
+    conversation write and qualification completion are queued on
+    conversation_writer and persisted after the response.
     """
     phone = From.replace("whatsapp:", "").strip()
     user_message = Body.strip()
@@ -304,7 +376,7 @@ async def whatsapp_webhook(
             exp_dt = datetime.fromisoformat(window_exp.replace("Z", "+00:00"))
             if datetime.now(timezone.utc) > exp_dt:
                 # Window expired — reset
-                conv = await _get_or_create_conversation(phone + "_new_" + str(uuid.uuid4())[:8])
+                conv = _new_conversation(phone + "_new_" + str(uuid.uuid4())[:8])
                 messages = []
                 extracted_data = {}
         except Exception:
@@ -318,10 +390,10 @@ async def whatsapp_webhook(
 
     # Extract structured data from AI response
     extracted = _extract_json_block(ai_response)
+    completed = False
     if extracted:
         if extracted.get("stage") == "complete":
-            conv["extracted_data"] = extracted_data
-            await _complete_qualification(conv, phone)
+            completed = True
         elif "field" in extracted and "value" in extracted:
             field = extracted["field"]
             extracted_data[field] = extracted["value"]
@@ -337,14 +409,20 @@ async def whatsapp_webhook(
     # Add AI message to history
     messages.append({"role": "assistant", "content": ai_response})
 
-    # Update conversation state
-    await _update_conversation(conv["id"], {
+    # Update conversation state (cached now, persisted by the write-behind queue)
+    base_message_at = conv.get("last_message_at")  # None until the row is stored
+    conv.update({
         "messages": messages[-40:],  # keep last 40 messages
         "extracted_data": extracted_data,
         "qualification_stage": next_stage,
         "last_message_at": datetime.now(timezone.utc).isoformat(),
         "window_expires_at": (datetime.now(timezone.utc) + timedelta(hours=24)).isoformat(),
     })
+    conversation_cache.put(phone, conv)
+    conversation_writer.save(conv, base_message_at)
+    if completed:
+        snapshot = {"phone": conv["phone"], "extracted_data": dict(extracted_data)}
+        conversation_writer.submit(lambda: _complete_qualification(snapshot, phone), conv["phone"])
 
     # Return TwiML
     twiml = f"""<?xml version="1.0" encoding="UTF-8"?>
@@ -364,9 +442,6 @@ class OutboundMessagePayload(BaseModel):
         extra = "allow"
 
 
-from pydantic import BaseModel
-
-
 TEMPLATES = {
     "welcome": "Namaste {name}! 🙏 I'm Priya from Tharaga. You've expressed interest in Chennai properties. I'd love to help you find your dream home. What's your budget range? (e.g., 60-80 lakhs)",
     "lion_alert": "🎯 Great news, {name}! We have found {count} exclusive properties matching your profile in {location}. Our senior advisor will call you within 15 minutes. Please keep your phone available.",
@@ -396,19 +471,23 @@ async def send_whatsapp(payload: OutboundMessagePayload) -> dict:
     if not phone.startswith("+"):
         phone = f"+{phone}"
 
-    async with httpx.AsyncClient(
-        auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN), timeout=15
-    ) as client:
-        resp = await client.post(
-            f"https://api.twilio.com/2010-04-01/Accounts/{TWILIO_ACCOUNT_SID}/Messages.json",
-            data={
-                "From": TWILIO_WHATSAPP_NUMBER,
-                "To": f"whatsapp:{phone}",
-                "Body": message_body,
-            },
-        )
-        if resp.status_code in (200, 201):
-            return {"status": "sent", "sid": resp.json().get("sid")}
-        else:
-            logger.error("Twilio send failed: %s", resp.text)
-            return {"status": "error", "detail": resp.text}
+    async def post() -> httpx.Response:
+        async with httpx.AsyncClient(
+            auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN), timeout=15
+        ) as client:
+            return await client.post(
+                f"https://api.twilio.com/2010-04-01/Accounts/{TWILIO_ACCOUNT_SID}/Messages.json",
+                data={
+                    "From": TWILIO_WHATSAPP_NUMBER,
+                    "To": f"whatsapp:{phone}",
+                    "Body": message_body,
+                },
+            )
+
+    # Shared per-sender rate limit; 429/5xx are retried with backoff
+    resp = await outbound_messenger.send("twilio_whatsapp", TWILIO_WHATSAPP_NUMBER, post)
+    if resp.status_code in (200, 201):
+        return {"status": "sent", "sid": resp.json().get("sid")}
+    else:
+        logger.error("Twilio send failed: %s", resp.text)
+        return {"status": "error", "detail": resp.text}
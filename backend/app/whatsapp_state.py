@@ -0,0 +1,277 @@
+"""
+WhatsApp Conversation State
+TTL cache of active conversations keyed by phone, and a write-behind queue
+that persists them (plus qualification follow-ups) after Twilio has its reply
+"""
+import asyncio
+import copy
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+SUPABASE_URL = os.getenv("SUPABASE_URL", "")
+SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY", "")
+
+WHATSAPP_CONV_CACHE_TTL_SECONDS = float(os.getenv("WHATSAPP_CONV_CACHE_TTL_SECONDS", "120"))
+WHATSAPP_CONV_CACHE_MAX_ENTRIES = int(os.getenv("WHATSAPP_CONV_CACHE_MAX_ENTRIES", "10000"))
+WHATSAPP_WRITE_FLUSH_SECONDS = float(os.getenv("WHATSAPP_WRITE_FLUSH_SECONDS", "0.5"))
+WHATSAPP_WRITE_MAX_ROWS = int(os.getenv("WHATSAPP_WRITE_MAX_ROWS", "200"))
+WHATSAPP_JOB_MAX_ATTEMPTS = int(os.getenv("WHATSAPP_JOB_MAX_ATTEMPTS", "3"))
+
+SUPABASE_HEADERS = {
+    "apikey": SUPABASE_SERVICE_ROLE_KEY,
+    "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}",
+    "Content-Type": "application/json",
+}
+
+# Columns the webhook owns; lead_id / is_active are set by qualification jobs
+PERSISTED_FIELDS = (
+    "id",
+    "phone",
+    "qualification_stage",
+    "extracted_data",
+    "messages",
+    "last_message_at",
+    "window_expires_at",
+)
+
+Job = Callable[[], Awaitable[Any]]
+
+
+def _supabase_rest(path: str) -> str:
+    return f"{SUPABASE_URL}/rest/v1/{path}"
+
+
+# =============================================
+# CACHE
+# =============================================
+class ConversationCache:
+    """
+    Bounded TTL map of phone -> conversation row.
+
+    Active chats are answered from here without the conversation GET. Each
+    put restarts the entry's TTL; the oldest entries go first when full.
+    Entries are only as fresh as this process's own writes; the writer
+    drops an entry when the stored row turned out to have moved on.
+    """
+
+    def __init__(self, ttl_seconds: float = WHATSAPP_CONV_CACHE_TTL_SECONDS,
+                 max_entries: int = WHATSAPP_CONV_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, phone: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(phone)
+        if entry is None or entry[0] < time.monotonic():
+            self._entries.pop(phone, None)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def put(self, phone: str, conv: Dict[str, Any]):
+        self._entries.pop(phone, None)
+        self._entries[phone] = (time.monotonic() + self.ttl_seconds, conv)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def discard(self, phone: str):
+        self._entries.pop(phone, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# =============================================
+# WRITE-BEHIND QUEUE
+# =============================================
+class ConversationWriter:
+    """
+    Persists conversation state after the webhook has responded.
+
+    save() snapshots a conversation and marks it dirty; repeated saves of
+    the same phone before a flush collapse into one row. Each flush writes
+    the dirty rows with one write_whatsapp_conversations call
+    (sql/whatsapp_conversation_writes.sql), which skips rows whose stored
+    copy changed since it was read; those phones go to `on_stale` so the
+    cache re-reads them. A batch the database rejects is split until only
+    the offending rows are dropped. Queued jobs (qualification completion)
+    run as soon as their own phone's row is written; failed jobs are
+    retried up to WHATSAPP_JOB_MAX_ATTEMPTS times.
+    """
+
+    def __init__(
+        self,
+        client: Optional[httpx.AsyncClient] = None,
+        on_stale: Optional[Callable[[str], Any]] = None,
+        flush_interval: float = WHATSAPP_WRITE_FLUSH_SECONDS,
+        max_rows: int = WHATSAPP_WRITE_MAX_ROWS,
+        max_job_attempts: int = WHATSAPP_JOB_MAX_ATTEMPTS,
+    ):
+        self._client = client
+        self._on_stale = on_stale
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self.max_job_attempts = max_job_attempts
+        self._dirty: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._jobs: List[Tuple[Job, str, int]] = []
+
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+        self.written = 0
+        self.stale = 0
+        self.dropped = 0
+        self.failed_jobs = 0
+
+    def save(self, conv: Dict[str, Any], base_message_at: Optional[str] = None):
+        """
+        Queue the conversation's current state for persistence.
+
+        `base_message_at` is the stored last_message_at this state was built
+        on (None for a conversation that is not in the table yet).
+        """
+        row = {field: copy.deepcopy(conv.get(field)) for field in PERSISTED_FIELDS}
+        pending = self._dirty.pop(row["phone"], None)
+        # Coalesced rows still need the version the first of them was read at
+        row["base_message_at"] = pending["base_message_at"] if pending else base_message_at
+        self._dirty[row["phone"]] = row
+        self._wake()
+
+    def submit(self, job: Job, phone: str):
+        """Run `job()` once the queued state of `phone` is written"""
+        self._jobs.append((job, phone, 0))
+        self._wake()
+
+    def pending(self) -> int:
+        return len(self._dirty) + len(self._jobs)
+
+    # =============================================
+    # LIFECYCLE
+    # =============================================
+
+    def start(self):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._task is None or self._task.done():
+            self._stopping = False
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    def _wake(self):
+        self.start()
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def stop(self):
+        """Stop the loop after writing whatever is still queued"""
+        if self._task:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        if self._dirty or self._jobs:
+            try:
+                await self.flush()
+                while self._dirty:
+                    await self.flush()
+            except Exception as e:
+                logger.error(f"WhatsApp conversation flush on shutdown failed: {str(e)}")
+
+    async def _run(self):
+        while not self._stopping:
+            self._wakeup.clear()
+            await self._wakeup.wait()
+            # Let a burst of saves for the same chats coalesce
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                while self._dirty:
+                    await self.flush()
+            except Exception as e:
+                logger.error(f"WhatsApp conversation flush failed: {str(e)}")
+            if self._dirty or self._jobs:
+                self._wakeup.set()  # retry after another interval
+
+    # =============================================
+    # FLUSH
+    # =============================================
+
+    async def flush(self) -> int:
+        """Write one batch of dirty conversations, then run the jobs that were waiting on them"""
+        if self._client is not None:
+            return await self._flush(self._client)
+        async with httpx.AsyncClient(timeout=10) as client:
+            return await self._flush(client)
+
+    async def _flush(self, client: httpx.AsyncClient) -> int:
+        phones = list(self._dirty)[:self.max_rows]
+        rows = [self._dirty.pop(phone) for phone in phones]
+        if rows:
+            try:
+                stale = await self._write(client, rows)
+            except Exception:
+                for row in rows:
+                    newer = self._dirty.get(row["phone"])
+                    if newer is None:
+                        self._dirty[row["phone"]] = row
+                    else:
+                        # The chat moved on meanwhile; keep the newer state, on the old version
+                        newer["base_message_at"] = row["base_message_at"]
+                raise
+            self.written += len(rows) - len(stale)
+            for phone in stale:
+                self.stale += 1
+                if self._on_stale:
+                    self._on_stale(phone)
+
+        ready = [entry for entry in self._jobs if entry[1] not in self._dirty]
+        if not ready:
+            return len(rows)
+        self._jobs = [entry for entry in self._jobs if entry[1] in self._dirty]
+        outcomes = await asyncio.gather(*(job() for job, _, _ in ready), return_exceptions=True)
+        for (job, phone, attempts), outcome in zip(ready, outcomes):
+            if not isinstance(outcome, Exception):
+                continue
+            if attempts + 1 < self.max_job_attempts:
+                self._jobs.append((job, phone, attempts + 1))
+            else:
+                self.failed_jobs += 1
+                logger.error(f"WhatsApp job for {phone} failed after {attempts + 1} attempts: {outcome}")
+        return len(rows)
+
+    async def _write(self, client: httpx.AsyncClient, rows: List[Dict[str, Any]]) -> List[str]:
+        """Write rows; returns the phones that were not written (stale or rejected)"""
+        resp = await client.post(
+            _supabase_rest("rpc/write_whatsapp_conversations"),
+            headers=SUPABASE_HEADERS,
+            json={"p_rows": rows},
+        )
+        if 400 <= resp.status_code < 500:
+            if len(rows) == 1:
+                self.dropped += 1
+                logger.error(f"Dropped WhatsApp conversation write for {rows[0]['phone']}: {resp.text}")
+                return [rows[0]["phone"]]
+            # Find the offending rows instead of losing every chat in the batch
+            mid = len(rows) // 2
+            return await self._write(client, rows[:mid]) + await self._write(client, rows[mid:])
+        resp.raise_for_status()
+        return resp.json() or []
+
+
+# =============================================
+# INITIALIZE
+# =============================================
+conversation_cache = ConversationCache()
+conversation_writer = ConversationWriter(on_stale=conversation_cache.discard)
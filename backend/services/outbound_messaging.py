@@ -0,0 +1,302 @@
+# =============================================
+# OUTBOUND MESSAGING
+# Shared send queue for WhatsApp / SMS / email providers:
+# per-sender token buckets, bounded concurrency and
+# jittered retries on 429 / 5xx
+# =============================================
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import asyncio
+import logging
+import os
+import random
+import time
+
+import httpx
+from prometheus_client import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+# =============================================
+# CONFIGURATION
+# =============================================
+# Sustained messages/second per sender; bursts may use up to `burst` at once
+PROVIDER_RATE_LIMITS: Dict[str, Tuple[float, int]] = {
+    "twilio_whatsapp": (float(os.getenv("TWILIO_WHATSAPP_RATE_PER_SECOND", "10")), int(os.getenv("TWILIO_WHATSAPP_BURST", "10"))),
+    "twilio_sms": (float(os.getenv("TWILIO_SMS_RATE_PER_SECOND", "1")), int(os.getenv("TWILIO_SMS_BURST", "1"))),
+    "resend": (float(os.getenv("RESEND_RATE_PER_SECOND", "2")), int(os.getenv("RESEND_BURST", "2"))),
+}
+DEFAULT_RATE_LIMIT = (5.0, 5)
+
+OUTBOUND_MAX_CONCURRENCY = int(os.getenv("OUTBOUND_MAX_CONCURRENCY", "20"))
+OUTBOUND_MAX_ATTEMPTS = int(os.getenv("OUTBOUND_MAX_ATTEMPTS", "4"))
+OUTBOUND_BACKOFF_BASE_SECONDS = float(os.getenv("OUTBOUND_BACKOFF_BASE_SECONDS", "0.5"))
+OUTBOUND_BACKOFF_MAX_SECONDS = float(os.getenv("OUTBOUND_BACKOFF_MAX_SECONDS", "30"))
+
+# =============================================
+# METRICS
+# =============================================
+OUTBOUND_MESSAGES = Counter(
+    "outbound_messages_total", "Outbound message attempts", ["provider", "outcome"]
+)
+OUTBOUND_LATENCY = Histogram(
+    "outbound_message_latency_seconds", "Time from enqueue to final outcome", ["provider"]
+)
+OUTBOUND_QUEUE_DEPTH = Gauge(
+    "outbound_queue_depth", "Messages waiting for a send slot"
+)
+
+
+# =============================================
+# TOKEN BUCKET
+# =============================================
+class TokenBucket:
+    """
+    Async token bucket.
+
+    reserve() takes the next token without waiting and returns how long
+    the caller must hold off before using it (tokens may go negative, so
+    each reservation gets its own slot); acquire() waits for that slot.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        wait = max(self.paused_until - now, 0.0)
+        if self.tokens < 0:
+            wait += -self.tokens / self.rate
+        return wait
+
+    async def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens, e.g. after the provider answered 429"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        # No refill while paused; outstanding reservations stay owed
+        self.tokens = min(self.tokens, 0.0)
+        self.updated = self.paused_until
+
+
+# =============================================
+# RETRY CLASSIFICATION
+# =============================================
+def _status_of(outcome: Any) -> Optional[int]:
+    if isinstance(outcome, httpx.Response):
+        return outcome.status_code
+    # TwilioRestException exposes .status, resend/httpx errors .status_code
+    status = getattr(outcome, "status", None)
+    if not isinstance(status, int):
+        status = getattr(outcome, "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def _retry_after(outcome: Any) -> Optional[float]:
+    """Seconds from a Retry-After header, when the provider sent one"""
+    response = outcome if isinstance(outcome, httpx.Response) else getattr(outcome, "response", None)
+    headers = getattr(response, "headers", None)
+    value = headers.get("retry-after") if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        try:
+            return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+
+def is_retryable(outcome: Any) -> bool:
+    """429s, 5xx responses and transport errors are retried"""
+    if isinstance(outcome, httpx.TransportError):
+        return True
+    status = _status_of(outcome)
+    return status is not None and (status == 429 or status >= 500)
+
+
+def backoff_delay(attempt: int, base: float = OUTBOUND_BACKOFF_BASE_SECONDS, cap: float = OUTBOUND_BACKOFF_MAX_SECONDS) -> float:
+    """Exponential backoff with full jitter around the nominal delay"""
+    return min(cap, base * (2 ** (attempt - 1))) * random.uniform(0.5, 1.5)
+
+
+# =============================================
+# SEND QUEUE
+# =============================================
+class _SendJob:
+    __slots__ = ("provider", "sender", "send_fn", "future", "enqueued_at", "attempts", "has_token")
+
+    def __init__(self, provider: str, sender: str, send_fn: Callable[[], Awaitable[Any]], future: asyncio.Future):
+        self.provider = provider
+        self.sender = sender
+        self.send_fn = send_fn
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+        self.has_token = False
+
+
+class OutboundMessenger:
+    """
+    Single funnel for provider sends.
+
+    send() enqueues a zero-argument coroutine factory that performs one
+    provider call and resolves with its result. A fixed pool of workers
+    drains the queue; each call first takes a token from the bucket of its
+    (provider, sender) pair. A job whose token is not due yet is parked
+    until it is rather than holding a worker, so one throttled sender never
+    stalls the others. Retryable outcomes are re-queued after a
+    jittered backoff (or the provider's Retry-After) instead of being
+    reported as failures; after max_attempts the last response is returned
+    or the last exception raised, so callers keep their own error handling.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = OUTBOUND_MAX_CONCURRENCY,
+        max_attempts: int = OUTBOUND_MAX_ATTEMPTS,
+        rate_limits: Optional[Dict[str, Tuple[float, int]]] = None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.rate_limits = rate_limits if rate_limits is not None else PROVIDER_RATE_LIMITS
+        self._buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: list = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._in_flight = 0
+        self._waiting_retry = 0
+
+    def _bucket(self, provider: str, sender: str) -> TokenBucket:
+        key = (provider, sender)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(*self.rate_limits.get(provider, DEFAULT_RATE_LIMIT))
+            self._buckets[key] = bucket
+        return bucket
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        # First use, or a new event loop (tests, reloads): rebuild the pool
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        self._buckets = {}
+        self._workers = [loop.create_task(self._worker()) for _ in range(self.max_concurrency)]
+
+    async def send(self, provider: str, sender: str, send_fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Queue one provider call and wait for its final outcome"""
+        self._ensure_started()
+        job = _SendJob(provider, sender or "default", send_fn, self._loop.create_future())
+        self._queue.put_nowait(job)
+        OUTBOUND_QUEUE_DEPTH.set(self._queue.qsize())
+        return await job.future
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "in_flight": self._in_flight,
+            "waiting_retry": self._waiting_retry,
+            "workers": len(self._workers),
+        }
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            OUTBOUND_QUEUE_DEPTH.set(self._queue.qsize())
+            try:
+                await self._process(job)
+            except Exception as e:
+                # A worker must outlive any single job
+                logger.error(f"{job.provider} send job failed unexpectedly: {str(e)}")
+                if not job.future.done():
+                    job.future.set_exception(e)
+
+    async def _process(self, job: _SendJob):
+        if job.future.done():
+            return  # caller gave up (timeout, disconnect)
+        if not job.has_token:
+            job.has_token = True
+            wait = self._bucket(job.provider, job.sender).reserve()
+            if wait > 0:
+                self._loop.call_later(wait, self._requeue, job)
+                return
+
+        job.has_token = False
+        job.attempts += 1
+        self._in_flight += 1
+        try:
+            outcome = await job.send_fn()
+            failed = False
+        except Exception as e:
+            outcome = e
+            failed = True
+        finally:
+            self._in_flight -= 1
+
+        if is_retryable(outcome) and job.attempts < self.max_attempts:
+            self._schedule_retry(job, outcome)
+            return
+
+        status = _status_of(outcome)
+        if failed or (status is not None and status >= 400):
+            OUTBOUND_MESSAGES.labels(job.provider, "failed").inc()
+        else:
+            OUTBOUND_MESSAGES.labels(job.provider, "sent").inc()
+        OUTBOUND_LATENCY.labels(job.provider).observe(time.monotonic() - job.enqueued_at)
+
+        if job.future.done():
+            return
+        if failed:
+            job.future.set_exception(outcome)
+        else:
+            job.future.set_result(outcome)
+
+    def _requeue(self, job: _SendJob):
+        self._queue.put_nowait(job)
+        OUTBOUND_QUEUE_DEPTH.set(self._queue.qsize())
+
+    def _schedule_retry(self, job: _SendJob, outcome: Any):
+        OUTBOUND_MESSAGES.labels(job.provider, "retried").inc()
+        delay = backoff_delay(job.attempts)
+        hinted = _retry_after(outcome)
+        if hinted is not None:
+            delay = max(delay, hinted)
+        if _status_of(outcome) == 429:
+            # The whole sender is over its limit, not just this message
+            self._bucket(job.provider, job.sender).pause(delay)
+        logger.warning(
+            f"{job.provider} send attempt {job.attempts} hit {_status_of(outcome) or type(outcome).__name__}; "
+            f"retrying in {delay:.1f}s"
+        )
+
+        self._waiting_retry += 1
+
+        def requeue():
+            self._waiting_retry -= 1
+            self._requeue(job)
+
+        self._loop.call_later(delay, requeue)
+
+
+# =============================================
+# INITIALIZE MESSENGER
+# =============================================
+outbound_messenger = OutboundMessenger()
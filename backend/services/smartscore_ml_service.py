@@ -16,6 +16,7 @@ from sklearn.ensemble import RandomForestClassifier, GradientBoostingRegressor
 from sklearn.linear_model import LogisticRegression
 from sklearn.preprocessing import StandardScaler
 from sklearn.model_selection import train_test_split
+from services.tree_compiler import compile_model
 try:
     import tensorflow as tf
     from tensorflow import keras
@@ -319,6 +320,9 @@ class ModelManager:
         self.churn_risk_model = None
         self.scaler = None
         self.feature_names = []
+        # Flat-array versions of the tree ensembles for single-row scoring
+        self.compiled_lead_quality_model = None
+        self.compiled_ltv_model = None
         self.load_models()
     
     def load_models(self):
@@ -345,10 +349,19 @@ class ModelManager:
                 logger.info("Loaded feature scaler")
             else:
                 logger.warning("No models found - training required")
+            
+            self.compile_models()
                 
         except Exception as e:
             logger.error(f"Model loading failed: {str(e)}")
     
+    def compile_models(self):
+        """Flatten tree ensembles so predictions skip sklearn's per-call overhead"""
+        self.compiled_lead_quality_model = compile_model(self.lead_quality_model)
+        self.compiled_ltv_model = compile_model(self.ltv_model)
+        if self.compiled_lead_quality_model or self.compiled_ltv_model:
+            logger.info("Compiled tree ensembles for fast inference")
+    
     async def predict_smartscore(
         self, 
         lead_id: int, 
@@ -370,7 +383,10 @@ class ModelManager:
             # === PREDICTIONS ===
             
             # 1. Lead Quality Score (0-100)
-            if self.lead_quality_model:
+            if self.compiled_lead_quality_model:
+                quality_proba = self.compiled_lead_quality_model.predict_proba(features_scaled)[0]
+                smartscore = float(np.dot(quality_proba, [20, 40, 60, 80, 100]))
+            elif self.lead_quality_model:
                 quality_proba = self.lead_quality_model.predict_proba(features_scaled)[0]
                 smartscore = float(np.dot(quality_proba, [20, 40, 60, 80, 100]))
             else:
@@ -383,7 +399,9 @@ class ModelManager:
                 conversion_prob = smartscore / 100.0
             
             # 3. Predicted LTV
-            if self.ltv_model:
+            if self.compiled_ltv_model:
+                predicted_ltv = float(self.compiled_ltv_model.predict(features_scaled)[0])
+            elif self.ltv_model:
                 predicted_ltv = float(self.ltv_model.predict(features_scaled)[0])
             else:
                 predicted_ltv = features.get('budget', 0) * conversion_prob * 0.02
@@ -630,6 +648,8 @@ class ModelManager:
             ltv_score = self.ltv_model.score(X_test_scaled, y_ltv.loc[X_test.index])
             logger.info(f"LTV Model - R²: {ltv_score:.3f}")
             
+            self.compile_models()
+            
             # 4. Churn Risk Neural Network (if TF available)
             if TF_AVAILABLE:
                 self.churn_risk_model = keras.Sequential([
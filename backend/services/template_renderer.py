@@ -0,0 +1,232 @@
+# =============================================
+# MESSAGE TEMPLATE RENDERER
+# Templates are compiled once into literal segments + placeholder
+# slots and cached per message_templates row (id + updated_at)
+# =============================================
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from functools import lru_cache
+import logging
+import os
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+PLACEHOLDER_PATTERN = re.compile(r"\{\{(\w+)\}\}")
+
+# How long a cached row is trusted before its updated_at is re-checked
+TEMPLATE_CACHE_TTL_SECONDS = float(os.getenv("TEMPLATE_CACHE_TTL_SECONDS", "60"))
+TEMPLATE_CACHE_MAX_ENTRIES = int(os.getenv("TEMPLATE_CACHE_MAX_ENTRIES", "1000"))
+
+
+# =============================================
+# TEMPLATE VARIABLES
+# =============================================
+class LeadContext:
+    """The related rows a lead's variables are read from, resolved once per render"""
+
+    __slots__ = ("lead", "property", "profile", "builder")
+
+    def __init__(self, lead_data: Dict):
+        self.lead = lead_data
+        self.property = lead_data.get('properties') or {}
+        self.profile = lead_data.get('profiles') or {}
+        builders = self.property.get('builders')
+        self.builder = builders if isinstance(builders, dict) else {}
+
+
+def _lead_name(ctx: LeadContext) -> str:
+    return ctx.lead.get('name') or ctx.profile.get('full_name', 'there')
+
+
+def _first_name(ctx: LeadContext) -> str:
+    lead_name = _lead_name(ctx)
+    return lead_name.split()[0] if lead_name else 'there'
+
+
+def _property_price(ctx: LeadContext) -> str:
+    return f"₹{ctx.property.get('price_inr', ctx.property.get('price', 0)):,.0f}"
+
+
+TEMPLATE_VARIABLES: Dict[str, Callable[[LeadContext], Any]] = {
+    'lead_name': _lead_name,
+    'first_name': _first_name,
+    'property_title': lambda ctx: ctx.property.get('title', 'the property'),
+    'property_type': lambda ctx: ctx.property.get('property_type', 'property'),
+    'property_price': _property_price,
+    'builder_name': lambda ctx: ctx.builder.get('name') or ctx.builder.get('company_name', 'Builder'),
+    'smartscore': lambda ctx: ctx.lead.get('smartscore_v2', ctx.lead.get('score', 0)),
+    'priority_tier': lambda ctx: ctx.lead.get('priority_tier', 'Developing'),
+    'next_action': lambda ctx: ctx.lead.get('next_best_action', 'Contact us'),
+    'location': lambda ctx: ctx.property.get('locality') or ctx.property.get('city', 'the area'),
+    'bedrooms': lambda ctx: ctx.property.get('bedrooms', 'N/A'),
+    'area_sqft': lambda ctx: ctx.property.get('sqft') or ctx.property.get('area_sqft', 'N/A'),
+}
+
+
+# =============================================
+# COMPILED TEMPLATES
+# =============================================
+class CompiledTemplate:
+    """
+    A template split into literal segments and variable slots.
+
+    Rendering evaluates only the variables the template uses and joins the
+    parts once. Unknown placeholders are kept verbatim.
+    """
+
+    __slots__ = ("source", "_parts", "_slots")
+
+    def __init__(self, source: str):
+        self.source = source or ""
+        parts: List[str] = []
+        slots: List[Tuple[int, Callable[[LeadContext], Any]]] = []
+
+        position = 0
+        for match in PLACEHOLDER_PATTERN.finditer(self.source):
+            resolver = TEMPLATE_VARIABLES.get(match.group(1))
+            if resolver is None:
+                continue
+            parts.append(self.source[position:match.start()])
+            slots.append((len(parts), resolver))
+            parts.append("")
+            position = match.end()
+        parts.append(self.source[position:])
+
+        self._parts = parts
+        self._slots = slots
+
+    @property
+    def variables(self) -> List[str]:
+        return [m.group(1) for m in PLACEHOLDER_PATTERN.finditer(self.source) if m.group(1) in TEMPLATE_VARIABLES]
+
+    def render(self, lead_data: Dict) -> str:
+        if not self._slots:
+            return self._parts[0]
+        ctx = LeadContext(lead_data)
+        parts = self._parts.copy()
+        for index, resolver in self._slots:
+            parts[index] = str(resolver(ctx))
+        return "".join(parts)
+
+    def render_many(self, leads: List[Dict]) -> List[str]:
+        """Personalise this template for many leads (e.g. a campaign run)"""
+        if not self._slots:
+            return [self._parts[0]] * len(leads)
+        base = self._parts
+        slots = self._slots
+        rendered = []
+        for lead_data in leads:
+            ctx = LeadContext(lead_data)
+            parts = base.copy()
+            for index, resolver in slots:
+                parts[index] = str(resolver(ctx))
+            rendered.append("".join(parts))
+        return rendered
+
+
+@lru_cache(maxsize=1024)
+def compile_template(source: str) -> CompiledTemplate:
+    """Compile (and memoise) an ad-hoc template string"""
+    return CompiledTemplate(source)
+
+
+def render_template(source: str, lead_data: Dict) -> str:
+    if not source:
+        return ""
+    return compile_template(source).render(lead_data)
+
+
+# =============================================
+# MESSAGE TEMPLATE CACHE
+# =============================================
+class MessageTemplate:
+    """A message_templates row with its body and subject compiled"""
+
+    __slots__ = ("row", "updated_at", "body", "subject", "checked_at")
+
+    def __init__(self, row: Dict):
+        self.row = row
+        self.updated_at = row.get('updated_at')
+        self.body = CompiledTemplate(row.get('body_template') or row.get('body', ''))
+        self.subject = CompiledTemplate(row.get('subject') or 'Property Inquiry Follow-up')
+        self.checked_at = time.monotonic()
+
+
+class MessageTemplateCache:
+    """
+    In-process cache of compiled message_templates rows.
+
+    Entries are keyed by template id and tagged with the row's updated_at.
+    Within the TTL a hit costs nothing; after it only `updated_at` is read
+    back, and the row is recompiled only if it actually changed.
+    """
+
+    def __init__(
+        self,
+        get_client: Callable[[], Any],
+        ttl_seconds: float = TEMPLATE_CACHE_TTL_SECONDS,
+        max_entries: int = TEMPLATE_CACHE_MAX_ENTRIES,
+    ):
+        self._get_client = get_client
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: Dict[str, MessageTemplate] = {}
+
+    def get(self, template_id: str) -> Optional[MessageTemplate]:
+        return self.get_many([template_id]).get(template_id)
+
+    def get_many(self, template_ids: List[str]) -> Dict[str, MessageTemplate]:
+        """Resolve several templates with at most two queries"""
+        now = time.monotonic()
+        found: Dict[str, MessageTemplate] = {}
+        stale: List[str] = []
+        missing: List[str] = []
+
+        for template_id in dict.fromkeys(t for t in template_ids if t):
+            entry = self._entries.get(template_id)
+            if entry is None:
+                missing.append(template_id)
+            elif now - entry.checked_at < self.ttl_seconds:
+                found[template_id] = entry
+            else:
+                stale.append(template_id)
+
+        if stale:
+            versions = self._get_client().table('message_templates').select(
+                'id, updated_at'
+            ).in_('id', stale).execute()
+            current = {row['id']: row.get('updated_at') for row in (versions.data or [])}
+            for template_id in stale:
+                entry = self._entries[template_id]
+                if template_id not in current:
+                    del self._entries[template_id]
+                elif current[template_id] == entry.updated_at:
+                    entry.checked_at = now
+                    found[template_id] = entry
+                else:
+                    missing.append(template_id)
+
+        if missing:
+            rows = self._get_client().table('message_templates').select(
+                '*'
+            ).in_('id', missing).execute()
+            for row in rows.data or []:
+                found[row['id']] = self._store(row)
+
+        return found
+
+    def _store(self, row: Dict) -> MessageTemplate:
+        if len(self._entries) >= self.max_entries:
+            # Drop the least recently validated entry
+            oldest = min(self._entries, key=lambda k: self._entries[k].checked_at)
+            del self._entries[oldest]
+        entry = MessageTemplate(row)
+        self._entries[row['id']] = entry
+        return entry
+
+    def invalidate(self, template_id: Optional[str] = None):
+        if template_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(template_id, None)
@@ -0,0 +1,273 @@
+# =============================================
+# WEBHOOK INBOX
+# Fast-ack buffer for inbound provider webhooks:
+# raw bodies are acknowledged immediately, deduplicated by
+# idempotency key, bulk-stored and dispatched in the background
+# =============================================
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from collections import OrderedDict
+from datetime import datetime
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+INBOX_FLUSH_INTERVAL_SECONDS = float(os.getenv("WEBHOOK_INBOX_FLUSH_INTERVAL_SECONDS", "0.5"))
+INBOX_FLUSH_MAX_ROWS = int(os.getenv("WEBHOOK_INBOX_FLUSH_MAX_ROWS", "500"))
+# Beyond this many unflushed receipts new webhooks get 503 so providers retry later
+INBOX_MAX_BUFFERED = int(os.getenv("WEBHOOK_INBOX_MAX_BUFFERED", "10000"))
+INBOX_DEDUP_TTL_SECONDS = float(os.getenv("WEBHOOK_INBOX_DEDUP_TTL_SECONDS", "86400"))
+INBOX_DEDUP_MAX_KEYS = int(os.getenv("WEBHOOK_INBOX_DEDUP_MAX_KEYS", "100000"))
+
+# Provider headers that already carry a unique delivery id
+IDEMPOTENCY_HEADERS = (
+    "idempotency-key",
+    "x-idempotency-key",
+    "i-twilio-idempotency-token",
+    "svix-id",
+    "x-razorpay-event-id",
+    "x-github-delivery",
+)
+
+InboundHandler = Callable[[Dict[str, Any]], Awaitable[Any]]
+
+
+def provider_secret(provider: str) -> Optional[str]:
+    """Shared secret for a provider (WEBHOOK_SECRET_<PROVIDER>), if configured"""
+    return os.getenv(f"WEBHOOK_SECRET_{provider.upper().replace('-', '_')}")
+
+
+def verify_signature(body: bytes, signature: Optional[str], secret: str) -> bool:
+    """HMAC-SHA256 over the raw body (hex, optionally 'sha256=' prefixed)"""
+    if not signature:
+        return False
+    if signature.startswith("sha256="):
+        signature = signature[len("sha256="):]
+    expected = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+def idempotency_key(provider: str, headers: Any, body: bytes) -> str:
+    """Provider delivery id when present, otherwise a hash of the raw body"""
+    for header in IDEMPOTENCY_HEADERS:
+        value = headers.get(header)
+        if value:
+            return f"{header}:{value}"
+    return "sha256:" + hashlib.sha256(provider.encode() + b"\0" + body).hexdigest()
+
+
+class RecentKeys:
+    """Bounded TTL set of recently seen idempotency keys"""
+
+    def __init__(self, ttl_seconds: float = INBOX_DEDUP_TTL_SECONDS, max_keys: int = INBOX_DEDUP_MAX_KEYS):
+        self.ttl_seconds = ttl_seconds
+        self.max_keys = max_keys
+        self._seen: "OrderedDict[str, float]" = OrderedDict()
+
+    def add(self, key: str) -> bool:
+        """Record a key; False if it was already seen within the TTL"""
+        now = time.monotonic()
+        while self._seen:
+            oldest, seen_at = next(iter(self._seen.items()))
+            if now - seen_at <= self.ttl_seconds and len(self._seen) < self.max_keys:
+                break
+            self._seen.popitem(last=False)
+        if key in self._seen:
+            return False
+        self._seen[key] = now
+        return True
+
+    def discard(self, key: str):
+        self._seen.pop(key, None)
+
+
+class WebhookInbox:
+    """
+    In-process buffer between the receive endpoint and storage.
+
+    accept() only checks the idempotency key and appends the raw bytes, so
+    the provider gets its 2xx without waiting on Supabase. A background
+    loop parses each body once, bulk-inserts the batch into
+    webhook_receipts (ignoring duplicates on provider + idempotency_key)
+    and then runs the handlers registered for each provider.
+    """
+
+    def __init__(
+        self,
+        get_client: Optional[Callable[[], Any]] = None,
+        flush_interval: float = INBOX_FLUSH_INTERVAL_SECONDS,
+        max_rows: int = INBOX_FLUSH_MAX_ROWS,
+        max_buffered: int = INBOX_MAX_BUFFERED,
+    ):
+        self._get_client = get_client
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self.max_buffered = max_buffered
+        self.recent = RecentKeys()
+        self._handlers: Dict[str, List[InboundHandler]] = {}
+        self._buffer: List[Dict[str, Any]] = []
+
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+        self.accepted = 0
+        self.duplicates = 0
+
+    @property
+    def client(self):
+        if self._get_client is None:
+            from services.webhook_manager import get_supabase_client
+            self._get_client = get_supabase_client
+        return self._get_client()
+
+    def register_handler(self, provider: str, handler: InboundHandler):
+        """Run `handler(receipt)` for every stored webhook from `provider`"""
+        self._handlers.setdefault(provider, []).append(handler)
+
+    # =============================================
+    # ACCEPT
+    # =============================================
+
+    def is_full(self) -> bool:
+        return len(self._buffer) >= self.max_buffered
+
+    def accept(self, provider: str, body: bytes, key: str, signature: Optional[str], verified: bool) -> bool:
+        """Buffer a raw webhook; False if it is a redelivery we already have"""
+        if not self.recent.add(f"{provider}|{key}"):
+            self.duplicates += 1
+            return False
+
+        self._buffer.append({
+            "provider": provider,
+            "body": body,
+            "idempotency_key": key,
+            "signature": signature,
+            "verified": verified,
+            "received_at": datetime.now().isoformat(),
+        })
+        self.accepted += 1
+        self.start()
+        if self._wakeup and len(self._buffer) >= self.max_rows:
+            self._wakeup.set()
+        return True
+
+    # =============================================
+    # LIFECYCLE
+    # =============================================
+
+    def start(self):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._task is None or self._task.done():
+            self._stopping = False
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the loop after flushing whatever is still buffered"""
+        if self._task:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        if self._buffer:
+            await self.flush()
+
+    def stats(self) -> Dict[str, int]:
+        return {"buffered": len(self._buffer), "accepted": self.accepted, "duplicates": self.duplicates}
+
+    async def _run(self):
+        while not self._stopping:
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                while self._buffer:
+                    await self.flush()
+            except Exception as e:
+                logger.error(f"Webhook inbox flush failed: {str(e)}")
+
+    # =============================================
+    # FLUSH + DISPATCH
+    # =============================================
+
+    async def flush(self) -> int:
+        batch, self._buffer = self._buffer[:self.max_rows], self._buffer[self.max_rows:]
+        if not batch:
+            return 0
+
+        receipts = []
+        for item in batch:
+            try:
+                payload = json.loads(item["body"])
+            except ValueError:
+                # Form-encoded or otherwise non-JSON bodies are kept verbatim
+                payload = {"raw": item["body"].decode("utf-8", errors="replace")}
+            receipts.append({
+                "provider": item["provider"],
+                "payload": payload,
+                "signature": item["signature"],
+                "verified": item["verified"],
+                "idempotency_key": item["idempotency_key"],
+                "received_at": item["received_at"],
+            })
+
+        try:
+            self.client.table('webhook_receipts').upsert(
+                receipts,
+                on_conflict='provider,idempotency_key',
+                ignore_duplicates=True,
+                returning='minimal'
+            ).execute()
+        except Exception:
+            # Keep the batch (ahead of newer receipts) for the next attempt
+            self._buffer = batch + self._buffer
+            raise
+
+        await self._dispatch(receipts)
+        return len(receipts)
+
+    async def _dispatch(self, receipts: List[Dict[str, Any]]):
+        jobs, handled = [], []
+        for receipt in receipts:
+            for handler in self._handlers.get(receipt["provider"], []):
+                jobs.append(handler(receipt))
+                handled.append(receipt)
+        if not jobs:
+            return
+
+        outcomes = await asyncio.gather(*jobs, return_exceptions=True)
+        failed = set()
+        for receipt, outcome in zip(handled, outcomes):
+            if isinstance(outcome, Exception):
+                logger.error(f"{receipt['provider']} webhook handler failed: {outcome}")
+                failed.add((receipt["provider"], receipt["idempotency_key"]))
+
+        # Only receipts whose handlers all succeeded count as processed
+        processed: Dict[str, List[str]] = {}
+        for provider, key in dict.fromkeys((r["provider"], r["idempotency_key"]) for r in handled):
+            if (provider, key) not in failed:
+                processed.setdefault(provider, []).append(key)
+
+        for provider, keys in processed.items():
+            try:
+                self.client.table('webhook_receipts').update({'processed': True}).eq(
+                    'provider', provider
+                ).in_('idempotency_key', keys).execute()
+            except Exception as e:
+                logger.warning(f"Failed to mark {provider} webhooks processed: {e}")
+
+
+# =============================================
+# INITIALIZE INBOX
+# =============================================
+webhook_inbox = WebhookInbox()
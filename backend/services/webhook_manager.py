@@ -4,12 +4,18 @@
 # =============================================
 from fastapi import FastAPI, Request, HTTPException, Header
 from pydantic import BaseModel
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
+import asyncio
 import hmac
 import hashlib
+import json
+import time
 import httpx
 from datetime import datetime
 from supabase import create_client, Client
+
+from services.webhook_outbox import webhook_dispatcher
+from services.webhook_inbox import webhook_inbox, provider_secret, verify_signature, idempotency_key
 import os
 import logging
 
@@ -38,6 +44,34 @@ def get_supabase_client() -> Client:
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Delivery settings
+WEBHOOK_TIMEOUT_SECONDS = float(os.getenv("WEBHOOK_TIMEOUT_SECONDS", "10"))
+WEBHOOK_ENDPOINT_CONCURRENCY = int(os.getenv("WEBHOOK_ENDPOINT_CONCURRENCY", "4"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "50"))
+WEBHOOK_INDEX_TTL_SECONDS = float(os.getenv("WEBHOOK_INDEX_TTL_SECONDS", "30"))
+
+# Shared pooled client for outgoing deliveries - lazy initialization
+_http_client: Optional[httpx.AsyncClient] = None
+
+def get_http_client() -> httpx.AsyncClient:
+    """Lazy initialization of the pooled delivery client"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            timeout=WEBHOOK_TIMEOUT_SECONDS,
+            limits=httpx.Limits(
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                max_keepalive_connections=WEBHOOK_MAX_CONNECTIONS
+            )
+        )
+    return _http_client
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
 # =============================================
 # PYDANTIC MODELS
 # =============================================
@@ -50,16 +84,110 @@ class WebhookEndpoint(BaseModel):
 # =============================================
 # WEBHOOK FUNCTIONS
 # =============================================
-def generate_signature(payload: Dict, secret: str) -> str:
-    """Generate HMAC signature for webhook"""
-    import json
-    message = json.dumps(payload, sort_keys=True).encode()
-    signature = hmac.new(
+def serialize_payload(payload: Dict) -> bytes:
+    """Canonical request body; signatures are computed over exactly these bytes"""
+    return json.dumps(payload, sort_keys=True).encode()
+
+def sign_body(body: bytes, secret: str) -> str:
+    """HMAC-SHA256 of an already serialized body"""
+    return hmac.new(
         secret.encode(),
-        message,
+        body,
         hashlib.sha256
     ).hexdigest()
-    return signature
+
+def generate_signature(payload: Dict, secret: str) -> str:
+    """Generate HMAC signature for webhook"""
+    return sign_body(serialize_payload(payload), secret)
+
+# =============================================
+# SUBSCRIPTION INDEX
+# =============================================
+class WebhookSubscriptionIndex:
+    """
+    event_type -> active endpoints, built from one webhook_endpoints read.
+
+    Rebuilt when older than the TTL or after invalidate() (called on
+    registration), so triggers no longer scan every endpoint per event.
+    """
+    
+    def __init__(self, ttl_seconds: float = WEBHOOK_INDEX_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._by_event: Dict[str, List[Dict]] = {}
+        self._by_id: Dict[str, Dict] = {}
+        self._loaded_at: Optional[float] = None
+    
+    def invalidate(self):
+        self._loaded_at = None
+    
+    def refresh(self):
+        webhooks = get_supabase_client().table('webhook_endpoints').select('*').eq(
+            'is_active', True
+        ).execute()
+        
+        by_event: Dict[str, List[Dict]] = {}
+        for webhook in webhooks.data or []:
+            for event in set(webhook.get('events', []) or []):
+                by_event.setdefault(event, []).append(webhook)
+        
+        self._by_event = by_event
+        self._by_id = {webhook['id']: webhook for webhook in webhooks.data or []}
+        self._loaded_at = time.monotonic()
+    
+    def _ensure_fresh(self):
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl_seconds:
+            self.refresh()
+    
+    def endpoints_for(self, event_type: str) -> List[Dict]:
+        self._ensure_fresh()
+        return self._by_event.get(event_type, [])
+    
+    def endpoint(self, webhook_id: str) -> Optional[Dict]:
+        """Active endpoint by id (None once deactivated or deleted)"""
+        self._ensure_fresh()
+        return self._by_id.get(webhook_id)
+
+subscription_index = WebhookSubscriptionIndex()
+
+# Caps in-flight deliveries per endpoint so one slow receiver
+# cannot take every pooled connection
+_endpoint_slots: Dict[str, asyncio.Semaphore] = {}
+
+def _endpoint_slot(webhook_id: str) -> asyncio.Semaphore:
+    slot = _endpoint_slots.get(webhook_id)
+    if slot is None:
+        slot = asyncio.Semaphore(WEBHOOK_ENDPOINT_CONCURRENCY)
+        _endpoint_slots[webhook_id] = slot
+    return slot
+
+async def deliver_webhook(webhook: Dict, event_type: str, body: bytes) -> Dict[str, Any]:
+    """POST a pre-serialized body to one endpoint"""
+    headers = {
+        'Content-Type': 'application/json',
+        'X-Webhook-Signature': sign_body(body, webhook['secret']),
+        'X-Webhook-Event': event_type
+    }
+    try:
+        async with _endpoint_slot(webhook['id']):
+            response = await get_http_client().post(
+                webhook['url'],
+                content=body,
+                headers=headers,
+                timeout=WEBHOOK_TIMEOUT_SECONDS
+            )
+        return {
+            "webhook_id": webhook['id'],
+            "success": response.status_code < 400,
+            "status_code": response.status_code,
+            "response_body": response.text[:1000] if response.text else None
+        }
+    except Exception as e:
+        logger.error(f"Webhook delivery failed for {webhook['id']}: {e}")
+        return {
+            "webhook_id": webhook['id'],
+            "success": False,
+            "error": str(e)
+        }
 
 # =============================================
 # API ENDPOINTS
@@ -81,6 +209,7 @@ async def register_webhook(endpoint: WebhookEndpoint, user_id: Optional[str] = N
         if not result.data:
             raise HTTPException(500, "Failed to create webhook endpoint")
         
+        subscription_index.invalidate()
         return {"success": True, "webhook_id": result.data[0]['id']}
     except Exception as e:
         logger.error(f"Webhook registration failed: {str(e)}")
@@ -91,67 +220,22 @@ async def trigger_webhook(event_type: str, payload: Dict[str, Any]):
     """
     Trigger webhooks for an event
     Called internally when events occur
+    
+    Deliveries are written to the durable outbox and sent by the background
+    dispatcher (with retries), so this returns as soon as they are queued.
     """
     try:
-        supabase = get_supabase_client()
+        relevant_webhooks = subscription_index.endpoints_for(event_type)
         
-        # Get all active webhooks for this event
-        webhooks = supabase.table('webhook_endpoints').select('*').eq(
-            'is_active', True
-        ).execute()
+        # Serialize once; every endpoint receives (and is signed over) the same bytes
+        body = serialize_payload(payload)
+        delivery_ids = webhook_dispatcher.enqueue(event_type, body, relevant_webhooks)
         
-        # Filter webhooks that subscribe to this event
-        relevant_webhooks = [
-            w for w in webhooks.data
-            if event_type in (w.get('events', []) or [])
+        results = [
+            {"webhook_id": webhook['id'], "delivery_id": delivery_id, "status": "queued"}
+            for webhook, delivery_id in zip(relevant_webhooks, delivery_ids)
         ]
         
-        results = []
-        
-        for webhook in relevant_webhooks:
-            try:
-                # Generate HMAC signature
-                signature = generate_signature(payload, webhook['secret'])
-                
-                # Send webhook
-                async with httpx.AsyncClient() as client:
-                    response = await client.post(
-                        webhook['url'],
-                        json=payload,
-                        headers={
-                            'X-Webhook-Signature': signature,
-                            'X-Webhook-Event': event_type
-                        },
-                        timeout=10.0
-                    )
-                
-                # Log delivery
-                try:
-                    supabase.table('webhook_deliveries').insert({
-                        "webhook_id": webhook['id'],
-                        "event_type": event_type,
-                        "payload": payload,
-                        "status_code": response.status_code,
-                        "response_body": response.text[:1000] if response.text else None,
-                        "status": "delivered" if response.status_code < 400 else "failed",
-                        "created_at": datetime.now().isoformat()
-                    }).execute()
-                except Exception as e:
-                    logger.warning(f"Failed to log delivery: {e}")
-                
-                results.append({
-                    "webhook_id": webhook['id'],
-                    "success": response.status_code < 400
-                })
-                
-            except Exception as e:
-                logger.error(f"Webhook delivery failed for {webhook['id']}: {e}")
-                results.append({
-                    "webhook_id": webhook['id'],
-                    "success": False,
-                    "error": str(e)
-                })
-        
         return {"triggered": len(results), "results": results}
     except Exception as e:
         logger.error(f"Webhook trigger failed: {str(e)}")
@@ -164,32 +248,37 @@ async def receive_webhook(
     x_webhook_signature: Optional[str] = Header(None, alias="X-Webhook-Signature")
 ):
     """
-    Receive webhooks from external providers
+    Receive webhooks from external providers.
+
+    Acknowledges as soon as the raw body is verified and buffered; storage
+    in webhook_receipts and provider handlers run in the webhook inbox.
     """
-    try:
-        supabase = get_supabase_client()
-        
-        body = await request.body()
-        payload = await request.json()
-        
-        # Log receipt
-        try:
-            supabase.table('webhook_receipts').insert({
-                "provider": provider,
-                "payload": payload,
-                "signature": x_webhook_signature,
-                "received_at": datetime.now().isoformat()
-            }).execute()
-        except Exception as e:
-            logger.warning(f"Failed to log webhook receipt: {e}")
-        
-        # Process webhook based on provider and type
-        # This would be extended based on specific provider requirements
-        
-        return {"success": True, "provider": provider}
-    except Exception as e:
-        logger.error(f"Webhook receipt failed: {str(e)}")
-        raise HTTPException(500, f"Receipt failed: {str(e)}")
+    body = await request.body()
+    
+    secret = provider_secret(provider)
+    verified = secret is not None and verify_signature(body, x_webhook_signature, secret)
+    if secret is not None and not verified:
+        raise HTTPException(401, "Invalid webhook signature")
+    
+    if webhook_inbox.is_full():
+        # Providers retry on 5xx, so shed load instead of buffering without bound
+        raise HTTPException(503, "Webhook inbox is full, retry later")
+    
+    key = idempotency_key(provider, request.headers, body)
+    accepted = webhook_inbox.accept(provider, body, key, x_webhook_signature, verified)
+    
+    return {"success": True, "provider": provider, "duplicate": not accepted}
+
+@app.on_event("startup")
+async def startup():
+    webhook_dispatcher.start()
+    webhook_inbox.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await webhook_dispatcher.stop()
+    await webhook_inbox.stop()
+    await close_http_client()
 
 @app.get("/health")
 async def health():
@@ -0,0 +1,445 @@
+# =============================================
+# WEBHOOK OUTBOX
+# Durable delivery queue for outgoing webhooks with
+# exponential backoff, per-endpoint circuit breaking
+# and a dead-letter state
+# =============================================
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from datetime import datetime, timezone
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import sqlite3
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_BATCH_SIZE = int(os.getenv("WEBHOOK_OUTBOX_BATCH_SIZE", "100"))
+# Outcomes are written back in chunks of this size as deliveries finish
+OUTBOX_APPLY_CHUNK = int(os.getenv("WEBHOOK_OUTBOX_APPLY_CHUNK", "20"))
+# Same settings webhook_manager delivers with (it imports this module, so read them here)
+_DELIVERY_TIMEOUT_SECONDS = float(os.getenv("WEBHOOK_TIMEOUT_SECONDS", "10"))
+_ENDPOINT_CONCURRENCY = int(os.getenv("WEBHOOK_ENDPOINT_CONCURRENCY", "4"))
+# A claimed batch may all target one endpoint, which delivers
+# _ENDPOINT_CONCURRENCY at a time; the lease must outlast that worst case
+OUTBOX_LEASE_SECONDS = int(os.getenv(
+    "WEBHOOK_OUTBOX_LEASE_SECONDS",
+    str(math.ceil(OUTBOX_BATCH_SIZE / _ENDPOINT_CONCURRENCY) * math.ceil(_DELIVERY_TIMEOUT_SECONDS) + 30)
+))
+OUTBOX_POLL_SECONDS = float(os.getenv("WEBHOOK_OUTBOX_POLL_SECONDS", "5"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_BASE_SECONDS = float(os.getenv("WEBHOOK_OUTBOX_BACKOFF_BASE_SECONDS", "10"))
+OUTBOX_BACKOFF_MAX_SECONDS = float(os.getenv("WEBHOOK_OUTBOX_BACKOFF_MAX_SECONDS", "3600"))
+# Local SQLite file instead of Supabase (tests / local development)
+OUTBOX_SQLITE_PATH = os.getenv("WEBHOOK_OUTBOX_SQLITE_PATH")
+
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("WEBHOOK_BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_COOLDOWN_SECONDS = float(os.getenv("WEBHOOK_BREAKER_COOLDOWN_SECONDS", "60"))
+BREAKER_MAX_COOLDOWN_SECONDS = float(os.getenv("WEBHOOK_BREAKER_MAX_COOLDOWN_SECONDS", "3600"))
+
+
+def _iso(epoch: float) -> str:
+    return datetime.fromtimestamp(epoch, timezone.utc).isoformat()
+
+
+def backoff_seconds(attempts: int) -> float:
+    """Delay before retry number `attempts` (1-based), jittered +/-25%"""
+    delay = min(OUTBOX_BACKOFF_MAX_SECONDS, OUTBOX_BACKOFF_BASE_SECONDS * (2 ** (attempts - 1)))
+    return delay * random.uniform(0.75, 1.25)
+
+
+# =============================================
+# STORES
+# =============================================
+# A store persists outbox rows:
+#   enqueue(rows) -> ids       rows: {endpoint_id, event_type, body}
+#   claim(limit, lease) -> rows due now (or with an expired lease)
+#   apply(results)             results: {id, status, attempts, next_attempt_at,
+#                                        last_status_code, last_error, delivered_at}
+# Timestamps cross the interface as epoch seconds.
+
+class SupabaseOutboxStore:
+    """webhook_outbox table (sql/webhook_outbox.sql)"""
+
+    def __init__(self, get_client: Callable[[], Any]):
+        self._get_client = get_client
+
+    def enqueue(self, rows: List[Dict]) -> List[str]:
+        if not rows:
+            return []
+        result = self._get_client().table('webhook_outbox').insert(rows).execute()
+        return [row['id'] for row in (result.data or [])]
+
+    def claim(self, limit: int, lease_seconds: int) -> List[Dict]:
+        result = self._get_client().rpc('claim_webhook_outbox', {
+            'p_limit': limit,
+            'p_lease_seconds': lease_seconds
+        }).execute()
+        return result.data or []
+
+    def apply(self, results: List[Dict]):
+        if not results:
+            return
+        payload = []
+        for r in results:
+            row = dict(r)
+            for field in ('next_attempt_at', 'delivered_at'):
+                if row.get(field) is not None:
+                    row[field] = _iso(row[field])
+            payload.append(row)
+        self._get_client().rpc('apply_webhook_outbox_results', {'p_results': payload}).execute()
+
+
+class SQLiteOutboxStore:
+    """Same contract on a local SQLite file (':memory:' for tests)"""
+
+    def __init__(self, path: str = ":memory:"):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS webhook_outbox (
+                id TEXT PRIMARY KEY,
+                endpoint_id TEXT NOT NULL,
+                event_type TEXT NOT NULL,
+                body TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                locked_until REAL,
+                last_status_code INTEGER,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                delivered_at REAL
+            )
+        """)
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_webhook_outbox_due ON webhook_outbox(status, next_attempt_at)"
+        )
+
+    def enqueue(self, rows: List[Dict]) -> List[str]:
+        now = time.time()
+        ids = [str(uuid.uuid4()) for _ in rows]
+        self._db.executemany(
+            "INSERT INTO webhook_outbox (id, endpoint_id, event_type, body, next_attempt_at, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(i, r['endpoint_id'], r['event_type'], r['body'], now, now) for i, r in zip(ids, rows)]
+        )
+        return ids
+
+    def claim(self, limit: int, lease_seconds: int) -> List[Dict]:
+        now = time.time()
+        # BEGIN IMMEDIATE takes the write lock, like FOR UPDATE SKIP LOCKED
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self._db.execute(
+                "SELECT * FROM webhook_outbox "
+                "WHERE (status = 'pending' AND next_attempt_at <= ?) "
+                "   OR (status = 'delivering' AND locked_until < ?) "
+                "ORDER BY next_attempt_at LIMIT ?",
+                (now, now, limit)
+            ).fetchall()
+            self._db.executemany(
+                "UPDATE webhook_outbox SET status = 'delivering', locked_until = ? WHERE id = ?",
+                [(now + lease_seconds, row['id']) for row in rows]
+            )
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+        return [dict(row, status='delivering') for row in rows]
+
+    def apply(self, results: List[Dict]):
+        self._db.executemany(
+            "UPDATE webhook_outbox SET status = :status, "
+            "attempts = COALESCE(:attempts, attempts), "
+            "next_attempt_at = COALESCE(:next_attempt_at, next_attempt_at), "
+            "last_status_code = COALESCE(:last_status_code, last_status_code), "
+            "last_error = :last_error, delivered_at = :delivered_at, locked_until = NULL "
+            "WHERE id = :id",
+            [{
+                'attempts': None, 'next_attempt_at': None, 'last_status_code': None,
+                'last_error': None, 'delivered_at': None, **r
+            } for r in results]
+        )
+
+    def rows(self, status: Optional[str] = None) -> List[Dict]:
+        query, args = "SELECT * FROM webhook_outbox", ()
+        if status:
+            query, args = query + " WHERE status = ?", (status,)
+        return [dict(row) for row in self._db.execute(query, args).fetchall()]
+
+
+def get_outbox_store():
+    if OUTBOX_SQLITE_PATH:
+        return SQLiteOutboxStore(OUTBOX_SQLITE_PATH)
+    from services.webhook_manager import get_supabase_client
+    return SupabaseOutboxStore(get_supabase_client)
+
+
+# =============================================
+# CIRCUIT BREAKER
+# =============================================
+class EndpointCircuitBreaker:
+    """
+    Pauses endpoints that keep failing.
+
+    After `threshold` consecutive failures the endpoint is open for a
+    cooldown (doubling on every re-open). Once it elapses a single trial
+    delivery is let through; success closes the breaker.
+    """
+
+    def __init__(
+        self,
+        threshold: int = BREAKER_FAILURE_THRESHOLD,
+        cooldown_seconds: float = BREAKER_COOLDOWN_SECONDS,
+        max_cooldown_seconds: float = BREAKER_MAX_COOLDOWN_SECONDS,
+    ):
+        self.threshold = threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.max_cooldown_seconds = max_cooldown_seconds
+        self._failures: Dict[str, int] = {}
+        self._open_until: Dict[str, float] = {}
+        self._cooldown: Dict[str, float] = {}
+        self._trial: Dict[str, bool] = {}
+
+    def allow(self, endpoint_id: str) -> bool:
+        open_until = self._open_until.get(endpoint_id)
+        if open_until is None:
+            return True
+        if time.time() < open_until or self._trial.get(endpoint_id):
+            return False
+        self._trial[endpoint_id] = True  # half-open: one trial delivery
+        return True
+
+    def retry_at(self, endpoint_id: str) -> float:
+        return max(self._open_until.get(endpoint_id, 0.0), time.time() + 1)
+
+    def record_success(self, endpoint_id: str):
+        for state in (self._failures, self._open_until, self._cooldown, self._trial):
+            state.pop(endpoint_id, None)
+
+    def record_failure(self, endpoint_id: str):
+        failures = self._failures.get(endpoint_id, 0) + 1
+        self._failures[endpoint_id] = failures
+        self._trial.pop(endpoint_id, None)
+        if failures >= self.threshold:
+            cooldown = self._cooldown.get(endpoint_id)
+            cooldown = self.cooldown_seconds if cooldown is None else min(cooldown * 2, self.max_cooldown_seconds)
+            self._cooldown[endpoint_id] = cooldown
+            self._open_until[endpoint_id] = time.time() + cooldown
+            logger.warning(f"Webhook endpoint {endpoint_id} paused for {cooldown:.0f}s after {failures} failures")
+
+    def is_open(self, endpoint_id: str) -> bool:
+        return endpoint_id in self._open_until
+
+
+# =============================================
+# DISPATCHER
+# =============================================
+class WebhookOutboxDispatcher:
+    """
+    Enqueues deliveries and drains the outbox in the background.
+
+    enqueue() is the only thing trigger_webhook waits for. The drain loop
+    claims due rows (leased, so several processes can drain one outbox),
+    delivers them concurrently and writes outcomes back in chunks as the
+    deliveries finish, so fast endpoints are not held behind slow ones.
+    """
+
+    def __init__(
+        self,
+        store: Any = None,
+        deliver: Optional[Callable[[Dict, str, bytes], Awaitable[Dict]]] = None,
+        resolve_endpoint: Optional[Callable[[str], Optional[Dict]]] = None,
+        breaker: Optional[EndpointCircuitBreaker] = None,
+        batch_size: int = OUTBOX_BATCH_SIZE,
+        lease_seconds: int = OUTBOX_LEASE_SECONDS,
+        poll_seconds: float = OUTBOX_POLL_SECONDS,
+        max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+        apply_chunk: int = OUTBOX_APPLY_CHUNK,
+    ):
+        self._store = store
+        self._deliver = deliver
+        self._resolve_endpoint = resolve_endpoint
+        self.breaker = breaker or EndpointCircuitBreaker()
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.max_attempts = max_attempts
+        self.apply_chunk = apply_chunk
+
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+        self.delivered = 0
+        self.dead = 0
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = get_outbox_store()
+        return self._store
+
+    def _dependencies(self):
+        if self._deliver is None or self._resolve_endpoint is None:
+            from services.webhook_manager import deliver_webhook, subscription_index
+            self._deliver = self._deliver or deliver_webhook
+            self._resolve_endpoint = self._resolve_endpoint or subscription_index.endpoint
+        return self._deliver, self._resolve_endpoint
+
+    # =============================================
+    # ENQUEUE
+    # =============================================
+
+    def enqueue(self, event_type: str, body: bytes, endpoints: List[Dict]) -> List[str]:
+        """Persist one delivery per endpoint and wake the drain loop"""
+        ids = self.store.enqueue([{
+            'endpoint_id': endpoint['id'],
+            'event_type': event_type,
+            'body': body.decode()
+        } for endpoint in endpoints])
+        self.start()
+        if self._wakeup:
+            self._wakeup.set()
+        return ids
+
+    # =============================================
+    # LIFECYCLE
+    # =============================================
+
+    def start(self):
+        """Start the drain loop (idempotent; needs a running event loop)"""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._task is None or self._task.done():
+            self._stopping = False
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+            logger.info("Webhook outbox dispatcher started")
+
+    async def stop(self):
+        if self._task:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "delivered": self.delivered,
+            "dead": self.dead,
+            "open_circuits": len(self.breaker._open_until),
+        }
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                drained = await self.drain_once()
+            except Exception as e:
+                logger.error(f"Webhook outbox drain failed: {str(e)}")
+                drained = 0
+            if drained >= self.batch_size:
+                continue  # more may be due right away
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    # =============================================
+    # DELIVERY
+    # =============================================
+
+    async def drain_once(self) -> int:
+        """Claim one batch of due deliveries, attempt them and record outcomes"""
+        rows = self.store.claim(self.batch_size, self.lease_seconds)
+        if not rows:
+            return 0
+        finished: List[Dict] = []
+        for attempt in asyncio.as_completed([self._attempt_safely(row) for row in rows]):
+            finished.append(await attempt)
+            if len(finished) >= self.apply_chunk:
+                self.store.apply(finished)
+                finished = []
+        if finished:
+            self.store.apply(finished)
+        return len(rows)
+
+    async def _attempt_safely(self, row: Dict) -> Dict:
+        """_attempt, but an unexpected error only reschedules its own row"""
+        try:
+            return await self._attempt(row)
+        except Exception as e:
+            logger.error(f"Webhook delivery {row['id']} failed unexpectedly: {str(e)}")
+            return self._failure_outcome(row, (row.get('attempts') or 0) + 1, None, str(e) or type(e).__name__)
+
+    async def _attempt(self, row: Dict) -> Dict:
+        deliver, resolve_endpoint = self._dependencies()
+        endpoint_id = row['endpoint_id']
+        webhook = resolve_endpoint(endpoint_id)
+        if webhook is None:
+            self.dead += 1
+            return {'id': row['id'], 'status': 'dead', 'last_error': 'Endpoint inactive or deleted'}
+
+        if not self.breaker.allow(endpoint_id):
+            # Not an attempt: just wait for the circuit to close
+            return {
+                'id': row['id'],
+                'status': 'pending',
+                'next_attempt_at': self.breaker.retry_at(endpoint_id),
+                'last_error': row.get('last_error')
+            }
+
+        attempts = (row.get('attempts') or 0) + 1
+        try:
+            result = await deliver(webhook, row['event_type'], row['body'].encode())
+        except Exception as e:
+            result = {'success': False, 'error': str(e) or type(e).__name__}
+        status_code = result.get('status_code')
+
+        if result.get('success'):
+            self.breaker.record_success(endpoint_id)
+            self.delivered += 1
+            return {
+                'id': row['id'],
+                'status': 'delivered',
+                'attempts': attempts,
+                'last_status_code': status_code,
+                'delivered_at': time.time()
+            }
+
+        self.breaker.record_failure(endpoint_id)
+        return self._failure_outcome(row, attempts, status_code, result.get('error') or f"HTTP {status_code}")
+
+    def _failure_outcome(self, row: Dict, attempts: int, status_code: Optional[int], error: str) -> Dict:
+        if attempts >= self.max_attempts:
+            self.dead += 1
+            logger.warning(f"Webhook delivery {row['id']} dead-lettered after {attempts} attempts: {error}")
+            return {
+                'id': row['id'],
+                'status': 'dead',
+                'attempts': attempts,
+                'last_status_code': status_code,
+                'last_error': error
+            }
+
+        return {
+            'id': row['id'],
+            'status': 'pending',
+            'attempts': attempts,
+            'next_attempt_at': time.time() + backoff_seconds(attempts),
+            'last_status_code': status_code,
+            'last_error': error
+        }
+
+
+# =============================================
+# INITIALIZE DISPATCHER
+# =============================================
+webhook_dispatcher = WebhookOutboxDispatcher()
@@ -17,11 +17,25 @@ from services.webhook_manager import (
     register_webhook,
     trigger_webhook,
     receive_webhook,
+    close_http_client,
     WebhookEndpoint
 )
+from services.webhook_outbox import webhook_dispatcher
+from services.webhook_inbox import webhook_inbox
 
 router = APIRouter(prefix="/api/webhooks", tags=["webhooks"])
 
+@router.on_event("startup")
+async def start_dispatcher():
+    webhook_dispatcher.start()
+    webhook_inbox.start()
+
+@router.on_event("shutdown")
+async def stop_dispatcher():
+    await webhook_dispatcher.stop()
+    await webhook_inbox.stop()
+    await close_http_client()
+
 @router.post("/register")
 async def register_route(endpoint: WebhookEndpoint, user_id: Optional[str] = None):
     """Register webhook endpoint"""
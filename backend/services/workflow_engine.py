@@ -5,7 +5,7 @@
 from fastapi import FastAPI, HTTPException, BackgroundTasks
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any, Literal
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from supabase import create_client, Client
 import os
 import asyncio
@@ -13,6 +13,10 @@ import json
 import logging
 from enum import Enum
 
+from services.template_renderer import MessageTemplateCache, render_template
+from services.workflow_status_writer import WorkflowStatusWriter
+from services.outbound_messaging import outbound_messenger
+
 # =============================================
 # CONFIGURATION
 # =============================================
@@ -117,6 +121,8 @@ class WorkflowEngine:
     
     def __init__(self):
         self.supabase = None
+        self.templates = MessageTemplateCache(self._get_supabase)
+        self.status_writer = WorkflowStatusWriter(self._get_supabase)
     
     def _get_supabase(self):
         """Get Supabase client"""
@@ -159,15 +165,11 @@ class WorkflowEngine:
                 return {"status": "skipped", "reason": "Workflow inactive"}
             
             # Fetch lead data with related info
-            lead_result = supabase.table('leads').select(
-                '*, properties:property_id(*, builders(*)), profiles:buyer_id(*)'
-            ).eq('id', lead_id).single().execute()
+            lead = self._fetch_lead(lead_id)
             
-            if not lead_result.data:
+            if not lead:
                 raise HTTPException(404, "Lead not found")
             
-            lead = lead_result.data
-            
             # Evaluate conditions
             if not force_execute:
                 conditions_result = supabase.rpc(
@@ -202,8 +204,9 @@ class WorkflowEngine:
             
             logger.info(f"Created execution {execution_id}")
             
-            # Process actions asynchronously
-            asyncio.create_task(self._process_actions(execution_id, lead))
+            # Hand actions to the scheduler; they run when due
+            from services.workflow_scheduler import workflow_scheduler
+            await workflow_scheduler.enqueue_execution(execution_id)
             
             return {
                 "status": "created",
@@ -219,83 +222,89 @@ class WorkflowEngine:
     # ACTION PROCESSING
     # =============================================
     
-    async def _process_actions(self, execution_id: str, lead_data: Dict):
+    def _fetch_lead(self, lead_id: int) -> Optional[Dict]:
+        """Fetch lead with property, builder and profile data for personalization"""
+        lead_result = self._get_supabase().table('leads').select(
+            '*, properties:property_id(*, builders(*)), profiles:buyer_id(*)'
+        ).eq('id', lead_id).single().execute()
+        return lead_result.data
+    
+    def claim_actions(self, worker_id: str, limit: int, lease_seconds: int) -> List[Dict]:
+        """Lease up to `limit` due actions to a worker (claim_workflow_actions RPC)"""
+        result = self._get_supabase().rpc('claim_workflow_actions', {
+            'p_worker_id': worker_id,
+            'p_limit': limit,
+            'p_lease_seconds': lease_seconds
+        }).execute()
+        return result.data or []
+    
+    def renew_action_leases(self, worker_id: str, action_ids: List[str], lease_seconds: int) -> int:
+        """Extend the leases held on in-flight actions"""
+        result = self._get_supabase().rpc('renew_workflow_action_leases', {
+            'p_worker_id': worker_id,
+            'p_action_ids': action_ids,
+            'p_lease_seconds': lease_seconds
+        }).execute()
+        return result.data or 0
+    
+    async def run_claimed_action(self, action: Dict):
         """
-        Process all actions for a workflow execution
+        Execute one action leased to this worker by claim_actions
+        
+        The row is already 'running'; the lease guarantees no other worker
+        runs it concurrently.
         """
+        supabase = self._get_supabase()
+        action_id = action['id']
+        execution_id = action['execution_id']
+        
         try:
-            supabase = self._get_supabase()
+            # single() raises if the execution row is gone; that fails the
+            # action now instead of leaving it leased until poison handling
+            execution_result = supabase.table('workflow_executions').select(
+                'id, lead_id, status'
+            ).eq('id', execution_id).single().execute()
+            
+            execution = execution_result.data
+            
+            if execution['status'] == 'pending':
+                self.status_writer.update_execution(
+                    execution_id,
+                    status='running',
+                    started_at=datetime.now().isoformat()
+                )
             
-            # Update execution status
-            supabase.table('workflow_executions').update({
-                'status': 'running',
-                'started_at': datetime.now().isoformat()
-            }).eq('id', execution_id).execute()
+            lead_data = self._fetch_lead(execution['lead_id']) or {}
             
-            # Fetch pending actions
-            actions_result = supabase.table('workflow_actions').select(
-                '*'
-            ).eq('execution_id', execution_id).order('scheduled_for').execute()
-            
-            actions = actions_result.data or []
-            
-            for action in actions:
-                try:
-                    # Wait for scheduled time
-                    scheduled_time = datetime.fromisoformat(action['scheduled_for'].replace('Z', '+00:00'))
-                    now = datetime.now(scheduled_time.tzinfo)
-                    
-                    if scheduled_time > now:
-                        delay_seconds = (scheduled_time - now).total_seconds()
-                        logger.info(f"Waiting {delay_seconds}s for action {action['id']}")
-                        await asyncio.sleep(delay_seconds)
-                    
-                    # Execute action
-                    await self._execute_action(action, lead_data)
-                    
-                except Exception as e:
-                    logger.error(f"Action {action['id']} failed: {str(e)}")
-                    
-                    # Mark action as failed
-                    supabase.table('workflow_actions').update({
-                        'status': 'failed',
-                        'error_message': str(e),
-                        'completed_at': datetime.now().isoformat()
-                    }).eq('id', action['id']).execute()
-            
-            # Update execution status
-            completed_actions = supabase.table('workflow_actions').select(
-                'status'
-            ).eq('execution_id', execution_id).execute()
-            
-            all_completed = all(
-                a['status'] in ['completed', 'failed', 'skipped']
-                for a in (completed_actions.data or [])
-            )
-            
-            if all_completed:
-                completed_count = len([a for a in completed_actions.data if a['status'] == 'completed'])
-                failed_count = len([a for a in completed_actions.data if a['status'] == 'failed'])
-                
-                supabase.table('workflow_executions').update({
-                    'status': 'completed',
-                    'completed_at': datetime.now().isoformat(),
-                    'actions_completed': completed_count,
-                    'actions_failed': failed_count
-                }).eq('id', execution_id).execute()
-                
-                logger.info(f"Workflow execution {execution_id} completed")
+            try:
+                await self._execute_action(action, lead_data)
+            except Exception as e:
+                # _execute_action already recorded the failure
+                logger.error(f"Action {action_id} failed: {str(e)}")
             
         except Exception as e:
             logger.error(f"Action processing failed: {str(e)}")
             
+            # The action never ran; fail it so its lease is released
+            self.status_writer.update_action(
+                action_id,
+                status='failed',
+                error_message=str(e),
+                completed_at=datetime.now().isoformat()
+            )
+            self.status_writer.count_action(execution_id, 'failed')
+            
             # Mark execution as failed
-            supabase = self._get_supabase()
-            supabase.table('workflow_executions').update({
-                'status': 'failed',
-                'error_message': str(e),
-                'completed_at': datetime.now().isoformat()
-            }).eq('id', execution_id).execute()
+            self.status_writer.update_execution(
+                execution_id,
+                status='failed',
+                error_message=str(e),
+                completed_at=datetime.now().isoformat()
+            )
+        
+        # All transitions of this action (and its execution's counters) are
+        # written in one batched flush; the execution completes in the RPC
+        await self.status_writer.commit()
     
     async def _execute_action(self, action: Dict, lead_data: Dict):
         """
@@ -306,14 +315,7 @@ class WorkflowEngine:
         
         logger.info(f"Executing action {action['id']}: {action_type}")
         
-        supabase = self._get_supabase()
-        
-        # Update action status
-        supabase.table('workflow_actions').update({
-            'status': 'running',
-            'started_at': datetime.now().isoformat()
-        }).eq('id', action['id']).execute()
-        
+        # The claim already marked the action running
         try:
             result = None
             
@@ -328,18 +330,18 @@ class WorkflowEngine:
             elif action_type == 'create_task':
                 result = await self._create_task(action, lead_data)
             elif action_type == 'wait':
-                delay_minutes = action_config.get('duration_minutes', 5)
-                await asyncio.sleep(delay_minutes * 60)
-                result = {"status": "waited"}
+                result = self._defer_remaining_actions(action, action_config.get('duration_minutes', 5))
             else:
                 raise ValueError(f"Unknown action type: {action_type}")
             
             # Mark action as completed
-            supabase.table('workflow_actions').update({
-                'status': 'completed',
-                'result': json.dumps(result),
-                'completed_at': datetime.now().isoformat()
-            }).eq('id', action['id']).execute()
+            self.status_writer.update_action(
+                action['id'],
+                status='completed',
+                result=result,
+                completed_at=datetime.now().isoformat()
+            )
+            self.status_writer.count_action(action['execution_id'], 'completed')
             
             logger.info(f"Action {action['id']} completed successfully")
             
@@ -347,14 +349,33 @@ class WorkflowEngine:
             logger.error(f"Action execution failed: {str(e)}")
             
             # Mark action as failed
-            supabase.table('workflow_actions').update({
-                'status': 'failed',
-                'error_message': str(e),
-                'completed_at': datetime.now().isoformat()
-            }).eq('id', action['id']).execute()
+            self.status_writer.update_action(
+                action['id'],
+                status='failed',
+                error_message=str(e),
+                completed_at=datetime.now().isoformat()
+            )
+            self.status_writer.count_action(action['execution_id'], 'failed')
             
             raise
     
+    def _defer_remaining_actions(self, action: Dict, delay_minutes: float) -> Dict:
+        """
+        Wait action: push later pending actions of the execution back so
+        none runs before now + delay. The scheduler picks up the new times.
+        """
+        resume_at = (datetime.now(timezone.utc) + timedelta(minutes=delay_minutes)).isoformat()
+        
+        self._get_supabase().table('workflow_actions').update({
+            'scheduled_for': resume_at
+        }).eq('execution_id', action['execution_id']).eq(
+            'status', 'pending'
+        ).neq('id', action['id']).gte(
+            'scheduled_for', action['scheduled_for']
+        ).lt('scheduled_for', resume_at).execute()
+        
+        return {"status": "waited", "resume_at": resume_at}
+    
     # =============================================
     # MESSAGE SENDING METHODS
     # =============================================
@@ -370,15 +391,12 @@ class WorkflowEngine:
             
             supabase = self._get_supabase()
             
-            # Fetch template
-            template_result = supabase.table('message_templates').select(
-                '*'
-            ).eq('id', template_id).single().execute()
-            
-            if not template_result.data:
+            # Compiled template (cached per id + updated_at)
+            compiled = self.templates.get(template_id)
+            if not compiled:
                 raise ValueError("Message template not found")
             
-            template = template_result.data
+            template = compiled.row
             
             # Get recipient phone from lead
             recipient_phone = lead_data.get('phone')
@@ -398,16 +416,16 @@ class WorkflowEngine:
             if template.get('use_ai_generation', False):
                 message_body = await self._generate_ai_message(template, lead_data)
             else:
-                body_template = template.get('body_template') or template.get('body', '')
-                message_body = self._personalize_template(body_template, lead_data)
+                message_body = compiled.body.render(lead_data)
             
-            # Send via Twilio
+            # Send via Twilio (rate limited and retried per sender number)
             from_number = f'whatsapp:{TWILIO_WHATSAPP_NUMBER or "+1234567890"}'
-            message = twilio_client.messages.create(
+            message = await outbound_messenger.send('twilio_whatsapp', from_number, lambda: asyncio.to_thread(
+                twilio_client.messages.create,
                 from_=from_number,
                 to=f'whatsapp:{recipient_phone}',
                 body=message_body
-            )
+            ))
             
             # Create delivery record
             delivery_data = {
@@ -425,11 +443,12 @@ class WorkflowEngine:
             
             delivery_result = supabase.table('message_deliveries').insert(delivery_data).execute()
             
-            # Update action with external ID
-            supabase.table('workflow_actions').update({
-                'external_message_id': message.sid,
-                'external_status': message.status
-            }).eq('id', action['id']).execute()
+            # Record the external ID with the action's completion
+            self.status_writer.update_action(
+                action['id'],
+                external_message_id=message.sid,
+                external_status=message.status
+            )
             
             logger.info(f"WhatsApp sent: {message.sid}")
             
@@ -455,15 +474,12 @@ class WorkflowEngine:
             
             supabase = self._get_supabase()
             
-            # Fetch template
-            template_result = supabase.table('message_templates').select(
-                '*'
-            ).eq('id', template_id).single().execute()
-            
-            if not template_result.data:
+            # Compiled template (cached per id + updated_at)
+            compiled = self.templates.get(template_id)
+            if not compiled:
                 raise ValueError("Message template not found")
             
-            template = template_result.data
+            template = compiled.row
             
             # Get recipient phone
             recipient_phone = lead_data.get('phone')
@@ -480,16 +496,16 @@ class WorkflowEngine:
             if template.get('use_ai_generation', False):
                 message_body = await self._generate_ai_message(template, lead_data)
             else:
-                body_template = template.get('body_template') or template.get('body', '')
-                message_body = self._personalize_template(body_template, lead_data)
+                message_body = compiled.body.render(lead_data)
             
-            # Send via Twilio
+            # Send via Twilio (rate limited and retried per sender number)
             from_number = TWILIO_SMS_NUMBER or "+1234567890"
-            message = twilio_client.messages.create(
+            message = await outbound_messenger.send('twilio_sms', from_number, lambda: asyncio.to_thread(
+                twilio_client.messages.create,
                 from_=from_number,
                 to=recipient_phone,
                 body=message_body
-            )
+            ))
             
             # Create delivery record
             delivery_data = {
@@ -530,15 +546,12 @@ class WorkflowEngine:
             
             supabase = self._get_supabase()
             
-            # Fetch template
-            template_result = supabase.table('message_templates').select(
-                '*'
-            ).eq('id', template_id).single().execute()
-            
-            if not template_result.data:
+            # Compiled template (cached per id + updated_at)
+            compiled = self.templates.get(template_id)
+            if not compiled:
                 raise ValueError("Email template not found")
             
-            template = template_result.data
+            template = compiled.row
             
             # Get recipient email
             recipient_email = lead_data.get('email')
@@ -570,25 +583,14 @@ class WorkflowEngine:
                         subject = recommended.subject or template.get('subject', 'Property Inquiry Follow-up')
                     except Exception as e:
                         logger.error(f"AI email generation failed, using fallback: {e}")
-                        body_template = template.get('body_template') or template.get('body', '')
-                        email_body = self._personalize_template(body_template, lead_data)
-                        subject = self._personalize_template(
-                            template.get('subject', 'Property Inquiry Follow-up'),
-                            lead_data
-                        )
+                        email_body = compiled.body.render(lead_data)
+                        subject = compiled.subject.render(lead_data)
                 else:
-                    body_template = template.get('body_template') or template.get('body', '')
-                    email_body = self._personalize_template(body_template, lead_data)
-                    subject = self._personalize_template(
-                        template.get('subject', 'Property Inquiry Follow-up'),
-                        lead_data
-                    )
+                    email_body = compiled.body.render(lead_data)
+                    subject = compiled.subject.render(lead_data)
             else:
-                body_template = template.get('body_template') or template.get('body', '')
-                email_body = self._personalize_template(body_template, lead_data)
-                
-                subject_template = template.get('subject', 'Property Inquiry Follow-up')
-                subject = self._personalize_template(subject_template, lead_data)
+                email_body = compiled.body.render(lead_data)
+                subject = compiled.subject.render(lead_data)
             
             # Get builder info for sender
             property_data = lead_data.get('properties', {})
@@ -597,13 +599,13 @@ class WorkflowEngine:
             from_email = 'noreply@tharaga.co.in'
             from_name = builder_data.get('name') or builder_data.get('company_name') or 'Tharaga'
             
-            # Send via Resend
-            email_response = resend.Emails.send({
+            # Send via Resend (rate limited and retried)
+            email_response = await outbound_messenger.send('resend', from_email, lambda: asyncio.to_thread(resend.Emails.send, {
                 "from": f"{from_name} <{from_email}>",
                 "to": recipient_email,
                 "subject": subject,
                 "html": email_body if template.get('format') == 'html' else f"<p>{email_body}</p>"
-            })
+            }))
             
             # Create delivery record
             delivery_data = {
@@ -660,10 +662,10 @@ class WorkflowEngine:
             
             # Check if tasks table exists
             title_template = config.get('title', 'Follow up with lead')
-            title = self._personalize_template(title_template, lead_data)
+            title = render_template(title_template, lead_data)
             
             description_template = config.get('description', '')
-            description = self._personalize_template(description_template, lead_data) if description_template else ''
+            description = render_template(description_template, lead_data)
             
             task_data = {
                 'builder_id': lead_data.get('builder_id'),
@@ -701,43 +703,16 @@ class WorkflowEngine:
     # HELPER METHODS
     # =============================================
     
-    def _personalize_template(self, template: str, lead_data: Dict) -> str:
-        """Replace template variables with actual data"""
-        if not template:
-            return ""
-        
-        # Get property data
-        property_data = lead_data.get('properties', {})
-        profile_data = lead_data.get('profiles', {})
-        
-        # Get builder info
-        builder_data = property_data.get('builders', {}) if isinstance(property_data.get('builders'), dict) else {}
-        
-        # Available variables
-        lead_name = lead_data.get('name') or profile_data.get('full_name', 'there')
-        first_name = lead_name.split()[0] if lead_name else 'there'
-        
-        variables = {
-            'lead_name': lead_name,
-            'first_name': first_name,
-            'property_title': property_data.get('title', 'the property'),
-            'property_type': property_data.get('property_type', 'property'),
-            'property_price': f"₹{property_data.get('price_inr', property_data.get('price', 0)):,.0f}",
-            'builder_name': builder_data.get('name') or builder_data.get('company_name', 'Builder'),
-            'smartscore': str(lead_data.get('smartscore_v2', lead_data.get('score', 0))),
-            'priority_tier': lead_data.get('priority_tier', 'Developing'),
-            'next_action': lead_data.get('next_best_action', 'Contact us'),
-            'location': property_data.get('locality') or property_data.get('city', 'the area'),
-            'bedrooms': str(property_data.get('bedrooms', 'N/A')),
-            'area_sqft': str(property_data.get('sqft') or property_data.get('area_sqft', 'N/A'))
-        }
-        
-        # Replace variables
-        result = template
-        for key, value in variables.items():
-            result = result.replace(f"{{{{{key}}}}}", str(value))
+    def render_template_bulk(self, template_id: str, leads: List[Dict], field: str = 'body') -> List[str]:
+        """
+        Personalise one message template for many leads (campaign runs)
         
-        return result
+        field is 'body' or 'subject'. The template is fetched and compiled once.
+        """
+        compiled = self.templates.get(template_id)
+        if not compiled:
+            raise ValueError("Message template not found")
+        return getattr(compiled, field).render_many(leads)
     
     async def _generate_ai_message(self, template: Dict, lead_data: Dict) -> str:
         """Generate personalized message using AI Message Generator Service"""
@@ -785,7 +760,7 @@ class WorkflowEngine:
             if not lead_id:
                 # Fallback if no lead_id
                 logger.warning("No lead_id found, using template personalization fallback")
-                return self._personalize_template(
+                return render_template(
                     template.get('body_template') or template.get('body', ''),
                     lead_data
                 )
@@ -805,7 +780,7 @@ class WorkflowEngine:
         except Exception as e:
             logger.error(f"AI message generation failed: {str(e)}")
             # Fallback to template personalization
-            return self._personalize_template(
+            return render_template(
                 template.get('body_template') or template.get('body', ''),
                 lead_data
             )
@@ -813,7 +788,7 @@ class WorkflowEngine:
         except Exception as e:
             logger.error(f"AI generation failed: {str(e)}")
             # Fallback to template
-            return self._personalize_template(template.get('body_template') or template.get('body', ''), lead_data)
+            return render_template(template.get('body_template') or template.get('body', ''), lead_data)
 
 # =============================================
 # INITIALIZE ENGINE
@@ -836,51 +811,34 @@ async def execute_workflow(request: ExecuteWorkflowRequest):
     return result
 
 @app.post("/api/workflows/process-pending")
-async def process_pending_actions(background_tasks: BackgroundTasks):
-    """Process all pending workflow actions (called by cron)"""
+async def process_pending_actions():
+    """Pull pending workflow actions into the scheduler and claim due ones (called by cron)"""
     try:
-        supabase = get_supabase_client()
-        
-        # Fetch pending actions due now
-        actions_result = supabase.table('workflow_actions').select(
-            '*, workflow_executions!inner(*), leads!inner(*)'
-        ).eq('status', 'pending').lte(
-            'scheduled_for', datetime.now().isoformat()
-        ).limit(100).execute()
+        from services.workflow_scheduler import workflow_scheduler
         
-        if not actions_result.data or len(actions_result.data) == 0:
-            return {"status": "no_pending_actions"}
-        
-        # Group by execution
-        executions = {}
-        for action in actions_result.data:
-            exec_id = action['execution_id']
-            if exec_id not in executions:
-                executions[exec_id] = {
-                    'execution': action['workflow_executions'],
-                    'actions': []
-                }
-            executions[exec_id]['actions'].append(action)
-        
-        # Process each execution
-        for exec_id, data in executions.items():
-            lead_data = data['execution'].get('leads', {})
-            background_tasks.add_task(
-                workflow_engine._process_actions,
-                exec_id,
-                lead_data
-            )
+        workflow_scheduler.start()
+        picked_up = await workflow_scheduler.refresh()
         
         return {
-            "status": "processing",
-            "executions_queued": len(executions),
-            "actions_total": len(actions_result.data)
+            "status": "scheduled",
+            "actions_picked_up": picked_up,
+            **workflow_scheduler.stats()
         }
         
     except Exception as e:
         logger.error(f"Pending actions processing failed: {str(e)}")
         raise HTTPException(500, str(e))
 
+@app.on_event("startup")
+async def start_scheduler():
+    from services.workflow_scheduler import workflow_scheduler
+    workflow_scheduler.start()
+
+@app.on_event("shutdown")
+async def stop_scheduler():
+    from services.workflow_scheduler import workflow_scheduler
+    await workflow_scheduler.stop()
+
 @app.get("/api/workflows/{workflow_id}/stats")
 async def get_workflow_stats(workflow_id: str):
     """Get workflow execution statistics"""
@@ -1,7 +1,7 @@
 # =============================================
 # WORKFLOW ENGINE API ROUTES
 # =============================================
-from fastapi import APIRouter, HTTPException, BackgroundTasks
+from fastapi import APIRouter, HTTPException
 from typing import Dict, Any
 import logging
 
@@ -11,6 +11,7 @@ from services.workflow_engine import (
     get_supabase_client,
     TriggerType
 )
+from services.workflow_scheduler import workflow_scheduler
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
@@ -35,51 +36,31 @@ async def execute_workflow(request: ExecuteWorkflowRequest):
         logger.error(f"Workflow execution failed: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Execution failed: {str(e)}")
 
+@router.on_event("startup")
+async def start_scheduler():
+    """Hydrate the action heap from workflow_actions and start the timer loop"""
+    workflow_scheduler.start()
+
+@router.on_event("shutdown")
+async def stop_scheduler():
+    await workflow_scheduler.stop()
+
 @router.post("/process-pending")
-async def process_pending_actions(background_tasks: BackgroundTasks):
+async def process_pending_actions():
     """
-    Process all pending workflow actions (called by cron)
+    Pull pending workflow actions into the scheduler and claim due ones (called by cron)
+    
+    Safe to call from overlapping crons and replicas: actions are leased
+    atomically, so each one is executed by exactly one worker.
     """
     try:
-        supabase = get_supabase_client()
-        
-        # Fetch pending actions due now
-        actions_result = supabase.table('workflow_actions').select(
-            '*, workflow_executions!inner(*), leads:lead_id(*)'
-        ).eq('status', 'pending').lte(
-            'scheduled_for', datetime.now().isoformat()
-        ).limit(100).execute()
-        
-        if not actions_result.data or len(actions_result.data) == 0:
-            return {"status": "no_pending_actions"}
-        
-        # Group by execution
-        executions = {}
-        for action in actions_result.data:
-            exec_id = action['execution_id']
-            exec_data = action.get('workflow_executions', {})
-            lead_data = exec_data.get('leads', {})
-            
-            if exec_id not in executions:
-                executions[exec_id] = {
-                    'execution': exec_data,
-                    'lead_data': lead_data,
-                    'actions': []
-                }
-            executions[exec_id]['actions'].append(action)
-        
-        # Process each execution
-        for exec_id, data in executions.items():
-            background_tasks.add_task(
-                workflow_engine._process_actions,
-                exec_id,
-                data['lead_data']
-            )
+        workflow_scheduler.start()
+        picked_up = await workflow_scheduler.refresh()
         
         return {
-            "status": "processing",
-            "executions_queued": len(executions),
-            "actions_total": len(actions_result.data)
+            "status": "scheduled",
+            "actions_picked_up": picked_up,
+            **workflow_scheduler.stats()
         }
         
     except Exception as e:
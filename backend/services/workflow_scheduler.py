@@ -0,0 +1,286 @@
+# =============================================
+# WORKFLOW ACTION SCHEDULER
+# Durable timer loop for pending workflow actions
+# =============================================
+from typing import Any, Dict, List, Optional, Tuple
+from datetime import datetime, timedelta, timezone
+import asyncio
+import heapq
+import logging
+import os
+import socket
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Only actions due within the lookahead window are held in memory;
+# later ones stay in workflow_actions until a refresh reaches them.
+SCHEDULER_LOOKAHEAD_SECONDS = int(os.getenv("WORKFLOW_SCHEDULER_LOOKAHEAD_SECONDS", "300"))
+SCHEDULER_REFRESH_SECONDS = int(os.getenv("WORKFLOW_SCHEDULER_REFRESH_SECONDS", "30"))
+# Size of the worker pool draining claimed actions
+SCHEDULER_MAX_CONCURRENCY = int(os.getenv("WORKFLOW_SCHEDULER_MAX_CONCURRENCY", "10"))
+SCHEDULER_HYDRATE_LIMIT = int(os.getenv("WORKFLOW_SCHEDULER_HYDRATE_LIMIT", "1000"))
+# Claimed actions are leased; a lease not renewed in time is reclaimable
+SCHEDULER_LEASE_SECONDS = int(os.getenv("WORKFLOW_ACTION_LEASE_SECONDS", "120"))
+SCHEDULER_CLAIM_BATCH_SIZE = int(os.getenv("WORKFLOW_CLAIM_BATCH_SIZE", "50"))
+
+
+def parse_timestamp(value: str) -> float:
+    """Parse a Postgres/ISO timestamp into epoch seconds (naive values are UTC)"""
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+class WorkflowScheduler:
+    """
+    Executes pending workflow_actions when they fall due.
+
+    Actions are never slept on: the database row stays 'pending' until it
+    runs, and a single loop wakes up from an in-memory min-heap of due
+    times. The heap is hydrated from the DB on start and refreshed
+    periodically, so a restart loses nothing and memory stays O(actions
+    due soon).
+
+    The heap only decides *when* to look; *who* runs an action is decided
+    by claim_workflow_actions (sql/workflow_action_leases.sql), which leases
+    due rows with FOR UPDATE SKIP LOCKED. Claimed rows are drained by a
+    fixed pool of workers that renew their leases while they work, so any
+    number of replicas can run side by side and a crashed worker's actions
+    are reclaimed once its lease lapses.
+    """
+
+    def __init__(
+        self,
+        engine: Any = None,
+        lookahead_seconds: int = SCHEDULER_LOOKAHEAD_SECONDS,
+        refresh_seconds: int = SCHEDULER_REFRESH_SECONDS,
+        max_concurrency: int = SCHEDULER_MAX_CONCURRENCY,
+        lease_seconds: int = SCHEDULER_LEASE_SECONDS,
+        claim_batch_size: int = SCHEDULER_CLAIM_BATCH_SIZE,
+    ):
+        self._engine = engine
+        self.lookahead_seconds = lookahead_seconds
+        self.refresh_seconds = refresh_seconds
+        self.max_concurrency = max_concurrency
+        self.lease_seconds = lease_seconds
+        self.claim_batch_size = claim_batch_size
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+        self._heap: List[Tuple[float, str]] = []
+        # action_id -> due time of its live heap entry (older entries are stale)
+        self._scheduled: Dict[str, float] = {}
+        # Leased actions held by this process, queued or running
+        self._claimed: Dict[str, Dict] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._claim_needed = False
+
+        self._task: Optional[asyncio.Task] = None
+        self._workers: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+        self._last_refresh = float("-inf")
+        self._last_renewal = float("-inf")
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            from services.workflow_engine import workflow_engine
+            self._engine = workflow_engine
+        return self._engine
+
+    # =============================================
+    # QUEUEING
+    # =============================================
+
+    def push(self, action_id: str, due_at: float) -> bool:
+        """Track an action if it is due within the lookahead window"""
+        if action_id in self._claimed:
+            return False
+        if due_at > time.time() + self.lookahead_seconds:
+            return False
+        if self._scheduled.get(action_id) == due_at:
+            return False
+
+        self._scheduled[action_id] = due_at
+        heapq.heappush(self._heap, (due_at, action_id))
+        if self._wakeup:
+            self._wakeup.set()
+        return True
+
+    def schedule_actions(self, actions: List[Dict]) -> int:
+        """Push pending action rows ({id, scheduled_for, status})"""
+        added = 0
+        for action in actions:
+            if action.get('status', 'pending') != 'pending':
+                continue
+            if self.push(action['id'], parse_timestamp(action['scheduled_for'])):
+                added += 1
+        return added
+
+    def request_claim(self):
+        """Ask the loop to claim due actions now (e.g. expired leases)"""
+        self._claim_needed = True
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def refresh(self) -> int:
+        """Pull pending actions due within the lookahead window from the DB"""
+        self._last_refresh = time.monotonic()
+        horizon = datetime.now(timezone.utc) + timedelta(seconds=self.lookahead_seconds)
+        result = self.engine._get_supabase().table('workflow_actions').select(
+            'id, scheduled_for, status'
+        ).eq('status', 'pending').lte(
+            'scheduled_for', horizon.isoformat()
+        ).order('scheduled_for').limit(SCHEDULER_HYDRATE_LIMIT).execute()
+
+        added = self.schedule_actions(result.data or [])
+        if added:
+            logger.info(f"Scheduler picked up {added} pending actions")
+        # Also sweeps up leases abandoned by crashed workers
+        self.request_claim()
+        return added
+
+    async def enqueue_execution(self, execution_id: str) -> int:
+        """Schedule the pending actions of an execution"""
+        result = self.engine._get_supabase().table('workflow_actions').select(
+            'id, scheduled_for, status'
+        ).eq('execution_id', execution_id).eq('status', 'pending').execute()
+        self.start()
+        return self.schedule_actions(result.data or [])
+
+    # =============================================
+    # LIFECYCLE
+    # =============================================
+
+    def start(self):
+        """Start the scheduler loop and worker pool (idempotent; needs a running event loop)"""
+        if self._task is None or self._task.done():
+            self._stopping = False
+            self._wakeup = asyncio.Event()
+            self._queue = asyncio.Queue()
+            self._workers = [
+                asyncio.create_task(self._worker()) for _ in range(self.max_concurrency)
+            ]
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Workflow scheduler started as {self.worker_id} with {self.max_concurrency} workers")
+
+    async def stop(self):
+        """
+        Stop claiming and cancel the workers. Actions still leased to this
+        process are picked up by another worker once their lease expires.
+        """
+        if self._task:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        for worker in self._workers:
+            worker.cancel()
+        if self._workers:
+            await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._claimed.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "scheduled": len(self._scheduled),
+            "claimed": len(self._claimed),
+            "queued": self._queue.qsize() if self._queue else 0,
+            "workers": len(self._workers),
+        }
+
+    # =============================================
+    # LOOP
+    # =============================================
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                if time.monotonic() - self._last_refresh >= self.refresh_seconds:
+                    await self.refresh()
+            except Exception as e:
+                logger.error(f"Scheduler refresh failed: {str(e)}")
+
+            self._pop_due()
+            try:
+                await self._claim_due()
+            except Exception as e:
+                logger.error(f"Claiming workflow actions failed: {str(e)}")
+
+            try:
+                if time.monotonic() - self._last_renewal >= self.lease_seconds / 3:
+                    self._renew_leases()
+            except Exception as e:
+                logger.error(f"Lease renewal failed: {str(e)}")
+
+            self._wakeup.clear()
+            now = time.monotonic()
+            timeout = min(
+                self.refresh_seconds - (now - self._last_refresh),
+                self.lease_seconds / 3 - (now - self._last_renewal),
+            )
+            if self._heap and not self._claim_needed:
+                timeout = min(timeout, self._heap[0][0] - time.time())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(timeout, 0.01))
+            except asyncio.TimeoutError:
+                pass
+
+    def _pop_due(self):
+        """Drop due heap entries; any live one means there is work to claim"""
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            due_at, action_id = heapq.heappop(self._heap)
+            if self._scheduled.get(action_id) != due_at:
+                continue  # superseded by a newer entry
+            del self._scheduled[action_id]
+            self._claim_needed = True
+
+    async def _claim_due(self):
+        while self._claim_needed and not self._stopping:
+            capacity = self.max_concurrency - len(self._claimed)
+            if capacity <= 0:
+                return  # a finishing worker asks again
+            limit = min(capacity, self.claim_batch_size)
+
+            rows = self.engine.claim_actions(self.worker_id, limit, self.lease_seconds)
+            for row in rows:
+                self._scheduled.pop(row['id'], None)
+                self._claimed[row['id']] = row
+                self._queue.put_nowait(row)
+
+            if len(rows) < limit:
+                # Nothing else is due right now
+                self._claim_needed = False
+
+    def _renew_leases(self):
+        self._last_renewal = time.monotonic()
+        if self._claimed:
+            self.engine.renew_action_leases(self.worker_id, list(self._claimed), self.lease_seconds)
+
+    async def _worker(self):
+        while True:
+            action = await self._queue.get()
+            try:
+                await self.engine.run_claimed_action(action)
+            except Exception as e:
+                logger.error(f"Workflow action {action['id']} failed: {str(e)}")
+            finally:
+                self._claimed.pop(action['id'], None)
+                if action.get('action_type') == 'wait':
+                    # The wait pushed later actions back; track their new times
+                    try:
+                        await self.enqueue_execution(action['execution_id'])
+                    except Exception as e:
+                        logger.error(f"Rescheduling execution {action['execution_id']} failed: {str(e)}")
+                # The next action of this execution may be due now
+                self.request_claim()
+
+
+# =============================================
+# INITIALIZE SCHEDULER
+# =============================================
+workflow_scheduler = WorkflowScheduler()
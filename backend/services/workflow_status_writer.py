@@ -0,0 +1,160 @@
+# =============================================
+# WORKFLOW STATUS WRITER
+# Coalesces workflow_actions / workflow_executions updates
+# and flushes them in one apply_workflow_status_updates call
+# =============================================
+from typing import Any, Callable, Dict, List, Optional
+import asyncio
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Commits arriving within this window share one flush (group commit)
+STATUS_FLUSH_INTERVAL_SECONDS = float(os.getenv("WORKFLOW_STATUS_FLUSH_INTERVAL_SECONDS", "0.05"))
+STATUS_FLUSH_MAX_ROWS = int(os.getenv("WORKFLOW_STATUS_FLUSH_MAX_ROWS", "200"))
+# A failed flush is retried after flush_interval * 2^failures, capped here
+STATUS_FLUSH_RETRY_MAX_SECONDS = float(os.getenv("WORKFLOW_STATUS_FLUSH_RETRY_MAX_SECONDS", "30"))
+
+# Execution counters are sent as increments, never absolute values
+COUNTER_FIELDS = ('completed_delta', 'failed_delta')
+
+
+class WorkflowStatusWriter:
+    """
+    Buffers status transitions per row and writes them in batches.
+
+    update_action / update_execution merge fields into the pending row, so
+    an action's running -> external ids -> completed transitions become a
+    single row in the next flush. count_action keeps per-execution counters
+    in memory; the RPC adds them to the stored counts and completes the
+    execution once every action is accounted for.
+
+    commit() returns once the caller's updates are durable. Commits that
+    arrive within STATUS_FLUSH_INTERVAL_SECONDS share the same flush. A
+    failed flush keeps its rows and schedules a retry with backoff, so they
+    are written even if no further commit() comes along.
+    """
+
+    def __init__(
+        self,
+        get_client: Callable[[], Any],
+        flush_interval: float = STATUS_FLUSH_INTERVAL_SECONDS,
+        max_rows: int = STATUS_FLUSH_MAX_ROWS,
+    ):
+        self._get_client = get_client
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+
+        self._actions: Dict[str, Dict] = {}
+        self._executions: Dict[str, Dict] = {}
+        self._waiters: List[asyncio.Future] = []
+        self._timer: Optional[asyncio.Task] = None
+        self._failures = 0
+        self.flushes = 0
+        self.rows_written = 0
+
+    # =============================================
+    # BUFFERING
+    # =============================================
+
+    def update_action(self, action_id: str, **fields):
+        self._actions.setdefault(action_id, {'id': action_id}).update(fields)
+
+    def update_execution(self, execution_id: str, **fields):
+        self._executions.setdefault(execution_id, {'id': execution_id}).update(fields)
+
+    def count_action(self, execution_id: str, status: str):
+        """Record a finished action against its execution's counters"""
+        row = self._executions.setdefault(execution_id, {'id': execution_id})
+        field = 'completed_delta' if status == 'completed' else 'failed_delta'
+        row[field] = row.get(field, 0) + 1
+
+    def pending_rows(self) -> int:
+        return len(self._actions) + len(self._executions)
+
+    # =============================================
+    # FLUSHING
+    # =============================================
+
+    async def commit(self):
+        """Wait until everything buffered so far has been written"""
+        if not self.pending_rows() and not self._waiters:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+
+        if self.pending_rows() >= self.max_rows:
+            self.flush()
+        elif self._timer is None or self._timer.done():
+            self._timer = asyncio.create_task(self._flush_later())
+        await waiter
+
+    async def _flush_later(self, delay: Optional[float] = None):
+        await asyncio.sleep(self.flush_interval if delay is None else delay)
+        self.flush()
+
+    def _schedule_retry(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # flushed outside the event loop; the next commit() retries
+        self._failures += 1
+        delay = min(STATUS_FLUSH_RETRY_MAX_SECONDS, self.flush_interval * 2 ** self._failures)
+        self._timer = loop.create_task(self._flush_later(delay))
+
+    def flush(self) -> List[str]:
+        """Write all buffered rows now; returns the executions that completed"""
+        actions, self._actions = self._actions, {}
+        executions, self._executions = self._executions, {}
+        waiters, self._waiters = self._waiters, []
+        if not actions and not executions:
+            self._resolve(waiters)
+            return []
+
+        try:
+            result = self._get_client().rpc('apply_workflow_status_updates', {
+                'p_actions': list(actions.values()),
+                'p_executions': list(executions.values())
+            }).execute()
+        except Exception as e:
+            logger.error(f"Workflow status flush failed: {str(e)}")
+            self._requeue(actions, executions)
+            self._schedule_retry()
+            self._resolve(waiters, e)
+            return []
+
+        self._failures = 0
+        self.flushes += 1
+        self.rows_written += len(actions) + len(executions)
+        # SETOF uuid comes back as bare values (older PostgREST wraps them)
+        completed = [
+            next(iter(row.values())) if isinstance(row, dict) else row
+            for row in (result.data or []) if row
+        ]
+        for execution_id in completed:
+            logger.info(f"Workflow execution {execution_id} completed")
+        self._resolve(waiters)
+        return completed
+
+    def _requeue(self, actions: Dict[str, Dict], executions: Dict[str, Dict]):
+        """Put a failed batch back underneath any newer updates"""
+        for action_id, row in actions.items():
+            self._actions[action_id] = {**row, **self._actions.get(action_id, {})}
+        for execution_id, row in executions.items():
+            newer = self._executions.get(execution_id, {})
+            merged = {**row, **newer}
+            for field in COUNTER_FIELDS:
+                if field in row or field in newer:
+                    merged[field] = row.get(field, 0) + newer.get(field, 0)
+            self._executions[execution_id] = merged
+
+    @staticmethod
+    def _resolve(waiters: List[asyncio.Future], error: Optional[Exception] = None):
+        for waiter in waiters:
+            if waiter.done():
+                continue
+            if error is None:
+                waiter.set_result(None)
+            else:
+                waiter.set_exception(error)
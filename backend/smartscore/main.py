@@ -9,9 +9,11 @@ Score formula:
 """
 from __future__ import annotations
 
+import asyncio
 import json
 import logging
 import os
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone
 from typing import Any
 
@@ -25,19 +27,52 @@ from pydantic import BaseModel
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Tharaga SmartScore", version="1.0.0")
-app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
-
 SUPABASE_URL = os.getenv("SUPABASE_URL", "")
 SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY", "")
 MODEL_PATH = os.getenv("MODEL_PATH", "/app/model.pkl")
 
+# Batch scoring: lead ids per `id=in.(...)` round-trip, and how many chunks run at once
+SCORE_BATCH_CHUNK_SIZE = int(os.getenv("SCORE_BATCH_CHUNK_SIZE", "200"))
+SCORE_MAX_CONCURRENCY = int(os.getenv("SCORE_MAX_CONCURRENCY", "4"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+SIGNALS_PER_LEAD = 50
+
 SUPABASE_HEADERS = {
     "apikey": SUPABASE_SERVICE_ROLE_KEY,
     "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}",
     "Content-Type": "application/json",
 }
 
+# App-lifetime pooled client (keep-alive) shared by every request
+_http_client: httpx.AsyncClient | None = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Lazily create the shared pooled HTTP client."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            timeout=15,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+                keepalive_expiry=60,
+            ),
+        )
+    return _http_client
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    get_http_client()
+    yield
+    if _http_client is not None:
+        await _http_client.aclose()
+
+
+app = FastAPI(title="Tharaga SmartScore", version="1.0.0", lifespan=lifespan)
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+
 # Load model if available
 _model = None
 try:
@@ -124,11 +159,66 @@ def _intent_score(purpose: str | None, loan_required: bool | None, source: str |
     return min(score, 15), intent_label
 
 
-def rule_based_score(lead: dict, signals: list[dict]) -> dict:
-    """Calculate SmartScore using rule-based system."""
+# Columnar signal encoding for batch scoring; any other signal type is -1
+SIGNAL_TYPE_CODES = {"scroll_depth": 0, "property_view": 1, "cta_click": 2, "time_on_page": 3, "exit": 4}
+_SCROLL, _VIEW, _CLICK, _TIME_ON_PAGE, _EXIT = range(5)
+
+
+def signals_to_columns(signals_per_lead: list[list[dict]]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Flatten per-lead signal lists into (lead index, signal type code, value) arrays."""
+    lead_index: list[int] = []
+    codes: list[int] = []
+    values: list[float] = []
+    for i, signals in enumerate(signals_per_lead):
+        for s in signals:
+            code = SIGNAL_TYPE_CODES.get(s.get("signal_type"), -1)
+            signal_value = s.get("signal_value", {})
+            if code == _SCROLL:
+                value = signal_value.get("percent", 0)
+            elif code in (_TIME_ON_PAGE, _EXIT):
+                value = signal_value.get("seconds", 0)
+            else:
+                value = 0
+            lead_index.append(i)
+            codes.append(code)
+            values.append(value)
+    return (
+        np.asarray(lead_index, dtype=np.intp),
+        np.asarray(codes, dtype=np.int8),
+        np.asarray(values, dtype=np.float64),
+    )
+
+
+def behavioral_scores(n_leads: int, lead_index: np.ndarray, codes: np.ndarray, values: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Vectorized _behavioral_score for many leads at once.
+
+    Returns (scores, labels, signal_counts), one entry per lead.
+    """
+    is_scroll = codes == _SCROLL
+    is_time = (codes == _TIME_ON_PAGE) | (codes == _EXIT)
+
+    max_scroll = np.full(n_leads, -np.inf)
+    np.maximum.at(max_scroll, lead_index[is_scroll], values[is_scroll])
+    max_scroll[np.isneginf(max_scroll)] = 0
+
+    property_views = np.bincount(lead_index[codes == _VIEW], minlength=n_leads)
+    cta_clicks = np.bincount(lead_index[codes == _CLICK], minlength=n_leads)
+    time_count = np.bincount(lead_index[is_time], minlength=n_leads)
+    time_total = np.bincount(lead_index[is_time], weights=values[is_time], minlength=n_leads)
+    avg_time = time_total / np.maximum(time_count, 1)
+
+    score = np.minimum(np.trunc(max_scroll / 100 * 10), 10).astype(np.int64)
+    score += np.minimum(property_views * 3, 8)
+    score += np.minimum(cta_clicks * 2, 4)
+    score += np.where(avg_time > 120, 3, np.where(avg_time > 30, 1, 0))
+
+    labels = np.where(score >= 20, "high", np.where(score >= 10, "medium", "low"))
+    return np.minimum(score, 25), labels, np.bincount(lead_index, minlength=n_leads)
+
+
+def _assemble_score(lead: dict, beh_s: int, beh_label: str, signal_count: int) -> dict:
     bs, budget_label = _budget_score(lead.get("budget"))
     ts, timeline_label = _timeline_score(lead.get("timeline_months"))
-    beh_s, beh_label = _behavioral_score(signals)
     int_s, intent_label = _intent_score(lead.get("purpose"), lead.get("loan_required"), lead.get("source"))
 
     total = bs + ts + beh_s + int_s
@@ -141,12 +231,30 @@ def rule_based_score(lead: dict, signals: list[dict]) -> dict:
         "score_breakdown": {
             "budget": {"score": bs, "max": 30, "label": budget_label, "value_lakhs": lead.get("budget")},
             "timeline": {"score": ts, "max": 30, "label": timeline_label, "months": lead.get("timeline_months")},
-            "behavioral": {"score": beh_s, "max": 25, "label": beh_label, "signal_count": len(signals)},
+            "behavioral": {"score": beh_s, "max": 25, "label": beh_label, "signal_count": signal_count},
             "intent": {"score": int_s, "max": 15, "label": intent_label, "purpose": lead.get("purpose")},
         },
     }
 
 
+def rule_based_score(lead: dict, signals: list[dict]) -> dict:
+    """Calculate SmartScore using rule-based system."""
+    beh_s, beh_label = _behavioral_score(signals)
+    return _assemble_score(lead, beh_s, beh_label, len(signals))
+
+
+def rule_based_score_batch(leads: list[dict], lead_index: np.ndarray, codes: np.ndarray, values: np.ndarray) -> list[dict]:
+    """Calculate rule-based SmartScores for many leads from columnar signals.
+
+    `lead_index` positions refer to `leads`; see signals_to_columns.
+    """
+    scores, labels, counts = behavioral_scores(len(leads), lead_index, codes, values)
+    return [
+        _assemble_score(lead, int(scores[i]), str(labels[i]), int(counts[i]))
+        for i, lead in enumerate(leads)
+    ]
+
+
 def ml_score(lead: dict, signals: list[dict]) -> dict | None:
     """Use trained ML model if available."""
     if not _model:
@@ -173,62 +281,122 @@ def health():
     return {"status": "ok", "model": "ml" if _model else "rule_based", "time": datetime.now(timezone.utc).isoformat()}
 
 
-@app.post("/score", response_model=ScoreResponse)
-async def score_lead(req: ScoreRequest) -> ScoreResponse:
-    """Score a lead by fetching data from Supabase."""
-    async with httpx.AsyncClient(timeout=15) as client:
-        # Fetch lead
-        lead_resp = await client.get(
-            f"{SUPABASE_URL}/rest/v1/leads",
-            headers=SUPABASE_HEADERS,
-            params={"id": f"eq.{req.lead_id}", "select": "*", "limit": "1"},
-        )
-        leads = lead_resp.json()
-        if not leads or not isinstance(leads, list):
-            return ScoreResponse(lead_id=req.lead_id, smartscore=0, classification="dog",
-                                 score_breakdown={}, scored_at=datetime.now(timezone.utc).isoformat())
+def _in_filter(values: list[str]) -> str:
+    return "in.(" + ",".join(values) + ")"
 
-        lead = leads[0]
 
-        # Fetch behavioral signals for this session
-        session_id = None
-        sig_resp = await client.get(
-            f"{SUPABASE_URL}/rest/v1/behavioral_signals",
+async def _fetch_leads(client: httpx.AsyncClient, lead_ids: list[str]) -> dict[str, dict]:
+    """Fetch all leads of a chunk in one round-trip, keyed by id."""
+    resp = await client.get(
+        f"{SUPABASE_URL}/rest/v1/leads",
+        headers=SUPABASE_HEADERS,
+        params={"id": _in_filter(lead_ids), "select": "*"},
+    )
+    rows = resp.json()
+    if not isinstance(rows, list):
+        logger.warning("Lead fetch failed: %s", rows)
+        return {}
+    return {row["id"]: row for row in rows}
+
+
+async def _fetch_signals(client: httpx.AsyncClient, lead_ids: list[str]) -> dict[str, list[dict]]:
+    """Fetch the newest SIGNALS_PER_LEAD signals of every lead in a chunk (sql/smartscore_batch_io.sql)."""
+    resp = await client.post(
+        f"{SUPABASE_URL}/rest/v1/rpc/lead_recent_signals",
+        headers=SUPABASE_HEADERS,
+        json={"p_lead_ids": lead_ids, "p_per_lead": SIGNALS_PER_LEAD},
+    )
+    by_lead = resp.json()
+    grouped: dict[str, list[dict]] = {lid: [] for lid in lead_ids}
+    if resp.status_code >= 300 or not isinstance(by_lead, dict):
+        logger.warning("Signal fetch failed: %s", by_lead)
+        return grouped
+    for lead_id, rows in by_lead.items():
+        if lead_id in grouped:
+            grouped[lead_id] = rows[:SIGNALS_PER_LEAD]
+    return grouped
+
+
+async def _score_chunk(client: httpx.AsyncClient, lead_ids: list[str]) -> list[ScoreResponse]:
+    """Score a chunk of leads: two bulk reads, in-memory scoring, one bulk update."""
+    leads, signals = await asyncio.gather(
+        _fetch_leads(client, lead_ids),
+        _fetch_signals(client, lead_ids),
+    )
+    now = datetime.now(timezone.utc).isoformat()
+
+    # Score: try ML first, fallback to rule-based (vectorized over the whole chunk)
+    results: dict[str, dict] = {}
+    for lead_id, lead in leads.items():
+        result = ml_score(lead, signals.get(lead_id, []))
+        if result:
+            results[lead_id] = result
+    rule_ids = [lid for lid in leads if lid not in results]
+    if rule_ids:
+        columns = signals_to_columns([signals.get(lid, []) for lid in rule_ids])
+        rule_results = rule_based_score_batch([leads[lid] for lid in rule_ids], *columns)
+        results.update(zip(rule_ids, rule_results))
+
+    responses: list[ScoreResponse] = []
+    updates: list[dict] = []
+    for lead_id in lead_ids:
+        result = results.get(lead_id)
+        if not result:
+            responses.append(ScoreResponse(lead_id=lead_id, smartscore=0, classification="dog",
+                                           score_breakdown={}, scored_at=now))
+            continue
+
+        updates.append({
+            "id": lead_id,
+            "smartscore": result["smartscore"],
+            "classification": result["classification"],
+            "score_breakdown": result["score_breakdown"],
+            "updated_at": now,
+        })
+        responses.append(ScoreResponse(
+            lead_id=lead_id,
+            smartscore=result["smartscore"],
+            classification=result["classification"],
+            score_breakdown=result["score_breakdown"],
+            scored_at=now,
+        ))
+
+    # Persist scores back to leads table (UPDATE of existing rows, never an insert)
+    if updates:
+        resp = await client.post(
+            f"{SUPABASE_URL}/rest/v1/rpc/apply_lead_scores",
             headers=SUPABASE_HEADERS,
-            params={"lead_id": f"eq.{req.lead_id}", "select": "*", "limit": "50"},
+            json={"p_scores": updates},
         )
-        signals = sig_resp.json() if isinstance(sig_resp.json(), list) else []
+        if resp.status_code >= 300:
+            logger.warning("Score write-back failed (%s): %s", resp.status_code, resp.text)
 
-        # Score: try ML first, fallback to rule-based
-        result = ml_score(lead, signals) or rule_based_score(lead, signals)
+    return responses
 
-        # Persist scores back to leads table
-        await client.patch(
-            f"{SUPABASE_URL}/rest/v1/leads?id=eq.{req.lead_id}",
-            headers=SUPABASE_HEADERS,
-            json={
-                "smartscore": result["smartscore"],
-                "classification": result["classification"],
-                "score_breakdown": result["score_breakdown"],
-                "updated_at": datetime.now(timezone.utc).isoformat(),
-            },
-        )
 
-    return ScoreResponse(
-        lead_id=req.lead_id,
-        smartscore=result["smartscore"],
-        classification=result["classification"],
-        score_breakdown=result["score_breakdown"],
-        scored_at=datetime.now(timezone.utc).isoformat(),
-    )
+@app.post("/score", response_model=ScoreResponse)
+async def score_lead(req: ScoreRequest) -> ScoreResponse:
+    """Score a lead by fetching data from Supabase."""
+    results = await _score_chunk(get_http_client(), [req.lead_id])
+    return results[0]
 
 
 @app.post("/score/batch")
 async def score_batch(lead_ids: list[str]) -> list[ScoreResponse]:
     """Score multiple leads (called by cron or N8N)."""
-    import asyncio
-    results = await asyncio.gather(*[score_lead(ScoreRequest(lead_id=lid)) for lid in lead_ids])
-    return list(results)
+    unique_ids = list(dict.fromkeys(lead_ids))
+    chunks = [unique_ids[i:i + SCORE_BATCH_CHUNK_SIZE] for i in range(0, len(unique_ids), SCORE_BATCH_CHUNK_SIZE)]
+    client = get_http_client()
+    semaphore = asyncio.Semaphore(SCORE_MAX_CONCURRENCY)
+
+    async def run(chunk: list[str]) -> list[ScoreResponse]:
+        async with semaphore:
+            return await _score_chunk(client, chunk)
+
+    scored: dict[str, ScoreResponse] = {}
+    for chunk_results in await asyncio.gather(*[run(chunk) for chunk in chunks]):
+        scored.update({r.lead_id: r for r in chunk_results})
+    return [scored[lid] for lid in lead_ids]
 
 
 if __name__ == "__main__":
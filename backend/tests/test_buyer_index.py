@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import random
+
+import app.ai.buyer_index as buyer_index
+from app.ai.buyer_index import BuyerPreferenceIndex
+
+
+LISTING = {"location": "Anna Nagar", "city": "Chennai", "property_type": "Apartment", "bedrooms": 2, "price": 8_000_000}
+
+
+def _buyer(index, buyer_id, profile=None, min_match_score=None, **prefs):
+    index.upsert_buyer(buyer_id, "profile", {"user_id": buyer_id, "preferences": profile or {}})
+    if prefs:
+        index.upsert_buyer(buyer_id, "preferences", {"user_id": buyer_id, **prefs})
+    if min_match_score is not None:
+        index.upsert_buyer(buyer_id, "match", {"buyer_id": buyer_id, "active": True, "min_match_score": min_match_score})
+
+
+def _rpc_score(listing, prefs, profile, behavior):
+    """match_buyers_for_listing's score, transcribed (behavior: (properties_viewed, searched_locations))"""
+    price, budget_min, budget_max = listing.get("price"), prefs.get("budget_min"), prefs.get("budget_max")
+    if budget_max is None or price is None:
+        budget = 50
+    elif (budget_min or 0) <= price <= budget_max:
+        budget = 100
+    elif price < (budget_min or 0):
+        budget = max(0, 100 - (budget_min - price) / budget_min * 100)
+    else:
+        budget = max(0, 100 - (price - budget_max) / budget_max * 100) if budget_max else 0
+
+    viewed, searched = behavior
+    preferred = prefs.get("preferred_location")
+    location_value = listing.get("location")
+    if preferred is None and searched is None:
+        location = 50
+    elif preferred is not None and location_value == preferred:  # NULL never equals in SQL
+        location = 100
+    elif preferred is not None and listing.get("locality") == preferred:
+        location = 90
+    elif preferred is not None and listing.get("city") == preferred:
+        location = 70
+    elif searched is not None and location_value is not None and (searched in location_value or location_value in searched):
+        location = 80
+    else:
+        location = 30
+
+    wanted, listing_type = prefs.get("preferred_property_type"), listing.get("property_type")
+    if wanted is None:
+        property_type = 50
+    elif listing_type == wanted:
+        property_type = 100
+    elif listing_type is not None and wanted.lower() in listing_type.lower():
+        property_type = 80
+    else:
+        property_type = 20
+
+    bedrooms, low = listing.get("bedrooms"), profile.get("min_bedrooms")
+    high = profile.get("max_bedrooms", 10)
+    if bedrooms is None:
+        size = 50
+    elif low is None:
+        size = 70
+    elif low <= bedrooms <= high:
+        size = 100
+    elif bedrooms < low:
+        size = max(0, 100 - (low - bedrooms) * 20)
+    else:
+        size = max(0, 100 - (bedrooms - high) * 15)
+
+    amenity = 70 if viewed else 50
+    timing = {"immediate": 100, "within_3_months": 80, "within_6_months": 60}.get(profile.get("buying_urgency"), 40)
+    return budget * 0.25 + location * 0.25 + property_type * 0.20 + size * 0.15 + amenity * 0.10 + timing * 0.05
+
+
+def test_candidates_keep_near_misses_the_rpc_still_accepts():
+    index = BuyerPreferenceIndex()
+    keen = {"min_bedrooms": 2, "max_bedrooms": 3, "buying_urgency": "immediate"}
+    exact = dict(preferred_location="Anna Nagar", preferred_property_type="Apartment",
+                 budget_min=7_000_000, budget_max=9_000_000)
+    _buyer(index, "exact", keen, **exact)
+    _buyer(index, "wrong-type", keen, **{**exact, "preferred_property_type": "Villa"})           # ~81
+    _buyer(index, "wrong-location", keen, **{**exact, "preferred_location": "Coimbatore"})       # ~79.5
+    _buyer(index, "over-budget", keen, **{**exact, "budget_min": 1_000_000, "budget_max": 3_000_000})  # ~72
+    _buyer(index, "picky", keen, min_match_score=90, **{**exact, "preferred_property_type": "Villa"})
+    _buyer(index, "no-prefs")
+    _buyer(index, "no-prefs-lenient", min_match_score=50)
+    # Preferences without a buyer profile are not candidates
+    index.upsert_buyer("not-a-buyer", "preferences", {"user_id": "not-a-buyer"})
+
+    assert index.candidates(LISTING) == {"exact", "wrong-type", "wrong-location", "over-budget", "no-prefs-lenient"}
+    assert len(index) == 7
+
+
+def test_candidates_are_a_superset_of_rpc_matches():
+    rng = random.Random(38)
+    locations = [None, "Anna Nagar", "anna nagar", "Adyar", "Chennai", "Velachery"]
+    types = [None, "Apartment", "apartment", "Villa", "Independent Villa", "Plot"]
+    index = BuyerPreferenceIndex()
+    buyers = {}
+    for n in range(400):
+        prefs = {"preferred_location": rng.choice(locations), "preferred_property_type": rng.choice(types),
+                 "budget_min": rng.choice([None, 2_000_000, 6_000_000]),
+                 "budget_max": rng.choice([None, 5_000_000, 9_000_000, 20_000_000])}
+        profile = {key: value for key, value in {
+            "min_bedrooms": rng.choice([None, 1, 2, 3, 4]), "max_bedrooms": rng.choice([None, 2, 3]),
+            "buying_urgency": rng.choice([None, "immediate", "within_3_months", "within_6_months"]),
+        }.items() if value is not None}
+        threshold = rng.choice([40, 55, 70, 80])
+        _buyer(index, f"b{n}", profile, min_match_score=threshold, **prefs)
+        buyers[f"b{n}"] = (prefs, profile, threshold)
+
+    for _ in range(60):
+        listing = {"location": rng.choice(locations[1:]), "locality": rng.choice([None, "Adyar"]),
+                   "city": "Chennai", "property_type": rng.choice(types[1:] + [None]),
+                   "bedrooms": rng.choice([None, 1, 2, 3, 5]),
+                   "price": rng.choice([None, 4_000_000, 8_000_000, rng.uniform(500_000, 40_000_000)])}
+        candidates = index.candidates(listing)
+        for buyer_id, (prefs, profile, threshold) in buyers.items():
+            best = max(_rpc_score(listing, prefs, profile, behavior)
+                       for behavior in [(0, None), (3, None), (3, listing["location"]), (3, "Tambaram")])
+            if best >= threshold:
+                assert buyer_id in candidates, (listing, prefs, profile, threshold, best)
+        assert len(candidates) < len(buyers)
+
+
+def test_lookup_only_touches_buyers_the_listing_can_reach():
+    index = BuyerPreferenceIndex()
+    far = {"min_bedrooms": 4, "buying_urgency": "immediate"}
+    for n in range(500):
+        # Another city, another type and a budget nowhere near the listing
+        _buyer(index, f"far{n}", far, preferred_location="Coimbatore", preferred_property_type="Villa",
+               budget_min=1_000_000, budget_max=2_000_000 + n * 1000)
+    _buyer(index, "local", preferred_location="Anna Nagar", budget_max=3_000_000)
+    _buyer(index, "in-budget", far, preferred_location="Coimbatore", preferred_property_type="Villa",
+           budget_min=7_000_000, budget_max=9_000_000)
+    _buyer(index, "lenient", min_match_score=40, preferred_location="Madurai", budget_max=1_000_000)
+
+    assert index._lookup(LISTING) == {"local", "in-budget", "lenient"}
+    assert index.candidates(LISTING) == {"in-budget", "lenient"}  # local is far over budget
+    assert index._lookup(dict(LISTING, price=None)) == {"local", "lenient"}
+
+
+def test_index_tracks_preference_changes_incrementally():
+    index = BuyerPreferenceIndex()
+    _buyer(index, "b1", min_match_score=75, preferred_location="Coimbatore", budget_max=3_000_000)
+    assert index.candidates(LISTING) == set()
+
+    index.upsert_buyer("b1", "preferences", {"user_id": "b1", "preferred_location": "Anna Nagar", "budget_max": 8_500_000})
+    assert index.candidates(LISTING) == {"b1"}
+    assert index.locations.postings == {"Anna Nagar": {"b1"}}
+
+    index.upsert_buyer("b1", "match", {"buyer_id": "b1", "active": False})
+    assert index.candidates(LISTING) == set() and len(index) == 0
+
+    index.upsert_buyer("b1", "match", {"buyer_id": "b1", "active": True})
+    index.remove_buyer("b1")
+    assert index.candidates(LISTING) == set()
+    assert index.locations.postings == {} and index.property_types.postings == {}
+    assert index.budgets.nodes == {}
+
+
+class FakeQuery:
+    def __init__(self, client, table):
+        self.client, self.table, self.since, self.bounds = client, table, None, None
+
+    def select(self, _columns):
+        return self
+
+    def gte(self, _column, value):
+        self.since = value
+        return self
+
+    def order(self, _column):
+        return self
+
+    def range(self, start, end):
+        self.bounds = (start, end)
+        return self
+
+    def execute(self):
+        self.client.queries.append((self.table, self.since, self.bounds))
+        rows = [r for r in self.client.rows.get(self.table, []) if self.since is None or r["updated_at"] >= self.since]
+        start, end = self.bounds
+        return type("Result", (), {"data": rows[start:end + 1]})()
+
+
+class FakeSupabase:
+    def __init__(self, rows):
+        self.rows, self.queries = rows, []
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+
+def test_sync_pages_full_load_then_reads_only_changed_rows(monkeypatch):
+    monkeypatch.setattr(buyer_index, "BUYER_INDEX_PAGE_SIZE", 2)
+    profiles = [{"user_id": f"b{i}", "preferences": {}, "updated_at": f"2026-01-0{i}"} for i in range(1, 4)]
+    supabase = FakeSupabase({"buyer_profiles": profiles})
+    index = BuyerPreferenceIndex(refresh_seconds=0)
+
+    index.ensure_fresh(supabase)
+    assert len(index) == 3
+    assert [q for q in supabase.queries if q[0] == "buyer_profiles"] == [
+        ("buyer_profiles", None, (0, 1)), ("buyer_profiles", None, (2, 3)),
+    ]
+
+    supabase.queries.clear()
+    supabase.rows["buyer_match_preferences"] = [{"buyer_id": "b2", "active": False, "updated_at": "2026-01-05"}]
+    index.ensure_fresh(supabase)
+    assert ("buyer_profiles", "2026-01-03", (0, 1)) in supabase.queries
+    assert "b2" not in index.candidates(dict(LISTING, price=None))
+    assert len(index) == 2
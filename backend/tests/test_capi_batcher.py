@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import app.lead_outbox as lead_outbox
+import app.routes.capi as capi
+from app.routes.capi import CAPIBatcher, CAPIEventPayload
+
+
+@pytest.fixture
+def meta(monkeypatch):
+    monkeypatch.setattr(capi, "META_ACCESS_TOKEN", "token")
+    monkeypatch.setattr(capi, "META_PIXEL_ID", "pixel")
+    monkeypatch.setattr(capi, "SUPABASE_URL", "https://db.test")
+    requests: list[httpx.Request] = []
+    state = {"status": 200}
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        status = state["status"] if request.method == "POST" else 200
+        return httpx.Response(status, json={})
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler)), requests, state
+
+
+def _payload(n, event_name="Lead", lead_id=None):
+    return CAPIEventPayload(event_name=event_name, event_id=f"e{n}", email=f"u{n}@test.in",
+                            city="Chennai", lead_id=lead_id)
+
+
+def test_events_flush_in_one_request_with_coalesced_flag_updates(meta):
+    client, requests, _ = meta
+    batcher = CAPIBatcher(max_wait_seconds=0.01, client=client)
+
+    async def scenario():
+        return await asyncio.gather(
+            batcher.send(_payload(1, lead_id="l1")),
+            batcher.send(_payload(2, lead_id="l2")),
+            batcher.send(_payload(1, lead_id="l1")),  # same event queued twice
+            batcher.send(_payload(3, event_name="Purchase", lead_id="l1")),
+            batcher.send(_payload(4, event_name="ViewContent")),
+        )
+
+    results = asyncio.run(scenario())
+
+    assert [r["status"] for r in results] == ["fired"] * 5
+    posts = [r for r in requests if r.method == "POST"]
+    assert len(posts) == 1
+    events = json.loads(posts[0].content)["data"]
+    assert [e["event_id"] for e in events] == ["e1", "e2", "e3", "e4"]
+    assert events[0]["user_data"]["ct"] == events[1]["user_data"]["ct"]
+    patches = {r.url.params["id"]: json.loads(r.content) for r in requests if r.method == "PATCH"}
+    assert patches == {"in.(l1,l2)": {"capi_lead_fired": True}, "in.(l1)": {"capi_purchase_fired": True}}
+
+
+def test_full_batch_flushes_immediately_and_sent_events_are_deduplicated(meta):
+    client, requests, _ = meta
+    batcher = CAPIBatcher(max_events=2, max_wait_seconds=60, client=client)
+
+    async def scenario():
+        first = await asyncio.gather(batcher.send(_payload(1)), batcher.send(_payload(2)))
+        again = await batcher.send(_payload(1))
+        return first, again
+
+    first, again = asyncio.run(scenario())
+
+    assert [r["status"] for r in first] == ["fired", "fired"]
+    assert again["status"] == "duplicate"
+    assert len(requests) == 1
+
+
+def test_failed_batch_reports_errors_and_can_be_resent(meta):
+    client, requests, state = meta
+    batcher = CAPIBatcher(max_wait_seconds=0.01, client=client)
+    state["status"] = 500
+
+    async def scenario():
+        failed = await batcher.send(_payload(1, lead_id="l1"))
+        state["status"] = 200
+        return failed, await batcher.send(_payload(1, lead_id="l1"))
+
+    failed, retried = asyncio.run(scenario())
+
+    assert failed["status"] == "error" and retried["status"] == "fired"
+    assert [r.method for r in requests] == ["POST", "POST", "PATCH"]
+
+
+def test_rejected_batch_is_split_until_only_the_invalid_event_fails(monkeypatch):
+    monkeypatch.setattr(capi, "META_ACCESS_TOKEN", "token")
+    monkeypatch.setattr(capi, "META_PIXEL_ID", "pixel")
+    monkeypatch.setattr(capi, "SUPABASE_URL", "https://db.test")
+    posted: list[list[str]] = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if request.method != "POST":
+            return httpx.Response(200, json={})
+        ids = [e["event_id"] for e in json.loads(request.content)["data"]]
+        posted.append(ids)
+        if "e3" in ids:
+            return httpx.Response(400, json={"error": {"message": "Invalid parameter"}})
+        return httpx.Response(200, json={"events_received": len(ids)})
+
+    batcher = CAPIBatcher(max_wait_seconds=0.01, client=httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+
+    async def scenario():
+        return await asyncio.gather(*(batcher.send(_payload(n)) for n in range(1, 6)))
+
+    results = asyncio.run(scenario())
+
+    assert [r["status"] for r in results] == ["fired", "fired", "error", "fired", "fired"]
+    assert posted[0] == ["e1", "e2", "e3", "e4", "e5"] and ["e3"] in posted
+    assert sum(len(ids) for ids in posted if "e3" not in ids) == 4  # every valid event sent once
+
+
+def test_lead_outbox_queues_lead_events_on_the_batcher(meta, monkeypatch):
+    client, requests, _ = meta
+    monkeypatch.setattr(capi, "capi_batcher", CAPIBatcher(max_wait_seconds=0.01, client=client))
+    leads = [{"id": "l1", "phone_hash": "h1", "budget": 50}, {"id": "l2", "event_id": "px-2"}]
+
+    handled = asyncio.run(lead_outbox.send_capi_leads(client, leads))
+
+    assert handled == {"l1", "l2"}
+    events = json.loads(requests[0].content)["data"]
+    assert [e["event_id"] for e in events] == ["l1", "px-2"] and events[0]["user_data"] == {"ph": ["h1"]}
+    assert requests[1].url.params["id"] == "in.(l1,l2)"
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import asyncio
+import json
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+import app.routes.distribution as distribution
+
+
+@pytest.fixture
+def supabase(monkeypatch):
+    calls: list[tuple[str, dict]] = []
+    state = {"response": None}
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        calls.append((request.url.path, json.loads(request.content or b"null")))
+        response = state["responses"].pop(0) if state.get("responses") else state["response"]
+        return httpx.Response(200, content=json.dumps(response).encode())
+
+    real_client = httpx.AsyncClient
+    monkeypatch.setattr(distribution.httpx, "AsyncClient",
+                        lambda **kwargs: real_client(transport=httpx.MockTransport(handler), **kwargs))
+    monkeypatch.setattr(distribution, "SUPABASE_URL", "https://db.test")
+    monkeypatch.setattr(distribution, "distribution_stats_cache", distribution.DistributionStats())
+    alerts: list[tuple] = []
+
+    async def record_alert(phone, message):
+        alerts.append((phone, message))
+
+    monkeypatch.setattr(distribution, "_send_whatsapp_alert", record_alert)
+    return calls, state, alerts
+
+
+def test_assignment_is_one_rpc_round_trip(supabase):
+    calls, state, alerts = supabase
+    state["response"] = {
+        "lead": {"id": "l1", "name": "Priya", "phone": "+919876543210", "budget": 90},
+        "classification": "lion",
+        "assignment_type": "sales_exec",
+        "assigned_to": "e1",
+        "assignee_phone": "+919000000001",
+        "sla_deadline": "2026-01-01T10:15:00+00:00",
+    }
+
+    async def scenario():
+        result = await distribution.distribute_lead_internal("l1")
+        await asyncio.sleep(0)
+        return result
+
+    result = asyncio.run(scenario())
+
+    assert calls == [("/rest/v1/rpc/assign_lead", {
+        "p_lead_id": "l1", "p_sla_minutes": distribution.SLA_MINUTES, "p_force_reassign": False,
+    })]
+    assert result == {
+        "lead_id": "l1", "assigned_to": "e1", "assignment_type": "sales_exec",
+        "classification": "lion", "sla_deadline": "2026-01-01T10:15:00+00:00",
+    }
+    assert alerts and alerts[0][0] == "+919000000001" and "Priya" in alerts[0][1]
+
+
+def test_missing_lead_is_404_and_no_assignee_skips_alerts(supabase):
+    calls, state, alerts = supabase
+
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(distribution.distribute_lead_internal("missing"))
+    assert exc.value.status_code == 404
+
+    state["response"] = {"lead": {"id": "l2"}, "classification": "dog", "assignment_type": "channel_partner",
+                         "assigned_to": None, "sla_deadline": "2026-01-01T18:00:00+00:00"}
+    result = asyncio.run(distribution.distribute_lead_internal("l2", force_reassign=True))
+
+    assert calls[-1][1]["p_force_reassign"] is True
+    assert result["assigned_to"] is None and result["assignment_type"] == "channel_partner"
+    assert alerts == []
+
+
+
+def test_sla_sweep_pages_batches_and_alerts_lion_reassignments(supabase, monkeypatch):
+    calls, state, alerts = supabase
+    monkeypatch.setattr(distribution, "SLA_SWEEP_BATCH_SIZE", 2)
+    state["responses"] = [
+        [
+            {"lead": {"id": "l1", "name": "Priya"}, "classification": "lion",
+             "assigned_to": "e2", "assignee_phone": "+919000000002"},
+            {"lead": {"id": "l2"}, "classification": "monkey", "assigned_to": "e3",
+             "assignee_phone": "+919000000003"},
+        ],
+        [{"lead": {"id": "l3"}, "classification": "lion", "assigned_to": None}],
+    ]
+
+    result = asyncio.run(distribution.sweep_sla_breaches())
+
+    # Full first batch -> asks again; short second batch -> done
+    assert [path for path, _ in calls] == ["/rest/v1/rpc/sweep_sla_breaches"] * 2
+    assert calls[0][1] == {"p_limit": 2, "p_sla_minutes": distribution.SLA_MINUTES,
+                           "p_max_overdue_hours": distribution.SLA_SWEEP_MAX_OVERDUE_HOURS}
+    assert result == {"breached": 3, "reassigned": 2}
+    # Only the lion that found a new exec is alerted
+    assert [phone for phone, _ in alerts] == ["+919000000002"]
+
+
+def test_stats_are_reconciled_once_then_updated_in_memory(supabase):
+    calls, state, alerts = supabase
+    state["responses"] = [{
+        "pipeline": {"lion_count": 4, "monkey_count": 10, "dog_count": 30},
+        "sales_team": [{"id": "e1", "name": "Asha", "leads_handled": 7, "conversion_rate": 0.4}],
+        "assignees": {"e1": 2, "p1": 5},
+        "sla": {"open": 7, "breaches_24h": 1},
+    }]
+    first = asyncio.run(distribution.distribution_stats())
+    assert calls == [("/rest/v1/rpc/distribution_stats", {})]
+    assert first["pipeline"]["lion_count"] == 4 and first["reconciled_at"] is not None
+
+    stats = distribution.distribution_stats_cache
+    # New lion lead to e1
+    stats.record_assignment({"lead": {"id": "l1", "assigned_to": None, "status": "new"},
+                             "classification": "lion", "assigned_to": "e1"})
+    # SLA breach moves an open dog lead from p1 to p2
+    stats.record_breaches(1)
+    stats.record_assignment({"lead": {"id": "l2", "assigned_to": "p1", "status": "new"},
+                             "classification": "dog", "assigned_to": "p2"})
+    # Nobody could take it: nothing changes
+    stats.record_assignment({"lead": {"id": "l3"}, "classification": "monkey", "assigned_to": None})
+
+    snapshot = asyncio.run(distribution.distribution_stats())
+    assert len(calls) == 1  # served from memory
+    assert snapshot["pipeline"] == {"lion_count": 5, "monkey_count": 10, "dog_count": 30}
+    assert snapshot["sales_team"][0]["leads_handled"] == 8
+    assert snapshot["assignees"] == {"e1": 3, "p1": 4, "p2": 1}
+    assert snapshot["sla"] == {"open": 8, "breaches_24h": 2}
+
+
+def test_no_assignee_while_assignees_exist_is_retryable(supabase):
+    calls, state, alerts = supabase
+    state["response"] = {"lead": {"id": "l3"}, "classification": "monkey", "assignment_type": "sales_exec",
+                         "assigned_to": None, "assignees_available": True,
+                         "sla_deadline": "2026-01-01T12:00:00+00:00"}
+
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(distribution.distribute_lead_internal("l3"))
+
+    assert exc.value.status_code == 503
+    assert alerts == []
@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+import asyncio
+import importlib
+import sys
+import types
+
+import pytest
+
+
+class Query:
+    def __init__(self, client, table):
+        self.client, self.table = client, table
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+    def insert(self, rows):
+        self.client.inserted.extend(rows)
+        return self
+
+    def execute(self):
+        if self.table == "properties":
+            return types.SimpleNamespace(data={"id": "p1", "listing_status": "active", "is_verified": True})
+        return types.SimpleNamespace(data=None)
+
+
+class FakeSupabase:
+    def __init__(self, matches):
+        self.matches = matches
+        self.inserted: list[dict] = []
+
+    def table(self, name):
+        return Query(self, name)
+
+    def rpc(self, name, params):
+        assert name == "match_buyers_for_listing"
+        return types.SimpleNamespace(execute=lambda: types.SimpleNamespace(data=self.matches))
+
+
+class FakeFanout:
+    """Reaches every buyer except b2"""
+
+    def __init__(self, render=None):
+        self.delivered: set[str] = set()
+
+    async def send(self, buyers):
+        self.delivered = {b["buyer_id"] for b in buyers if b["buyer_id"] != "b2"}
+        return {"email": {"sent": len(self.delivered), "failed": len(buyers) - len(self.delivered)}}
+
+
+@pytest.fixture
+def engine_module(monkeypatch):
+    monkeypatch.setitem(sys.modules, "anthropic", types.ModuleType("anthropic"))
+    module = importlib.import_module("app.ai.distribution_engine")
+    monkeypatch.setattr(module, "NotificationFanout", FakeFanout)
+    monkeypatch.setattr(module.buyer_preference_index, "ensure_fresh", lambda client: None)
+    monkeypatch.setattr(module.buyer_preference_index, "candidates", lambda listing: {"b1", "b2", "b3"})
+    return module
+
+
+def _match(buyer_id, score, frequency="instant"):
+    return {"buyer_id": buyer_id, "buyer_email": f"{buyer_id}@test.in", "match_score": score,
+            "match_factors": {}, "preferred_channels": ["email"], "notification_frequency": frequency}
+
+
+def test_only_delivered_instant_buyers_are_recorded_as_sent(engine_module):
+    engine = object.__new__(engine_module.SmartDistributionEngine)
+    engine.supabase = FakeSupabase([_match("b1", 90), _match("b2", 80), _match("b3", 70, "daily_digest")])
+
+    result = asyncio.run(engine.distribute_listing("p1"))
+
+    assert result["success"] and result["instant_sent"] == 1 and result["instant_failed"] == 1
+    records = {r["buyer_id"]: r for r in engine.supabase.inserted}
+    assert records["b1"]["conversion_status"] == "sent" and records["b1"]["sent_at"]
+    assert records["b2"]["conversion_status"] == "failed" and records["b2"]["sent_at"] is None
+    assert records["b3"]["conversion_status"] == "queued" and records["b3"]["sent_at"] is None
@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+import asyncio
+import json
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import app.routes.leads as leads
+
+
+@pytest.fixture
+def bulk(monkeypatch):
+    lookups: list[str] = []
+    inserts: list[list[dict]] = []
+    existing = {"+919000000002"}
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if request.method == "GET":
+            lookups.append(request.url.params["phone_normalized"])
+            phones = request.url.params["phone_normalized"][len("in.("):-1].split(",")
+            return httpx.Response(200, json=[{"phone_normalized": p} for p in phones if p in existing])
+        assert request.url.path == "/rest/v1/rpc/insert_leads_with_outbox"
+        rows = json.loads(request.content)["p_leads"]
+        inserts.append(rows)
+        return httpx.Response(201, json=rows)
+
+    real_client = httpx.AsyncClient
+    monkeypatch.setattr(leads.httpx, "AsyncClient",
+                        lambda **kwargs: real_client(transport=httpx.MockTransport(handler), **kwargs))
+    monkeypatch.setattr(leads, "SUPABASE_URL", "https://db.test")
+    monkeypatch.setattr(leads, "BULK_INGEST_CHUNK_SIZE", 2)
+    wakes: list[int] = []
+    monkeypatch.setattr(leads, "lead_outbox_dispatcher", type("Dispatcher", (), {"wake": lambda self: wakes.append(1)})())
+    app = FastAPI()
+    app.include_router(leads.router)
+    return TestClient(app), lookups, inserts, wakes
+
+
+def test_csv_is_chunked_and_deduplicated(bulk):
+    client, lookups, inserts, wakes = bulk
+    body = (
+        "name,phone,email,budget,notes\n"
+        "Priya,98765 43210,priya@test.in,120,vip\n"
+        'Arun,+91 9000000002,,,"met at\n expo"\n'      # already a lead
+        "Priya again,9876543210,,,\n"                    # duplicate within the file
+        "Bad,12345,,,\n"
+        "Meena,919000000003,,45,\n"
+        "Ravi,9000000004,,,\n"
+    )
+
+    def stream():
+        for start in range(0, len(body), 7):
+            yield body[start:start + 7].encode()
+
+    resp = client.post("/api/leads/ingest/bulk", content=stream(), headers={"content-type": "text/csv"})
+
+    assert resp.status_code == 200
+    result = resp.json()
+    assert {k: result[k] for k in ("rows", "created", "deduplicated", "invalid")} == \
+        {"rows": 6, "created": 3, "deduplicated": 2, "invalid": 1}
+    assert result["errors"][0]["row"] == 4
+
+    # One lookup per chunk of two unique phones
+    assert lookups == ["in.(+919876543210,+919000000002)", "in.(+919000000003,+919000000004)"]
+    assert [[r["phone_normalized"] for r in chunk] for chunk in inserts] == \
+        [["+919876543210"], ["+919000000003", "+919000000004"]]
+    assert inserts[0][0]["smartscore"] == 36 and inserts[0][0]["email"] == "priya@test.in"
+    # Follow-up work is in the outbox rows; the dispatcher is just nudged
+    assert len(wakes) == 2
+
+
+def test_ndjson_reports_unparseable_lines(bulk):
+    client, lookups, inserts, wakes = bulk
+    body = b'{"name": "A", "phone": "9000000011"}\nnot json\n[1]\n\n{"name": "B", "phone": "9000000012"}'
+
+    resp = client.post("/api/leads/ingest/bulk?format=ndjson", content=body)
+
+    result = resp.json()
+    assert result["created"] == 2 and result["invalid"] == 2
+    assert [e["row"] for e in result["errors"]] == [2, 3]
+
+
+def test_stream_lines_handles_split_multibyte_characters():
+    async def chunks():
+        data = "₹1\nदो\n".encode()
+        for i in range(len(data)):
+            yield data[i:i + 1]
+
+    async def collect():
+        return [line async for line in leads._stream_lines(chunks())]
+
+    assert asyncio.run(collect()) == ["₹1\n", "दो\n"]
@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import app.routes.leads as leads
+from app.lead_dedup import PhoneDedupIndex
+
+RealAsyncClient = httpx.AsyncClient
+
+
+def test_bloom_filter_has_no_false_negatives_and_few_false_positives():
+    index = PhoneDedupIndex(capacity=10_000, error_rate=0.01)
+    assert index.might_contain("anything")  # not warmed: ask the DB
+
+    added = [leads.sha256(f"+9190000{i:05d}") for i in range(10_000)]
+    index.load(added)
+    index.mark_ready()
+
+    assert all(index.might_contain(h) for h in added)
+    others = [leads.sha256(f"+9180000{i:05d}") for i in range(10_000)]
+    false_positives = sum(index.might_contain(h) for h in others)
+    assert false_positives < 300
+
+
+@pytest.fixture
+def supabase(monkeypatch):
+    requests: list[httpx.Request] = []
+    state = {"insert": None, "existing": []}
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if request.method == "GET":
+            return httpx.Response(200, json=state["existing"])
+        rows = json.loads(request.content)["p_leads"]
+        return httpx.Response(200, json=rows if state["insert"] is None else state["insert"])
+
+    monkeypatch.setattr(leads.httpx, "AsyncClient",
+                        lambda **kwargs: RealAsyncClient(transport=httpx.MockTransport(handler), **kwargs))
+    monkeypatch.setattr(leads, "SUPABASE_URL", "https://db.test")
+    index = PhoneDedupIndex(capacity=1000)
+    index.mark_ready()
+    monkeypatch.setattr(leads, "phone_dedup_index", index)
+    monkeypatch.setattr(leads, "lead_outbox_dispatcher", type("Dispatcher", (), {"wake": lambda self: None})())
+    return requests, state, index
+
+
+def _ingest(phone):
+    payload = leads.LeadIngestPayload(name="Priya", phone=phone)
+    return asyncio.run(leads.ingest_lead(payload))
+
+
+def test_definitely_new_phone_skips_the_lookup(supabase):
+    requests, state, index = supabase
+
+    result = _ingest("9876543210")
+
+    assert result.status == "created"
+    assert [r.method for r in requests] == ["POST"]
+    assert requests[0].url.path == "/rest/v1/rpc/insert_leads_with_outbox"
+    assert index.might_contain(leads.sha256("+919876543210"))
+
+    # Now a possible duplicate: checked against the DB
+    state["existing"] = [{"id": "lead-1", "smartscore": 40, "classification": "monkey"}]
+    again = _ingest("+91 98765 43210")
+    assert again.status == "deduplicated" and again.lead_id == "lead-1"
+    assert [r.method for r in requests] == ["POST", "GET"]
+
+
+def test_unique_index_catches_phones_the_filter_missed(supabase):
+    requests, state, index = supabase
+    state["insert"] = []  # another writer got there first
+    state["existing"] = [{"id": "lead-9", "smartscore": 10, "classification": "dog"}]
+
+    result = _ingest("9000000009")
+
+    assert result.status == "deduplicated" and result.lead_id == "lead-9"
+    assert [r.method for r in requests] == ["POST", "GET"]
+
+
+def test_warm_pages_by_id_and_hashes_rows_without_phone_hash(supabase, monkeypatch):
+    requests, state, _ = supabase
+    monkeypatch.setattr(leads, "LEAD_DEDUP_WARM_PAGE_SIZE", 2)
+    index = PhoneDedupIndex(capacity=1000)
+    monkeypatch.setattr(leads, "phone_dedup_index", index)
+    pages = [
+        [{"id": "a", "phone_hash": leads.sha256("+919000000001")},
+         {"id": "b", "phone_hash": None, "phone_normalized": "+919000000002"}],
+        [{"id": "c", "phone_hash": leads.sha256("+919000000003")}],
+    ]
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(200, json=pages.pop(0))
+
+    monkeypatch.setattr(leads.httpx, "AsyncClient",
+                        lambda **kwargs: RealAsyncClient(transport=httpx.MockTransport(handler), **kwargs))
+
+    asyncio.run(leads.warm_phone_dedup_index())
+
+    assert index.ready and index.count == 3
+    assert "id" not in requests[0].url.params and requests[1].url.params["id"] == "gt.b"
+    assert index.might_contain(leads.sha256("+919000000002"))
@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import app.lead_outbox as lead_outbox
+from app.lead_outbox import LeadOutboxDispatcher
+
+
+@pytest.fixture(autouse=True)
+def supabase_url(monkeypatch):
+    monkeypatch.setattr(lead_outbox, "SUPABASE_URL", "https://db.test")
+
+
+def _row(n, completed=(), attempts=0):
+    return {"id": f"o{n}", "lead_id": f"l{n}", "attempts": attempts, "completed_steps": list(completed),
+            "payload": {"id": f"l{n}", "phone_hash": f"h{n}", "budget": 50}}
+
+
+def _supabase(claims):
+    applied: list[list[dict]] = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path.endswith("/rpc/claim_lead_outbox"):
+            return httpx.Response(200, json=claims.pop(0) if claims else [])
+        applied.append(json.loads(request.content)["p_results"])
+        return httpx.Response(200, json=len(applied[-1]))
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler)), applied
+
+
+def test_steps_run_batch_wide_and_failures_retry_only_what_is_left():
+    calls: dict[str, list[list[str]]] = {"capi": [], "score": [], "distribute": []}
+
+    def step(name, fail=()):
+        async def run(client, leads):
+            ids = [lead["id"] for lead in leads]
+            calls[name].append(ids)
+            return set(ids) - set(fail)
+        return run
+
+    client, applied = _supabase([[_row(1), _row(2), _row(3, completed=["score"])]])
+    dispatcher = LeadOutboxDispatcher(
+        steps={"capi": step("capi"), "score": step("score", fail={"l2"}), "distribute": step("distribute")},
+        client=client,
+    )
+
+    assert asyncio.run(dispatcher.drain_once()) == 3
+
+    # l2 is not distributed without a score; l3 only had its CAPI event left
+    assert calls == {"capi": [["l1", "l2", "l3"]], "score": [["l1", "l2"]], "distribute": [["l1", "l3"]]}
+    results = {r["id"]: r for r in applied[0]}
+    assert results["o1"]["status"] == "done" and results["o3"]["status"] == "done"
+    assert results["o2"]["status"] == "pending" and results["o2"]["attempts"] == 1
+    assert results["o2"]["completed_steps"] == ["capi"] and results["o2"]["last_error"] == "score failed"
+    assert results["o2"]["next_attempt_at"]
+
+
+def test_capi_failure_does_not_hold_back_scoring_or_distribution():
+    distributed: list[str] = []
+
+    async def capi_down(client, leads):
+        raise httpx.ConnectError("graph.facebook.com unreachable")
+
+    async def score(client, leads):
+        return {lead["id"] for lead in leads}
+
+    async def distribute(client, leads):
+        distributed.extend(lead["id"] for lead in leads)
+        return {lead["id"] for lead in leads}
+
+    client, applied = _supabase([[_row(1)]])
+    dispatcher = LeadOutboxDispatcher(steps={"capi": capi_down, "score": score, "distribute": distribute},
+                                      client=client)
+
+    asyncio.run(dispatcher.drain_once())
+
+    assert distributed == ["l1"]
+    [result] = applied[0]
+    assert result["status"] == "pending" and result["completed_steps"] == ["score", "distribute"]
+    assert result["last_error"] == "capi failed"
+
+
+def test_step_exception_dead_letters_at_the_attempt_limit():
+    async def ok(client, leads):
+        return {lead["id"] for lead in leads}
+
+    async def boom(client, leads):
+        raise RuntimeError("assign_lead unavailable")
+
+    client, applied = _supabase([[_row(1, completed=["capi", "score"], attempts=2)]])
+    dispatcher = LeadOutboxDispatcher(steps={"capi": ok, "score": ok, "distribute": boom},
+                                      client=client, max_attempts=3)
+
+    asyncio.run(dispatcher.drain_once())
+
+    assert applied == [[{"id": "o1", "status": "dead", "attempts": 3,
+                         "completed_steps": ["capi", "score"], "last_error": "distribute failed"}]]
+    assert dispatcher.dead == 1
+
+
+
+def test_lease_outlasts_every_step_of_a_batch():
+    assert lead_outbox.LEAD_OUTBOX_LEASE_SECONDS > sum(lead_outbox.LEAD_OUTBOX_STEP_TIMEOUTS.values())
+
+
+def test_distribute_skips_leads_an_earlier_attempt_already_assigned(monkeypatch):
+    import app.routes.distribution as distribution
+
+    distributed: list[str] = []
+
+    async def distribute_lead_internal(lead_id):
+        distributed.append(lead_id)
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        assert request.url.params["id"] == "in.(l1,l2)"
+        return httpx.Response(200, json=[{"id": "l1", "assigned_to": "e1"}, {"id": "l2", "assigned_to": None}])
+
+    monkeypatch.setattr(distribution, "distribute_lead_internal", distribute_lead_internal)
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    done = asyncio.run(lead_outbox.distribute_leads(client, [{"id": "l1"}, {"id": "l2"}]))
+
+    assert distributed == ["l2"] and done == {"l1", "l2"}
@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import asyncio
+import json
+
+import httpx
+
+import app.ai.notification_fanout as fanout_module
+from app.ai.listing_digest import render_digest, send_listing_digests
+from app.ai.notification_fanout import NotificationFanout
+from services.outbound_messaging import OutboundMessenger
+
+
+def _row(n, buyer, score, status="active", channels=("email",)):
+    return {
+        "distribution_id": f"d{n}",
+        "buyer_id": buyer,
+        "listing_id": f"p{n}",
+        "match_score": score,
+        "buyer_email": f"{buyer}@test.in",
+        "buyer_phone": "+919000000000",
+        "preferred_channels": list(channels),
+        "listing": {"title": f"Listing {n}", "price": 5_000_000, "bedrooms": 2, "city": "Chennai", "listing_status": status},
+    }
+
+
+class FakeQuery:
+    def __init__(self, client):
+        self.client = client
+
+    def update(self, values):
+        self.values = values
+        return self
+
+    def in_(self, _column, ids):
+        self.client.updates.append((self.values["conversion_status"], sorted(ids)))
+        return self
+
+    def execute(self):
+        if hasattr(self, "claim"):
+            return type("Result", (), {"data": self.client.batches.pop(0) if self.client.batches else []})()
+        return type("Result", (), {"data": []})()
+
+
+class FakeSupabase:
+    def __init__(self, batches):
+        self.batches, self.updates, self.claims = batches, [], []
+
+    def rpc(self, name, params):
+        self.claims.append((name, params))
+        query = FakeQuery(self)
+        query.claim = True
+        return query
+
+    def table(self, _name):
+        return FakeQuery(self)
+
+
+def test_render_digest_ranks_and_truncates():
+    rows = [_row(i, "b", score) for i, score in enumerate([72, 95, 80])]
+    content = render_digest(rows, max_listings=2)
+
+    assert content["subject"] == "🏠 3 new property matches for you today"
+    body = content["body"]
+    assert body.index("Listing 1") < body.index("Listing 2")
+    assert "Listing 0" not in body and "...and 1 more" in body
+
+
+def test_digest_sends_one_message_per_buyer_and_marks_rows(monkeypatch):
+    requests: list[httpx.Request] = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(500 if b"b3@test.in" in request.content else 200)
+
+    monkeypatch.setattr(fanout_module, "RESEND_API_KEY", None)
+    monkeypatch.setattr(fanout_module, "outbound_messenger", OutboundMessenger(rate_limits={}, max_attempts=1))
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    supabase = FakeSupabase([[
+        _row(1, "b1", 90), _row(2, "b1", 75), _row(3, "b1", 88),
+        _row(4, "b2", 70, status="sold"), _row(5, "b2", 81),
+        _row(6, "b3", 99),
+    ]])
+    summary = asyncio.run(send_listing_digests(supabase, fanout=NotificationFanout(client=client), buyers_per_claim=3))
+
+    # Three claims' worth of buyers came back, so the job asks once more
+    assert [params["p_buyer_limit"] for _, params in supabase.claims] == [3, 3]
+    assert len(requests) == 3
+    by_recipient = {json.loads(r.content)["to"]: json.loads(r.content) for r in requests}
+    assert by_recipient["b1@test.in"]["subject"].startswith("🏠 3 new")
+    assert by_recipient["b2@test.in"]["subject"].startswith("🏠 1 new property match ")
+
+    assert ("expired", ["d4"]) in supabase.updates
+    assert ("sent", ["d1", "d2", "d3", "d5"]) in supabase.updates
+    # b3's send failed: its row stays claimed for a later run
+    assert not any("d6" in ids for _, ids in supabase.updates)
+    assert summary["listings_rolled_up"] == 5 and summary["messages_sent"] == 2
+    assert summary["buyers_failed"] == 1 and summary["expired"] == 1
@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import asyncio
+import json
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import app.routes.leads as leads
+from services.webhook_inbox import RecentKeys
+
+RealAsyncClient = httpx.AsyncClient
+
+
+def _change(leadgen_id, field="leadgen"):
+    return {"field": field, "value": {"leadgen_id": leadgen_id}}
+
+
+def _meta_lead(name, phone=None):
+    fields = [{"name": "full_name", "values": [name]}]
+    if phone:
+        fields.append({"name": "phone_number", "values": [phone]})
+    return {"field_data": fields}
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(leads, "_recent_leadgen_ids", RecentKeys(ttl_seconds=3600))
+    monkeypatch.setattr(leads, "SUPABASE_URL", "https://db.test")
+    monkeypatch.setattr(leads, "META_ACCESS_TOKEN", "token")
+    monkeypatch.setattr(leads, "lead_outbox_dispatcher", type("Dispatcher", (), {"wake": lambda self: None})())
+
+
+def test_webhook_coalesces_leadgen_ids_and_skips_redeliveries(monkeypatch):
+    batches: list[list[str]] = []
+
+    async def record(leadgen_ids):
+        batches.append(leadgen_ids)
+
+    monkeypatch.setattr(leads, "_ingest_meta_leads", record)
+    app = FastAPI()
+    app.include_router(leads.router)
+    client = TestClient(app)
+    body = {"entry": [
+        {"changes": [_change("111"), _change("222"), _change("999", field="feed")]},
+        {"changes": [_change("111"), _change("333")]},
+    ]}
+
+    first = client.post("/api/leads/meta-webhook", json=body)
+    again = client.post("/api/leads/meta-webhook", json=body)
+
+    assert first.json() == {"status": "ok", "leads_queued": 3}
+    assert again.json() == {"status": "ok", "leads_queued": 0}
+    assert batches == [["111", "222", "333"]]
+
+
+def test_leadgen_batch_is_fetched_once_and_bulk_inserted(monkeypatch):
+    requests: list[httpx.Request] = []
+    inserted: list[list[dict]] = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if request.url.host == "graph.facebook.com":
+            return httpx.Response(200, json={
+                "222": _meta_lead("Priya", "98765 43210"),
+                "333": _meta_lead("Arun"),                   # no phone
+                "444": _meta_lead("Priya M", "+919876543210"),  # same person, second form
+            })
+        if request.method == "GET" and "event_id" in request.url.params:
+            return httpx.Response(200, json=[{"event_id": "111"}])
+        if request.method == "GET":
+            return httpx.Response(200, json=[])
+        rows = json.loads(request.content)["p_leads"]
+        inserted.append(rows)
+        return httpx.Response(200, json=rows)
+
+    monkeypatch.setattr(leads.httpx, "AsyncClient",
+                        lambda **kwargs: RealAsyncClient(transport=httpx.MockTransport(handler), **kwargs))
+
+    asyncio.run(leads._ingest_meta_leads(["111", "222", "333", "444", "555"]))
+
+    graph = [r for r in requests if r.url.host == "graph.facebook.com"]
+    assert len(graph) == 1 and graph[0].url.params["ids"] == "222,333,444,555"
+    assert len(inserted) == 1
+    assert [(r["name"], r["phone_normalized"], r["event_id"]) for r in inserted[0]] == \
+        [("Priya", "+919876543210", "222")]
+    assert inserted[0][0]["source"] == "meta_lead_ads"
+    # 555 wasn't returned by Graph, so a redelivery may try it again
+    assert leads._recent_leadgen_ids.add("555")
@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import app.ai.notification_fanout as fanout_module
+from app.ai.notification_fanout import NotificationFanout, message_key
+from services.outbound_messaging import OutboundMessenger
+
+
+FACTORS = {"budget_match": 100, "location_match": 90, "size_match": 70, "timing_match": 40}
+
+
+def _buyer(i, score, channels, factors=FACTORS):
+    return {
+        "buyer_id": f"b{i}",
+        "buyer_email": f"b{i}@test.in",
+        "buyer_phone": f"+9190000000{i:02d}" if i % 5 else None,
+        "match_score": score,
+        "match_factors": factors,
+        "preferred_channels": channels,
+    }
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    requests: list[httpx.Request] = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(200, json={"ok": True})
+
+    monkeypatch.setattr(fanout_module, "outbound_messenger", OutboundMessenger(rate_limits={}))
+    monkeypatch.setattr(fanout_module, "_http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    return requests
+
+
+def test_message_key_bands_scores_and_top_reasons():
+    assert message_key(_buyer(1, 91.2, [])) == message_key(_buyer(2, 94.9, []))
+    assert message_key(_buyer(1, 91.2, [])) != message_key(_buyer(2, 95.0, []))
+    assert message_key(_buyer(1, 91.2, []))[1] == ("budget_match", "location_match", "size_match")
+
+
+def test_renders_once_per_band_and_batches_each_channel(sent, monkeypatch):
+    monkeypatch.setattr(fanout_module, "RESEND_API_KEY", "re_test")
+    buyers = [_buyer(i, 90 + (i % 3), ["email", "whatsapp"]) for i in range(1, 11)]
+    buyers += [_buyer(21 + i, 80, ["sms"], {"location_match": 100}) for i in range(3)]
+    rendered: list[float] = []
+    state = {"active": 0, "max_active": 0}
+
+    async def render(buyer):
+        state["active"] += 1
+        state["max_active"] = max(state["max_active"], state["active"])
+        await asyncio.sleep(0.01)
+        state["active"] -= 1
+        rendered.append(buyer["match_score"])
+        return {"subject": f"{buyer['match_score']:.0f}% match", "body": "x" * 300}
+
+    fanout = NotificationFanout(render, render_concurrency=1, batch_size=4)
+    stats = asyncio.run(fanout.send(buyers))
+
+    # Two message groups, each rendered once with its lowest score
+    assert sorted(rendered) == [80, 90]
+    assert state["max_active"] == 1
+
+    by_path: dict[str, list] = {}
+    for request in sent:
+        by_path.setdefault(request.url.path, []).append(json.loads(request.content))
+    emails = by_path["/emails/batch"]
+    assert sorted(len(batch) for batch in emails) == [2, 4, 4]
+    assert all(item["subject"] == "90% match" for batch in emails for item in batch)
+
+    bulk = by_path["/api/messaging/bulk"]
+    whatsapp = [b for b in bulk if b["type"] == "whatsapp"]
+    assert sum(len(b["recipients"]) for b in whatsapp) == 8
+    sms = [b for b in bulk if b["type"] == "sms"]
+    assert [len(b["message"]) for b in sms] == [160]
+
+    assert stats["email"]["sent"] == 10 and stats["email"]["requests"] == 3
+    # Buyers 5 and 10 have no phone number
+    assert stats["whatsapp"]["sent"] == 8 and stats["whatsapp"]["skipped"] == 2
+    assert stats["sms"]["sent"] == 3
+
+
+def test_email_falls_back_to_per_recipient_sends_without_resend_key(sent, monkeypatch):
+    monkeypatch.setattr(fanout_module, "RESEND_API_KEY", None)
+
+    async def render(buyer):
+        return {"subject": "s", "body": "b"}
+
+    stats = asyncio.run(NotificationFanout(render).send([_buyer(i, 90, ["email"]) for i in range(1, 4)]))
+
+    assert [r.url.path for r in sent] == ["/api/messaging/send"] * 3
+    assert stats["email"]["sent"] == 3 and stats["email"]["failed"] == 0
@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import services.outbound_messaging as outbound
+from services.outbound_messaging import OutboundMessenger, TokenBucket, is_retryable
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(outbound, "backoff_delay", lambda attempt: 0.01)
+
+
+def _response(status: int, **headers) -> httpx.Response:
+    return httpx.Response(status, headers=headers, request=httpx.Request("POST", "https://api.example.test"))
+
+
+def test_retries_rate_limited_and_server_errors_then_succeeds():
+    replies = [_response(429), _response(503), _response(201)]
+    calls = []
+
+    async def send():
+        calls.append(time.monotonic())
+        return replies[len(calls) - 1]
+
+    async def scenario():
+        return await OutboundMessenger(max_concurrency=2).send("twilio_whatsapp", "+1", send)
+
+    assert asyncio.run(scenario()).status_code == 201
+    assert len(calls) == 3
+
+
+def test_client_errors_are_returned_without_retry():
+    calls = []
+
+    async def send():
+        calls.append(1)
+        return _response(400)
+
+    async def scenario():
+        return await OutboundMessenger().send("resend", "noreply", send)
+
+    assert asyncio.run(scenario()).status_code == 400
+    assert calls == [1]
+
+
+def test_transport_errors_raise_after_max_attempts():
+    calls = []
+
+    async def send():
+        calls.append(1)
+        raise httpx.ConnectError("refused")
+
+    async def scenario():
+        await OutboundMessenger(max_attempts=3).send("twilio_sms", "+1", send)
+
+    with pytest.raises(httpx.ConnectError):
+        asyncio.run(scenario())
+    assert len(calls) == 3
+
+
+def test_sends_are_throttled_per_sender():
+    sent: dict[str, list[float]] = {"+1": [], "+2": []}
+
+    def sender(number):
+        async def send():
+            sent[number].append(time.monotonic())
+            return _response(201)
+        return send
+
+    async def scenario():
+        messenger = OutboundMessenger(max_concurrency=10, rate_limits={"twilio_sms": (20.0, 1)})
+        await asyncio.gather(*(messenger.send("twilio_sms", n, sender(n)) for n in ["+1", "+2"] * 4))
+
+    asyncio.run(scenario())
+    for times in sent.values():
+        assert len(times) == 4
+        # 4 sends at 20/s with a burst of 1 need at least 3 token intervals
+        assert times[-1] - times[0] >= 0.14
+
+
+def test_retryable_classification():
+    assert is_retryable(_response(429))
+    assert is_retryable(_response(500))
+    assert not is_retryable(_response(404))
+    assert is_retryable(httpx.ReadTimeout("slow"))
+    assert not is_retryable(ValueError("bad template"))
+
+
+def test_bucket_pause_blocks_acquire():
+    async def scenario():
+        bucket = TokenBucket(rate=100, burst=5)
+        bucket.pause(0.05)
+        start = time.monotonic()
+        await bucket.acquire()
+        return time.monotonic() - start
+
+    assert asyncio.run(scenario()) >= 0.045
+
+
+def test_cancelled_callers_do_not_kill_workers():
+    async def slow():
+        await asyncio.sleep(0.05)
+        return _response(201)
+
+    async def fast():
+        return _response(201)
+
+    async def scenario():
+        messenger = OutboundMessenger(max_concurrency=1)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(messenger.send("resend", "noreply", slow), timeout=0.01)
+        await asyncio.sleep(0.06)  # the send finishes after its caller left
+        return await asyncio.wait_for(messenger.send("resend", "noreply", fast), timeout=1)
+
+    assert asyncio.run(scenario()).status_code == 201
+
+
+def test_throttled_sender_does_not_block_other_providers():
+    async def send():
+        return _response(201)
+
+    async def scenario():
+        messenger = OutboundMessenger(max_concurrency=1, rate_limits={"twilio_sms": (1.0, 1), "resend": (100.0, 10)})
+        slow = [asyncio.ensure_future(messenger.send("twilio_sms", "+1", send)) for _ in range(3)]
+        await asyncio.sleep(0)
+        start = time.monotonic()
+        await asyncio.wait_for(messenger.send("resend", "noreply", send), timeout=0.5)
+        elapsed = time.monotonic() - start
+        for task in slow:
+            task.cancel()
+        await asyncio.gather(*slow, return_exceptions=True)
+        return elapsed
+
+    assert asyncio.run(scenario()) < 0.2
@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import smartscore.main as smartscore
+
+
+@pytest.fixture(autouse=True)
+def supabase_url(monkeypatch):
+    monkeypatch.setattr(smartscore, "SUPABASE_URL", "https://db.test")
+    monkeypatch.setattr(smartscore, "_model", None)
+
+
+def test_chunk_reads_signals_per_lead_and_writes_scores_with_an_update():
+    requests: list[httpx.Request] = []
+    leads = [{"id": "l1", "budget": 150, "timeline_months": 1, "purpose": "self_use"},
+             {"id": "l2", "budget": 25, "timeline_months": 24}]
+    chatty = [{"lead_id": "l1", "signal_type": "page_view", "signal_value": {}}] * 80
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if request.url.path == "/rest/v1/leads":
+            return httpx.Response(200, json=leads)
+        if request.url.path == "/rest/v1/rpc/lead_recent_signals":
+            return httpx.Response(200, json={
+                "l1": chatty,
+                "l2": [{"lead_id": "l2", "signal_type": "cta_click", "signal_value": {}}],
+            })
+        return httpx.Response(200, json=2)
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    results = asyncio.run(smartscore._score_chunk(client, ["l1", "l2", "gone"]))
+
+    signals_req = next(r for r in requests if r.url.path.endswith("/lead_recent_signals"))
+    assert json.loads(signals_req.content) == {"p_lead_ids": ["l1", "l2", "gone"],
+                                               "p_per_lead": smartscore.SIGNALS_PER_LEAD}
+
+    write = requests[-1]
+    assert write.method == "POST" and write.url.path == "/rest/v1/rpc/apply_lead_scores"
+    assert "on_conflict" not in write.url.params
+    assert "resolution" not in write.headers.get("prefer", "")
+    scores = json.loads(write.content)["p_scores"]
+    assert [row["id"] for row in scores] == ["l1", "l2"]
+    assert set(scores[0]) == {"id", "smartscore", "classification", "score_breakdown", "updated_at"}
+
+    # l2's signal was scored even though l1 has more than a whole window of its own
+    assert results[1].score_breakdown["behavioral"]["signal_count"] == 1
+    assert results[0].score_breakdown["behavioral"]["signal_count"] == smartscore.SIGNALS_PER_LEAD
+    assert results[2].smartscore == 0
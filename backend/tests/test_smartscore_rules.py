@@ -0,0 +1,46 @@
+from __future__ import annotations
+
+import random
+
+from smartscore.main import rule_based_score, rule_based_score_batch, signals_to_columns
+
+
+SIGNAL_TYPES = ["scroll_depth", "property_view", "cta_click", "time_on_page", "exit", "page_view", "search"]
+
+
+def _random_signal(rng: random.Random) -> dict:
+    signal_type = rng.choice(SIGNAL_TYPES)
+    if signal_type == "scroll_depth":
+        value = {"percent": rng.choice([0, 15, 49.5, 73, 99, 100])}
+    elif signal_type in ("time_on_page", "exit"):
+        value = {"seconds": rng.choice([0, 12, 31, 90.5, 121, 600])}
+    else:
+        value = {}
+    return {"signal_type": signal_type, "signal_value": value}
+
+
+def _random_lead(rng: random.Random) -> dict:
+    return {
+        "budget": rng.choice([None, 0, 25, 45, 75, 150, 250]),
+        "timeline_months": rng.choice([None, 1, 3, 6, 12, 24]),
+        "purpose": rng.choice([None, "self_use", "investment", "rental"]),
+        "loan_required": rng.choice([None, True, False]),
+        "source": rng.choice([None, "meta_lead_ads", "organic", "whatsapp"]),
+    }
+
+
+def test_batch_matches_per_lead_scoring():
+    rng = random.Random(42)
+    leads = [_random_lead(rng) for _ in range(300)]
+    signals = [[_random_signal(rng) for _ in range(rng.randint(0, 40))] for _ in leads]
+
+    batch = rule_based_score_batch(leads, *signals_to_columns(signals))
+
+    assert batch == [rule_based_score(lead, sigs) for lead, sigs in zip(leads, signals)]
+
+
+def test_batch_handles_leads_without_signals():
+    leads = [{"budget": 120, "timeline_months": 2, "purpose": "self_use"}, {}]
+    batch = rule_based_score_batch(leads, *signals_to_columns([[], []]))
+    assert batch == [rule_based_score(leads[0], []), rule_based_score(leads[1], [])]
+    assert batch[1]["score_breakdown"]["behavioral"] == {"score": 0, "max": 25, "label": "low", "signal_count": 0}
@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+from services.template_renderer import CompiledTemplate, MessageTemplateCache, render_template
+
+
+LEAD = {
+    "id": 7,
+    "name": "Priya Raman",
+    "smartscore_v2": 82,
+    "priority_tier": "Hot",
+    "properties": {
+        "title": "Lakeview Residency",
+        "price_inr": 8500000,
+        "locality": "Velachery",
+        "bedrooms": 3,
+        "builders": {"name": "Casagrand"},
+    },
+}
+
+
+def test_renders_known_variables_and_keeps_unknown_ones():
+    template = "Hi {{first_name}}, {{property_title}} in {{location}} is {{property_price}} by {{builder_name}}. {{coupon}}"
+    assert render_template(template, LEAD) == (
+        "Hi Priya, Lakeview Residency in Velachery is ₹8,500,000 by Casagrand. {{coupon}}"
+    )
+
+
+def test_defaults_for_missing_related_rows():
+    assert render_template("{{lead_name}} / {{property_title}} / {{area_sqft}}", {"properties": None}) == (
+        "there / the property / N/A"
+    )
+
+
+def test_render_many_matches_render():
+    compiled = CompiledTemplate("{{first_name}} scored {{smartscore}} ({{priority_tier}})")
+    leads = [LEAD, {"name": "Arun", "score": 40}, {}]
+    assert compiled.render_many(leads) == [compiled.render(lead) for lead in leads]
+    assert CompiledTemplate("no slots").render_many(leads) == ["no slots"] * 3
+
+
+class FakeQuery:
+    def __init__(self, client, columns):
+        self.client, self.columns, self.ids = client, columns, []
+
+    def select(self, columns):
+        return FakeQuery(self.client, columns)
+
+    def in_(self, _column, ids):
+        self.ids = ids
+        return self
+
+    def execute(self):
+        self.client.queries.append(self.columns)
+        rows = [row for row in self.client.rows.values() if row["id"] in self.ids]
+        return type("Result", (), {"data": [dict(r) for r in rows]})()
+
+
+class FakeClient:
+    def __init__(self):
+        self.rows = {"t1": {"id": "t1", "body_template": "Hi {{first_name}}", "updated_at": "v1"}}
+        self.queries: list[str] = []
+
+    def table(self, _name):
+        return FakeQuery(self, None)
+
+
+def test_cache_revalidates_by_updated_at():
+    client = FakeClient()
+    cache = MessageTemplateCache(lambda: client, ttl_seconds=0)
+
+    assert cache.get("t1").body.render(LEAD) == "Hi Priya"
+    # Unchanged row: only updated_at is read back
+    assert cache.get("t1").body.render(LEAD) == "Hi Priya"
+    assert client.queries == ["*", "id, updated_at"]
+
+    client.rows["t1"].update(body_template="Hello {{lead_name}}", updated_at="v2")
+    assert cache.get("t1").body.render(LEAD) == "Hello Priya Raman"
+    assert cache.get("missing") is None
@@ -0,0 +1,39 @@
+from __future__ import annotations
+
+import numpy as np
+from sklearn.ensemble import GradientBoostingRegressor, RandomForestClassifier
+
+from services.tree_compiler import (
+    CompiledForestClassifier,
+    CompiledGradientBoostingRegressor,
+    compile_model,
+)
+
+
+rng = np.random.RandomState(7)
+X_train = rng.randn(400, 12)
+X_test = rng.randn(250, 12)
+
+
+def test_forest_classifier_parity():
+    y = np.array(["Cold", "Warm", "Hot"])[rng.randint(0, 3, len(X_train))]
+    model = RandomForestClassifier(n_estimators=40, max_depth=10, random_state=42).fit(X_train, y)
+    compiled = compile_model(model)
+    assert isinstance(compiled, CompiledForestClassifier)
+    np.testing.assert_array_equal(compiled.predict_proba(X_test), model.predict_proba(X_test))
+    np.testing.assert_array_equal(compiled.predict(X_test), model.predict(X_test))
+    np.testing.assert_array_equal(compiled.predict_proba(X_test[:1]), model.predict_proba(X_test[:1]))
+
+
+def test_gbm_regressor_parity():
+    y = X_train[:, 0] * 1e5 + X_train[:, 3] * 2e4 + rng.randn(len(X_train)) * 1e3
+    model = GradientBoostingRegressor(n_estimators=60, random_state=42).fit(X_train, y)
+    compiled = compile_model(model)
+    assert isinstance(compiled, CompiledGradientBoostingRegressor)
+    np.testing.assert_array_equal(compiled.predict(X_test), model.predict(X_test))
+    np.testing.assert_array_equal(compiled.predict(X_test[:1]), model.predict(X_test[:1]))
+
+
+def test_compile_unsupported_model_returns_none():
+    assert compile_model(None) is None
+    assert compile_model(object()) is None
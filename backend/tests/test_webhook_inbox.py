@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import hmac
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import services.webhook_manager as webhooks
+from services.webhook_inbox import WebhookInbox, idempotency_key
+
+
+class FakeQuery:
+    def __init__(self, client, name):
+        self.client, self.name = client, name
+        self.filters: list[tuple] = []
+
+    def upsert(self, rows, **kwargs):
+        if self.client.fail_upserts:
+            self.client.fail_upserts -= 1
+            raise RuntimeError("supabase unavailable")
+        self.client.upserts.append((rows, kwargs))
+        return self
+
+    def update(self, values):
+        self.filters.append(("update", values))
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(("eq", column, value))
+        return self
+
+    def in_(self, column, values):
+        self.filters.append(("in", column, list(values)))
+        self.client.updates.append(self.filters)
+        return self
+
+    def execute(self):
+        return type("Result", (), {"data": []})()
+
+
+class FakeSupabase:
+    def __init__(self):
+        self.upserts: list = []
+        self.updates: list = []
+        self.fail_upserts = 0
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    supabase = FakeSupabase()
+    inbox = WebhookInbox(get_client=lambda: supabase, flush_interval=3600)
+    monkeypatch.setattr(webhooks, "webhook_inbox", inbox)
+    app = FastAPI()
+    app.post("/receive/{provider}")(webhooks.receive_webhook)
+    return TestClient(app), inbox, supabase
+
+
+def test_receive_acks_without_touching_storage_and_drops_redeliveries(client):
+    http, inbox, supabase = client
+    headers = {"Idempotency-Key": "evt-1"}
+
+    first = http.post("/receive/razorpay", content=b'{"event": "paid"}', headers=headers)
+    again = http.post("/receive/razorpay", content=b'{"event": "paid"}', headers=headers)
+
+    assert first.status_code == 200 and first.json()["duplicate"] is False
+    assert again.json()["duplicate"] is True
+    assert supabase.upserts == []
+    assert inbox.stats() == {"buffered": 1, "accepted": 1, "duplicates": 1}
+
+
+def test_signature_is_checked_when_provider_secret_is_set(client, monkeypatch):
+    http, inbox, _ = client
+    monkeypatch.setenv("WEBHOOK_SECRET_RAZORPAY", "shh")
+    body = b'{"event": "paid"}'
+    good = hmac.new(b"shh", body, hashlib.sha256).hexdigest()
+
+    assert http.post("/receive/razorpay", content=body, headers={"X-Webhook-Signature": "bad"}).status_code == 401
+    assert http.post("/receive/razorpay", content=body, headers={"X-Webhook-Signature": f"sha256={good}"}).status_code == 200
+    assert inbox._buffer[0]["verified"] is True
+
+    # Unsigned providers are still accepted, just not marked verified
+    assert http.post("/receive/other", content=b"{}").status_code == 200
+    assert inbox._buffer[1]["verified"] is False
+
+    inbox.max_buffered = 2
+    assert http.post("/receive/other", content=b"[]").status_code == 503
+
+
+def test_flush_bulk_stores_batch_then_runs_handlers():
+    supabase = FakeSupabase()
+    supabase.fail_upserts = 1
+    inbox = WebhookInbox(get_client=lambda: supabase, max_rows=10)
+    seen: list[dict] = []
+
+    async def handler(receipt):
+        seen.append(receipt["payload"])
+        if receipt["payload"].get("boom"):
+            raise ValueError("boom")
+
+    inbox.register_handler("meta", handler)
+    bodies = [b'{"n": 1}', b'{"boom": true}', b"From=whatsapp%3A%2B91"]
+    for body in bodies:
+        inbox.accept("meta", body, idempotency_key("meta", {}, body), None, False)
+
+    async def scenario():
+        with pytest.raises(RuntimeError):
+            await inbox.flush()
+        # The failed batch is kept for the next flush
+        assert len(inbox._buffer) == 3
+        return await inbox.flush()
+
+    assert asyncio.run(scenario()) == 3
+
+    (rows, kwargs), = supabase.upserts
+    assert kwargs["on_conflict"] == "provider,idempotency_key" and kwargs["ignore_duplicates"]
+    assert [r["payload"] for r in rows] == [{"n": 1}, {"boom": True}, {"raw": "From=whatsapp%3A%2B91"}]
+    assert len(seen) == 3
+
+    # One processed update covering only the receipts whose handler succeeded
+    (update,) = supabase.updates
+    assert update[0] == ("update", {"processed": True})
+    assert update[-1] == ("in", "idempotency_key", [rows[0]["idempotency_key"], rows[2]["idempotency_key"]])
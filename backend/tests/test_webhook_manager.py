@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import hmac
+
+import httpx
+import pytest
+
+import services.webhook_manager as webhooks
+from services.webhook_outbox import SQLiteOutboxStore, WebhookOutboxDispatcher
+
+
+class FakeTable:
+    def __init__(self, client, name):
+        self.client, self.name = client, name
+
+    def select(self, _columns):
+        return self
+
+    def eq(self, _column, _value):
+        return self
+
+    def insert(self, rows):
+        self.client.inserted.setdefault(self.name, []).append(rows)
+        return self
+
+    def execute(self):
+        if self.name == "webhook_endpoints":
+            self.client.endpoint_reads += 1
+        data = self.client.endpoints if self.name == "webhook_endpoints" else []
+        return type("Result", (), {"data": data})()
+
+
+class FakeSupabase:
+    def __init__(self, endpoints):
+        self.endpoints = endpoints
+        self.endpoint_reads = 0
+        self.inserted: dict[str, list] = {}
+
+    def table(self, name):
+        return FakeTable(self, name)
+
+
+@pytest.fixture
+def setup(monkeypatch):
+    endpoints = [
+        {"id": "w1", "url": "https://a.test/hook", "secret": "s1", "events": ["lead.created"]},
+        {"id": "w2", "url": "https://b.test/hook", "secret": "s2", "events": ["lead.created", "lead.scored"]},
+        {"id": "w3", "url": "https://c.test/hook", "secret": "s3", "events": ["lead.scored"]},
+    ]
+    supabase = FakeSupabase(endpoints)
+    received: list[httpx.Request] = []
+    state = {"active": 0, "max_active": 0}
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        state["active"] += 1
+        state["max_active"] = max(state["max_active"], state["active"])
+        await asyncio.sleep(0.01)
+        state["active"] -= 1
+        received.append(request)
+        return httpx.Response(500 if request.url.host == "b.test" else 200, text="ok")
+
+    monkeypatch.setattr(webhooks, "get_supabase_client", lambda: supabase)
+    monkeypatch.setattr(webhooks, "subscription_index", webhooks.WebhookSubscriptionIndex(ttl_seconds=60))
+    monkeypatch.setattr(webhooks, "webhook_dispatcher", WebhookOutboxDispatcher(
+        store=SQLiteOutboxStore(), poll_seconds=3600,
+        deliver=lambda *args: webhooks.deliver_webhook(*args),
+        resolve_endpoint=lambda webhook_id: webhooks.subscription_index.endpoint(webhook_id),
+    ))
+    monkeypatch.setattr(webhooks, "_endpoint_slots", {})
+    monkeypatch.setattr(webhooks, "_http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    return supabase, received, state
+
+
+def test_trigger_enqueues_and_dispatcher_sends_signed_identical_bodies(setup):
+    supabase, received, _ = setup
+    payload = {"lead_id": 42, "name": "Priya", "nested": {"b": 1, "a": 2}}
+
+    async def scenario():
+        result = await webhooks.trigger_webhook("lead.created", payload)
+        # Nothing is sent until the dispatcher drains the outbox
+        assert received == []
+        await webhooks.webhook_dispatcher.drain_once()
+        await webhooks.webhook_dispatcher.stop()
+        return result
+
+    result = asyncio.run(scenario())
+
+    assert result["triggered"] == 2
+    assert {r["webhook_id"]: r["status"] for r in result["results"]} == {"w1": "queued", "w2": "queued"}
+    secrets = {"a.test": "s1", "b.test": "s2"}
+    assert sorted(r.url.host for r in received) == ["a.test", "b.test"]
+    for request in received:
+        expected = hmac.new(secrets[request.url.host].encode(), request.content, hashlib.sha256).hexdigest()
+        assert request.headers["X-Webhook-Signature"] == expected
+        assert request.headers["X-Webhook-Signature"] == webhooks.generate_signature(payload, secrets[request.url.host])
+
+    store = webhooks.webhook_dispatcher.store
+    assert [r["endpoint_id"] for r in store.rows("delivered")] == ["w1"]
+    # b.test answered 500: kept for a retry
+    assert [r["endpoint_id"] for r in store.rows("pending")] == ["w2"]
+
+
+def test_index_is_reused_until_invalidated(setup):
+    supabase, _, _ = setup
+
+    async def scenario():
+        await webhooks.trigger_webhook("lead.created", {"n": 1})
+        await webhooks.trigger_webhook("lead.scored", {"n": 2})
+        webhooks.subscription_index.invalidate()
+        await webhooks.trigger_webhook("lead.scored", {"n": 3})
+        await webhooks.webhook_dispatcher.stop()
+
+    asyncio.run(scenario())
+    assert supabase.endpoint_reads == 2
+
+
+def test_per_endpoint_concurrency_is_capped(setup, monkeypatch):
+    _, received, state = setup
+    monkeypatch.setattr(webhooks, "WEBHOOK_ENDPOINT_CONCURRENCY", 2)
+    webhook = {"id": "w1", "url": "https://a.test/hook", "secret": "s1"}
+
+    async def scenario():
+        body = webhooks.serialize_payload({"n": 1})
+        await asyncio.gather(*(webhooks.deliver_webhook(webhook, "lead.created", body) for _ in range(8)))
+
+    asyncio.run(scenario())
+    assert len(received) == 8
+    assert state["max_active"] == 2
@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import asyncio
+import time
+
+import pytest
+
+import services.webhook_outbox as outbox
+from services.webhook_outbox import EndpointCircuitBreaker, SQLiteOutboxStore, WebhookOutboxDispatcher
+
+
+ENDPOINTS = {
+    "good": {"id": "good", "url": "https://good.test", "secret": "s"},
+    "down": {"id": "down", "url": "https://down.test", "secret": "s"},
+}
+
+
+class Receiver:
+    def __init__(self):
+        self.calls: list[tuple[str, bytes]] = []
+
+    async def __call__(self, webhook, event_type, body):
+        self.calls.append((webhook["id"], body))
+        if webhook["id"] == "down":
+            return {"webhook_id": webhook["id"], "success": False, "status_code": 503}
+        return {"webhook_id": webhook["id"], "success": True, "status_code": 200}
+
+
+@pytest.fixture
+def dispatcher():
+    receiver = Receiver()
+    d = WebhookOutboxDispatcher(
+        store=SQLiteOutboxStore(),
+        deliver=receiver,
+        resolve_endpoint=ENDPOINTS.get,
+        breaker=EndpointCircuitBreaker(threshold=3, cooldown_seconds=60),
+        max_attempts=4,
+    )
+    d.receiver = receiver
+    return d
+
+
+def _make_due(store: SQLiteOutboxStore):
+    store._db.execute("UPDATE webhook_outbox SET next_attempt_at = 0 WHERE status = 'pending'")
+
+
+def test_failed_deliveries_back_off_then_dead_letter(dispatcher, monkeypatch):
+    monkeypatch.setattr(outbox, "OUTBOX_BACKOFF_BASE_SECONDS", 10)
+    dispatcher.breaker = EndpointCircuitBreaker(threshold=100)
+    store = dispatcher.store
+    dispatcher.enqueue("lead.created", b'{"id": 1}', [ENDPOINTS["good"], ENDPOINTS["down"]])
+
+    async def scenario():
+        await dispatcher.drain_once()
+        row = store.rows("pending")[0]
+        assert row["endpoint_id"] == "down" and row["attempts"] == 1
+        # Backed off, so not due yet
+        assert row["next_attempt_at"] > time.time() + 5
+        assert await dispatcher.drain_once() == 0
+
+        for _ in range(3):
+            _make_due(store)
+            await dispatcher.drain_once()
+
+    asyncio.run(scenario())
+
+    assert [r["endpoint_id"] for r in store.rows("delivered")] == ["good"]
+    dead = store.rows("dead")
+    assert [(r["endpoint_id"], r["attempts"], r["last_error"]) for r in dead] == [("down", 4, "HTTP 503")]
+    assert dispatcher.receiver.calls.count(("good", b'{"id": 1}')) == 1
+
+
+def test_circuit_breaker_pauses_failing_endpoint(dispatcher):
+    store = dispatcher.store
+    dispatcher.enqueue("lead.created", b"{}", [ENDPOINTS["down"]] * 5)
+
+    async def scenario():
+        await dispatcher.drain_once()
+
+    asyncio.run(scenario())
+
+    # Three failures open the circuit; the other two are parked without an attempt
+    assert len(dispatcher.receiver.calls) == 3
+    assert dispatcher.breaker.is_open("down")
+    parked = [r for r in store.rows("pending") if r["attempts"] == 0]
+    assert len(parked) == 2
+    assert all(r["next_attempt_at"] > time.time() + 50 for r in parked)
+
+
+def test_breaker_half_open_allows_single_trial():
+    breaker = EndpointCircuitBreaker(threshold=1, cooldown_seconds=0.01)
+    breaker.record_failure("e")
+    assert not breaker.allow("e")
+    time.sleep(0.02)
+    assert breaker.allow("e")
+    assert not breaker.allow("e")
+    breaker.record_success("e")
+    assert breaker.allow("e") and not breaker.is_open("e")
+
+
+def test_expired_leases_are_reclaimed_and_inactive_endpoints_dead_lettered(dispatcher):
+    store = dispatcher.store
+    store.enqueue([
+        {"endpoint_id": "good", "event_type": "e", "body": "{}"},
+        {"endpoint_id": "gone", "event_type": "e", "body": "{}"},
+    ])
+    # A crashed dispatcher claimed both and never reported back
+    assert len(store.claim(10, lease_seconds=-1)) == 2
+
+    asyncio.run(dispatcher.drain_once())
+
+    assert [r["endpoint_id"] for r in store.rows("delivered")] == ["good"]
+    assert [r["last_error"] for r in store.rows("dead")] == ["Endpoint inactive or deleted"]
+
+
+def test_a_crashing_delivery_only_reschedules_its_own_row(dispatcher):
+    store = dispatcher.store
+    applied: list[int] = []
+    apply = store.apply
+    store.apply = lambda results: (applied.append(len(results)), apply(results))
+    dispatcher.apply_chunk = 2
+
+    def resolve(endpoint_id):
+        if endpoint_id == "broken":
+            raise RuntimeError("subscription index unavailable")
+        return ENDPOINTS.get(endpoint_id)
+
+    dispatcher._resolve_endpoint = resolve
+    store.enqueue([{"endpoint_id": e, "event_type": "e", "body": "{}"} for e in ("good", "broken", "good")])
+
+    assert asyncio.run(dispatcher.drain_once()) == 3
+
+    assert applied == [2, 1]  # written back as they finished, not all at the end
+    assert len(store.rows("delivered")) == 2
+    [retry] = store.rows("pending")
+    assert retry["endpoint_id"] == "broken" and retry["attempts"] == 1
+    assert retry["last_error"] == "subscription index unavailable" and retry["next_attempt_at"] > time.time()
+
+
+def test_default_lease_outlasts_a_batch_for_one_endpoint():
+    serial_rounds = -(-outbox.OUTBOX_BATCH_SIZE // outbox._ENDPOINT_CONCURRENCY)
+    assert outbox.OUTBOX_LEASE_SECONDS > serial_rounds * outbox._DELIVERY_TIMEOUT_SECONDS
@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import asyncio
+import importlib
+import sys
+import types
+
+import pytest
+
+
+class FakeAnthropic:
+    """Stands in for anthropic.AsyncAnthropic; records calls and concurrency"""
+
+    instances: list["FakeAnthropic"] = []
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.calls: list[dict] = []
+        self.in_flight = 0
+        self.peak = 0
+        self.fail = False
+        self.messages = types.SimpleNamespace(create=self._create)
+        FakeAnthropic.instances.append(self)
+
+    async def _create(self, **kwargs):
+        self.calls.append(kwargs)
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+            if self.fail:
+                raise TimeoutError("request timed out")
+            return types.SimpleNamespace(content=[types.SimpleNamespace(text="What's your budget?")])
+        finally:
+            self.in_flight -= 1
+
+    async def close(self):
+        pass
+
+
+@pytest.fixture
+def whatsapp(monkeypatch):
+    fake = types.ModuleType("anthropic")
+    fake.AsyncAnthropic = FakeAnthropic
+    monkeypatch.setitem(sys.modules, "anthropic", fake)
+    module = importlib.import_module("app.routes.whatsapp")
+    monkeypatch.setattr(module, "anthropic", fake)
+    monkeypatch.setattr(module, "ANTHROPIC_API_KEY", "key")
+    monkeypatch.setattr(module, "ANTHROPIC_MAX_CONCURRENCY", 2)
+    monkeypatch.setattr(module, "_anthropic_client", None)
+    monkeypatch.setattr(module, "_claude_semaphore", None)
+    FakeAnthropic.instances = []
+    return module
+
+
+def test_calls_share_one_client_and_are_capped_by_the_semaphore(whatsapp):
+    history = [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "Hello!"}]
+
+    async def scenario():
+        return await asyncio.gather(*(
+            whatsapp._call_claude(history + [{"role": "user", "content": f"{n} lakhs"}], "budget")
+            for n in range(6)
+        ))
+
+    replies = asyncio.run(scenario())
+
+    assert replies == ["What's your budget?"] * 6
+    [client] = FakeAnthropic.instances
+    assert client.kwargs == {"api_key": "key", "timeout": whatsapp.ANTHROPIC_TIMEOUT_SECONDS,
+                             "max_retries": whatsapp.ANTHROPIC_MAX_RETRIES}
+    assert len(client.calls) == 6 and client.peak == 2
+
+    call = client.calls[0]
+    assert call["system"] == whatsapp.SYSTEM_PROMPT
+    # The breakpoint sits after the whole history, not on the short system prompt
+    assert call["messages"][:2] == history
+    assert call["messages"][2]["content"] == [
+        {"type": "text", "text": "0 lakhs", "cache_control": {"type": "ephemeral"}}]
+    assert history[-1] == {"role": "assistant", "content": "Hello!"}  # caller's list untouched
+
+
+def test_failed_call_falls_back_and_releases_its_slot(whatsapp):
+    async def scenario():
+        whatsapp.get_anthropic_client().fail = True
+        failed = await asyncio.gather(*(
+            whatsapp._call_claude([{"role": "user", "content": "hi"}], "greeting") for _ in range(3)))
+        whatsapp.get_anthropic_client().fail = False
+        return failed, await whatsapp._call_claude([{"role": "user", "content": "hi"}], "greeting")
+
+    failed, ok = asyncio.run(scenario())
+
+    assert failed == ["Sorry, I faced a technical issue. Could you please repeat?"] * 3
+    assert ok == "What's your budget?"
+    assert whatsapp._get_claude_semaphore()._value == 2
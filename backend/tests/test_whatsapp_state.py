@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import app.whatsapp_state as whatsapp_state
+from app.whatsapp_state import ConversationCache, ConversationWriter
+
+
+@pytest.fixture(autouse=True)
+def supabase_url(monkeypatch):
+    monkeypatch.setattr(whatsapp_state, "SUPABASE_URL", "https://db.test")
+
+
+def _conv(n, stage="budget", messages=()):
+    return {"id": f"c{n}", "phone": f"+91900000000{n}", "qualification_stage": stage,
+            "extracted_data": {}, "messages": list(messages), "lead_id": None}
+
+
+def test_cache_expires_and_evicts_oldest(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(whatsapp_state.time, "monotonic", lambda: now[0])
+    cache = ConversationCache(ttl_seconds=60, max_entries=2)
+
+    cache.put("+1", _conv(1))
+    cache.put("+2", _conv(2))
+    assert cache.get("+1")["id"] == "c1"
+    cache.put("+3", _conv(3))  # "+1" was put first, so it goes
+    assert cache.get("+1") is None and len(cache) == 2
+
+    now[0] += 61
+    assert cache.get("+2") is None
+    assert cache.hits == 1 and cache.misses == 2
+
+
+def _writer(handler, **kwargs):
+    return ConversationWriter(client=httpx.AsyncClient(transport=httpx.MockTransport(handler)), **kwargs)
+
+
+def test_saves_coalesce_into_one_write_before_jobs_run():
+    log: list[str] = []
+    writes: list[list[dict]] = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        assert request.url.path == "/rest/v1/rpc/write_whatsapp_conversations"
+        writes.append(json.loads(request.content)["p_rows"])
+        log.append("write")
+        return httpx.Response(200, json=[])
+
+    async def complete():
+        log.append("complete")
+
+    writer = _writer(handler)
+    conv = _conv(1)
+    conv["messages"].append({"role": "user", "content": "hi"})
+    writer.save(conv, "2026-01-01T00:00:00+00:00")
+    conv["messages"].append({"role": "user", "content": "80 lakhs"})
+    conv["qualification_stage"] = "complete"
+    writer.save(conv, "2026-01-01T00:05:00+00:00")
+    writer.save(_conv(2))
+    writer.submit(complete, conv["phone"])
+    conv["messages"].append({"role": "user", "content": "later"})  # after the save: not written
+
+    asyncio.run(writer.flush())
+
+    assert log == ["write", "complete"]
+    rows = writes[0]
+    assert [row["id"] for row in rows] == ["c1", "c2"]
+    assert rows[0]["qualification_stage"] == "complete" and len(rows[0]["messages"]) == 2
+    # Coalesced saves are checked against the version the first one was built on
+    assert rows[0]["base_message_at"] == "2026-01-01T00:00:00+00:00" and rows[1]["base_message_at"] is None
+    assert "lead_id" not in rows[0]
+    assert writer.pending() == 0
+
+
+def test_stale_rows_are_reported_and_rejected_rows_dropped_one_by_one():
+    calls: list[list[str]] = []
+    stale: list[str] = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        phones = [row["phone"] for row in json.loads(request.content)["p_rows"]]
+        calls.append(phones)
+        if "+919000000003" in phones:
+            return httpx.Response(400, json={"code": "23514", "message": "violates check constraint"})
+        return httpx.Response(200, json=[p for p in phones if p == "+919000000002"])
+
+    writer = _writer(handler, on_stale=stale.append)
+    for n in range(1, 5):
+        writer.save(_conv(n))
+
+    asyncio.run(writer.flush())
+
+    assert calls[0] == ["+919000000001", "+919000000002", "+919000000003", "+919000000004"]
+    assert ["+919000000003"] in calls  # bisected down to the offending row
+    assert sorted(stale) == ["+919000000002", "+919000000003"]
+    assert writer.written == 2 and writer.dropped == 1 and writer.pending() == 0
+
+
+def test_failed_write_is_kept_and_only_its_jobs_wait():
+    responses = [httpx.Response(503), httpx.Response(200, json=[])]
+    writes: list[list[dict]] = []
+    jobs_run: list[str] = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        writes.append(json.loads(request.content)["p_rows"])
+        return responses.pop(0) if responses else httpx.Response(200, json=[])
+
+    def job(name):
+        async def run():
+            jobs_run.append(name)
+        return run
+
+    writer = _writer(handler, max_rows=1)
+    writer.save(_conv(1, stage="budget"), "2026-01-01T00:00:00+00:00")
+    writer.submit(job("c1"), "+919000000001")
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(writer.flush())
+    assert jobs_run == [] and writer.pending() == 2
+
+    writer.save(_conv(1, stage="location"), "2026-01-01T00:01:00+00:00")  # newer state replaces the failed row
+    writer.save(_conv(2))
+    writer.submit(job("c2"), "+919000000002")
+    asyncio.run(writer.flush())
+
+    assert writes[1] == [{**writes[0][0], "qualification_stage": "location"}]
+    # c1's row is written even though c2 is still queued behind it
+    assert jobs_run == ["c1"] and writer.pending() == 2
+    asyncio.run(writer.flush())
+    assert jobs_run == ["c1", "c2"] and writer.pending() == 0
+
+
+def test_failing_job_is_retried_then_given_up():
+    attempts = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, json=[])
+
+    async def boom():
+        attempts.append(1)
+        raise RuntimeError("leads unavailable")
+
+    writer = _writer(handler, max_job_attempts=2)
+    writer.submit(boom, "+919000000001")
+
+    asyncio.run(writer.flush())
+    asyncio.run(writer.flush())
+    asyncio.run(writer.flush())
+
+    assert len(attempts) == 2 and writer.failed_jobs == 1 and writer.pending() == 0
@@ -0,0 +1,45 @@
+from __future__ import annotations
+
+import asyncio
+import types
+
+from services.workflow_engine import WorkflowEngine
+
+
+class MissingExecutionQuery:
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+    def execute(self):
+        # What postgrest's single() raises when no row matches
+        raise RuntimeError("JSON object requested, multiple (or no) rows returned")
+
+
+class FakeSupabase:
+    def __init__(self):
+        self.status_updates: list[dict] = []
+
+    def table(self, name):
+        assert name == "workflow_executions"
+        return MissingExecutionQuery()
+
+    def rpc(self, name, params):
+        assert name == "apply_workflow_status_updates"
+        self.status_updates.append(params)
+        return types.SimpleNamespace(execute=lambda: types.SimpleNamespace(data=[]))
+
+
+def test_action_of_a_missing_execution_is_failed_right_away():
+    engine = WorkflowEngine()
+    engine.supabase = FakeSupabase()
+    engine.status_writer.flush_interval = 0
+
+    asyncio.run(engine.run_claimed_action(
+        {"id": "a1", "execution_id": "gone", "action_type": "send_sms", "action_config": {}}))
+
+    [update] = engine.supabase.status_updates
+    [action] = update["p_actions"]
+    assert action["id"] == "a1" and action["status"] == "failed"
+    assert "no) rows returned" in action["error_message"]
+    [execution] = update["p_executions"]
+    assert execution["id"] == "gone" and execution["failed_delta"] == 1 and execution["status"] == "failed"
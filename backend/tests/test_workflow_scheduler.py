@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import asyncio
+import time
+
+from services.workflow_scheduler import WorkflowScheduler
+
+
+class FakeEngine:
+    """In-memory stand-in for the claim/renew RPCs and action execution"""
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.rows: dict[str, dict] = {}
+        self.executed: list[str] = []
+        self.active = 0
+        self.max_active = 0
+        self.renewals: list[list[str]] = []
+
+    def add(self, action_id: str, execution_id: str, due_at: float, **fields) -> None:
+        self.rows[action_id] = {
+            "id": action_id, "execution_id": execution_id, "due": due_at,
+            "status": "pending", "lease": None, "claimed_by": None, **fields,
+        }
+
+    def claim_actions(self, worker_id: str, limit: int, lease_seconds: int) -> list[dict]:
+        now = time.time()
+
+        def claimable(row):
+            return (row["status"] == "pending" and row["due"] <= now) or (
+                row["status"] == "running" and row["lease"] < now
+            )
+
+        busy = {r["execution_id"] for r in self.rows.values() if r["status"] == "running" and r["lease"] >= now}
+        first: dict[str, dict] = {}
+        for row in sorted(self.rows.values(), key=lambda r: r["due"]):
+            if claimable(row) and row["execution_id"] not in busy:
+                first.setdefault(row["execution_id"], row)
+
+        claimed = sorted(first.values(), key=lambda r: r["due"])[:limit]
+        for row in claimed:
+            row.update(status="running", lease=now + lease_seconds, claimed_by=worker_id)
+        return [dict(row) for row in claimed]
+
+    def renew_action_leases(self, worker_id: str, action_ids: list[str], lease_seconds: int) -> int:
+        self.renewals.append(sorted(action_ids))
+        for action_id in action_ids:
+            if self.rows[action_id]["claimed_by"] == worker_id:
+                self.rows[action_id]["lease"] = time.time() + lease_seconds
+        return len(action_ids)
+
+    async def run_claimed_action(self, action: dict) -> None:
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        await asyncio.sleep(self.delay)
+        self.active -= 1
+        self.rows[action["id"]]["status"] = "completed"
+        self.executed.append(action["id"])
+
+
+def _scheduler(engine: FakeEngine, **kwargs) -> WorkflowScheduler:
+    scheduler = WorkflowScheduler(engine=engine, refresh_seconds=3600, **kwargs)
+
+    async def refresh() -> int:
+        scheduler._last_refresh = time.monotonic()
+        scheduler.request_claim()
+        return scheduler.schedule_actions(
+            {"id": r["id"], "scheduled_for": _iso(r["due"]), "status": r["status"]}
+            for r in engine.rows.values()
+        )
+
+    scheduler.refresh = refresh
+    return scheduler
+
+
+def _iso(epoch: float) -> str:
+    from datetime import datetime, timezone
+
+    return datetime.fromtimestamp(epoch, timezone.utc).isoformat()
+
+
+async def _drain(scheduler: WorkflowScheduler, engine: FakeEngine, expected: int, timeout: float = 2.0):
+    deadline = time.monotonic() + timeout
+    while len(engine.executed) < expected and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    await scheduler.stop()
+
+
+def test_runs_actions_in_due_order():
+    async def scenario():
+        engine = FakeEngine()
+        now = time.time()
+        engine.add("late", "e1", now + 0.15)
+        engine.add("early", "e2", now + 0.05)
+        engine.add("overdue", "e3", now - 10)
+        scheduler = _scheduler(engine, max_concurrency=1)
+        scheduler.start()
+        await _drain(scheduler, engine, 3)
+        return engine.executed
+
+    assert asyncio.run(scenario()) == ["overdue", "early", "late"]
+
+
+def test_ignores_actions_beyond_lookahead():
+    scheduler = _scheduler(FakeEngine(), lookahead_seconds=60)
+    assert scheduler.push("soon", time.time() + 30)
+    assert not scheduler.push("later", time.time() + 3600)
+    assert scheduler.stats()["scheduled"] == 1
+
+
+def test_worker_pool_is_bounded_and_executions_are_serialized():
+    async def scenario():
+        engine = FakeEngine(delay=0.02)
+        now = time.time() - 1
+        for i in range(12):
+            engine.add(f"a{i}", f"e{i}", now)
+        # Two actions of the same execution never overlap
+        engine.add("same-1", "shared", now)
+        engine.add("same-2", "shared", now + 0.001)
+        scheduler = _scheduler(engine, max_concurrency=3, claim_batch_size=2)
+        scheduler.start()
+        await _drain(scheduler, engine, 14)
+        return engine
+
+    engine = asyncio.run(scenario())
+    assert len(engine.executed) == 14
+    assert engine.max_active <= 3
+    assert engine.executed.index("same-1") < engine.executed.index("same-2")
+
+
+def test_two_schedulers_never_run_the_same_action():
+    async def scenario():
+        engine = FakeEngine(delay=0.005)
+        now = time.time() - 1
+        for i in range(40):
+            engine.add(f"a{i}", f"e{i}", now)
+        first, second = _scheduler(engine, max_concurrency=4), _scheduler(engine, max_concurrency=4)
+        first.start()
+        second.start()
+        deadline = time.monotonic() + 2
+        while len(engine.executed) < 40 and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        await asyncio.gather(first.stop(), second.stop())
+        return engine.executed
+
+    executed = asyncio.run(scenario())
+    assert sorted(executed) == sorted(f"a{i}" for i in range(40))
+
+
+def test_expired_leases_are_reclaimed_and_live_ones_renewed():
+    async def scenario():
+        engine = FakeEngine(delay=0.2)
+        # Left behind by a crashed worker
+        engine.add("orphan", "e1", time.time() - 60, status="running", lease=time.time() - 1, claimed_by="dead")
+        engine.add("slow", "e2", time.time() - 1)
+        scheduler = _scheduler(engine, lease_seconds=0.09)
+        scheduler.start()
+        await _drain(scheduler, engine, 2)
+        return engine
+
+    engine = asyncio.run(scenario())
+    assert sorted(engine.executed) == ["orphan", "slow"]
+    assert engine.rows["orphan"]["claimed_by"] != "dead"
+    assert any("slow" in ids for ids in engine.renewals)
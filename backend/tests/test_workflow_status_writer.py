@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from services.workflow_status_writer import WorkflowStatusWriter
+
+
+class FakeRpc:
+    def __init__(self, client, params):
+        self.client, self.params = client, params
+
+    def execute(self):
+        if self.client.fail:
+            self.client.fail = False
+            raise RuntimeError("connection reset")
+        self.client.calls.append(self.params)
+        return type("Result", (), {"data": self.client.completed})()
+
+
+class FakeClient:
+    def __init__(self):
+        self.calls: list[dict] = []
+        self.completed: list = []
+        self.fail = False
+
+    def rpc(self, name, params):
+        assert name == "apply_workflow_status_updates"
+        return FakeRpc(self, params)
+
+
+async def _run_action(writer: WorkflowStatusWriter, action_id: str, execution_id: str):
+    writer.update_execution(execution_id, status="running")
+    writer.update_action(action_id, external_message_id=f"SM-{action_id}")
+    writer.update_action(action_id, status="completed", result={"status": "sent"})
+    writer.count_action(execution_id, "completed")
+    await writer.commit()
+
+
+def test_concurrent_actions_share_one_flush_with_merged_rows():
+    client = FakeClient()
+    client.completed = ["exec-1"]
+    writer = WorkflowStatusWriter(lambda: client, flush_interval=0.01)
+
+    async def scenario():
+        await asyncio.gather(*(_run_action(writer, f"a{i}", "exec-1" if i < 3 else "exec-2") for i in range(5)))
+
+    asyncio.run(scenario())
+
+    assert len(client.calls) == 1
+    actions = client.calls[0]["p_actions"]
+    assert len(actions) == 5
+    assert actions[0] == {"id": "a0", "external_message_id": "SM-a0", "status": "completed", "result": {"status": "sent"}}
+    executions = {row["id"]: row for row in client.calls[0]["p_executions"]}
+    assert executions["exec-1"]["completed_delta"] == 3
+    assert executions["exec-2"]["completed_delta"] == 2
+    assert writer.pending_rows() == 0
+
+
+def test_failed_flush_keeps_rows_and_counters_for_the_next_one():
+    client = FakeClient()
+    client.fail = True
+    writer = WorkflowStatusWriter(lambda: client, flush_interval=0.01)
+
+    async def scenario():
+        writer.update_action("a1", status="failed", error_message="boom")
+        writer.count_action("exec-1", "failed")
+        with pytest.raises(RuntimeError):
+            await writer.commit()
+        writer.count_action("exec-1", "completed")
+        writer.count_action("exec-1", "failed")
+        await writer.commit()
+
+    asyncio.run(scenario())
+
+    assert len(client.calls) == 1
+    assert client.calls[0]["p_actions"] == [{"id": "a1", "status": "failed", "error_message": "boom"}]
+    assert client.calls[0]["p_executions"] == [{"id": "exec-1", "failed_delta": 2, "completed_delta": 1}]
+
+
+def test_failed_flush_is_retried_without_another_commit():
+    client = FakeClient()
+    client.fail = True
+    writer = WorkflowStatusWriter(lambda: client, flush_interval=0.01)
+
+    async def scenario():
+        writer.update_action("a1", status="completed")
+        writer.count_action("exec-1", "completed")
+        with pytest.raises(RuntimeError):
+            await writer.commit()
+        # Nobody commits again; the writer retries on its own after a backoff
+        await asyncio.sleep(0.1)
+
+    asyncio.run(scenario())
+
+    assert client.calls == [{"p_actions": [{"id": "a1", "status": "completed"}],
+                             "p_executions": [{"id": "exec-1", "completed_delta": 1}]}]
+    assert writer.pending_rows() == 0
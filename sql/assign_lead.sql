@@ -0,0 +1,176 @@
+-- =============================================
+-- ATOMIC LEAD ASSIGNMENT
+-- Picks an assignee, takes capacity, updates the lead and logs the event
+-- in one transaction
+-- Run this in Supabase SQL Editor (after 015_agentic_marketing_funnel.sql)
+-- =============================================
+
+-- distribute_lead_internal used to read the top execs, read each one's
+-- capacity, reset or bump counters with separate PATCHes, then patch the
+-- lead and insert a lead_events row: up to ~12 round-trips per lead, and
+-- two concurrent leads could both take an exec's last slot. Here the
+-- candidate rows are locked while the choice is made, so capacity and
+-- round-robin order hold under concurrent ingestion.
+--
+--   lion   -> top-5 execs by conversion_rate, first with capacity left
+--             today (else the top exec)
+--   monkey -> exec assigned longest ago (round-robin)
+--   dog    -> channel partner assigned longest ago
+--
+-- Round-robin picks skip rows locked by a concurrent assignment, falling
+-- back to waiting for the lock when every candidate is taken, so a burst of
+-- assignments never leaves a lead without an assignee. On re-assignment
+-- (SLA breach) the current assignee goes to the back of the line. Returns
+-- NULL when the lead does not exist.
+
+BEGIN;
+
+CREATE OR REPLACE FUNCTION public.assign_lead(
+  p_lead_id UUID,
+  p_sla_minutes JSONB DEFAULT '{"lion": 15, "monkey": 120, "dog": 480}'::JSONB,
+  p_force_reassign BOOLEAN DEFAULT false
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+SECURITY DEFINER
+VOLATILE
+SET search_path = public
+AS $$
+DECLARE
+  v_lead public.leads%ROWTYPE;
+  v_classification TEXT;
+  v_assignment_type TEXT;
+  v_today DATE := (NOW() AT TIME ZONE 'utc')::DATE;
+  v_sla_deadline TIMESTAMPTZ;
+  v_assignee RECORD;
+  v_found BOOLEAN;
+BEGIN
+  SELECT * INTO v_lead FROM public.leads WHERE id = p_lead_id FOR UPDATE;
+  IF NOT FOUND THEN
+    RETURN NULL;
+  END IF;
+
+  v_classification := COALESCE(v_lead.classification, 'dog');
+
+  IF v_classification = 'lion' THEN
+    v_assignment_type := 'sales_exec';
+    SELECT t.id, t.name, t.phone, t.whatsapp_number INTO v_assignee
+    FROM (
+      SELECT s.*,
+             CASE WHEN s.count_reset_date = v_today THEN s.current_daily_count ELSE 0 END AS todays_count
+      FROM public.sales_team s
+      WHERE s.is_active
+      ORDER BY (p_force_reassign AND s.id IS NOT DISTINCT FROM v_lead.assigned_to), s.conversion_rate DESC
+      LIMIT 5
+      FOR UPDATE
+    ) t
+    ORDER BY (t.todays_count < COALESCE(t.max_daily_leads, 20)) DESC,
+             (p_force_reassign AND t.id IS NOT DISTINCT FROM v_lead.assigned_to),
+             t.conversion_rate DESC
+    LIMIT 1;
+
+  ELSIF v_classification = 'monkey' THEN
+    v_assignment_type := 'sales_exec';
+    SELECT s.id, s.name, s.phone, s.whatsapp_number INTO v_assignee
+    FROM public.sales_team s
+    WHERE s.is_active
+    ORDER BY (p_force_reassign AND s.id IS NOT DISTINCT FROM v_lead.assigned_to),
+             s.last_assigned_at ASC NULLS FIRST
+    LIMIT 1
+    FOR UPDATE SKIP LOCKED;
+    IF NOT FOUND THEN
+      -- Every candidate is briefly locked by a concurrent assignment: wait for one
+      SELECT s.id, s.name, s.phone, s.whatsapp_number INTO v_assignee
+      FROM public.sales_team s
+      WHERE s.is_active
+      ORDER BY (p_force_reassign AND s.id IS NOT DISTINCT FROM v_lead.assigned_to),
+               s.last_assigned_at ASC NULLS FIRST
+      LIMIT 1
+      FOR UPDATE;
+    END IF;
+
+  ELSE
+    v_assignment_type := 'channel_partner';
+    SELECT c.id, c.name, c.phone, c.whatsapp_number INTO v_assignee
+    FROM public.channel_partners c
+    WHERE c.is_active
+    ORDER BY (p_force_reassign AND c.id IS NOT DISTINCT FROM v_lead.assigned_to),
+             c.last_assigned_at ASC NULLS FIRST
+    LIMIT 1
+    FOR UPDATE SKIP LOCKED;
+    IF NOT FOUND THEN
+      SELECT c.id, c.name, c.phone, c.whatsapp_number INTO v_assignee
+      FROM public.channel_partners c
+      WHERE c.is_active
+      ORDER BY (p_force_reassign AND c.id IS NOT DISTINCT FROM v_lead.assigned_to),
+               c.last_assigned_at ASC NULLS FIRST
+      LIMIT 1
+      FOR UPDATE;
+    END IF;
+  END IF;
+  v_found := FOUND;
+
+  v_sla_deadline := NOW() + make_interval(mins => COALESCE((p_sla_minutes->>v_classification)::INTEGER, 120));
+
+  IF NOT v_found THEN
+    -- assignees_available: nobody was picked although someone could take the
+    -- lead, so the caller should retry rather than treat it as distributed
+    RETURN jsonb_build_object(
+      'lead', to_jsonb(v_lead),
+      'classification', v_classification,
+      'assignment_type', v_assignment_type,
+      'assigned_to', NULL,
+      'assignees_available', CASE
+        WHEN v_assignment_type = 'sales_exec' THEN EXISTS (SELECT 1 FROM public.sales_team WHERE is_active)
+        ELSE EXISTS (SELECT 1 FROM public.channel_partners WHERE is_active)
+      END,
+      'sla_deadline', v_sla_deadline
+    );
+  END IF;
+
+  IF v_assignment_type = 'sales_exec' THEN
+    UPDATE public.sales_team
+    SET last_assigned_at = NOW(),
+        leads_handled = COALESCE(leads_handled, 0) + 1,
+        current_daily_count = CASE WHEN count_reset_date = v_today THEN COALESCE(current_daily_count, 0) ELSE 0 END + 1,
+        count_reset_date = v_today
+    WHERE id = v_assignee.id;
+  ELSE
+    UPDATE public.channel_partners
+    SET last_assigned_at = NOW(),
+        leads_sent = COALESCE(leads_sent, 0) + 1
+    WHERE id = v_assignee.id;
+  END IF;
+
+  UPDATE public.leads
+  SET assigned_to = v_assignee.id,
+      assignment_type = v_assignment_type,
+      sla_deadline = v_sla_deadline,
+      updated_at = NOW()
+  WHERE id = p_lead_id;
+
+  INSERT INTO public.lead_events (lead_id, event_type, actor_type, new_value)
+  VALUES (p_lead_id, 'assigned', 'system', jsonb_build_object(
+    'assignee_id', v_assignee.id,
+    'assignment_type', v_assignment_type,
+    'classification', v_classification
+  ));
+
+  RETURN jsonb_build_object(
+    'lead', to_jsonb(v_lead),
+    'classification', v_classification,
+    'assignment_type', v_assignment_type,
+    'assigned_to', v_assignee.id,
+    'assignee_name', v_assignee.name,
+    'assignee_phone', COALESCE(v_assignee.whatsapp_number, v_assignee.phone),
+    'sla_deadline', v_sla_deadline
+  );
+END;
+$$;
+
+COMMENT ON FUNCTION public.assign_lead(UUID, JSONB, BOOLEAN) IS
+  'Assigns a lead by classification (capacity and round-robin taken under row locks), updates the lead and logs an assigned event in one transaction';
+
+GRANT EXECUTE ON FUNCTION public.assign_lead(UUID, JSONB, BOOLEAN) TO service_role;
+
+COMMIT;
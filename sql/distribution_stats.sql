@@ -0,0 +1,73 @@
+-- =============================================
+-- DISTRIBUTION STATS SNAPSHOT
+-- One-query baseline for the in-process distribution stats
+-- Run this in Supabase SQL Editor (after sla_breach_sweep.sql)
+-- =============================================
+
+-- /api/distribution/stats is served from counters the API keeps in memory
+-- and bumps as it assigns leads. Those counters only see this process's
+-- assignments, so every few minutes they are replaced with this snapshot
+-- (leads contacted by sales, other replicas, manual edits all show up
+-- here). Returns:
+--
+--   pipeline    -> lead counts by classification
+--   sales_team  -> active execs with leads_handled / conversion_rate
+--   assignees   -> open ('new') leads per assignee
+--   sla         -> open leads and SLA breaches logged in the last 24h
+
+BEGIN;
+
+CREATE OR REPLACE FUNCTION public.distribution_stats()
+RETURNS JSONB
+LANGUAGE sql
+SECURITY DEFINER
+STABLE
+SET search_path = public
+AS $$
+  SELECT jsonb_build_object(
+    'pipeline', (
+      SELECT jsonb_build_object(
+        'lion_count', COUNT(*) FILTER (WHERE classification = 'lion'),
+        'monkey_count', COUNT(*) FILTER (WHERE classification = 'monkey'),
+        'dog_count', COUNT(*) FILTER (WHERE classification = 'dog')
+      )
+      FROM public.leads
+    ),
+    'sales_team', COALESCE((
+      SELECT jsonb_agg(jsonb_build_object(
+        'id', s.id,
+        'name', s.name,
+        'leads_handled', COALESCE(s.leads_handled, 0),
+        'conversion_rate', s.conversion_rate
+      ) ORDER BY s.conversion_rate DESC NULLS LAST)
+      FROM public.sales_team s
+      WHERE s.is_active
+    ), '[]'::JSONB),
+    'assignees', COALESCE((
+      SELECT jsonb_object_agg(a.assigned_to, a.open_leads)
+      FROM (
+        SELECT assigned_to, COUNT(*) AS open_leads
+        FROM public.leads
+        WHERE status = 'new' AND assigned_to IS NOT NULL
+        GROUP BY assigned_to
+      ) a
+    ), '{}'::JSONB),
+    'sla', jsonb_build_object(
+      'open', (
+        SELECT COUNT(*) FROM public.leads
+        WHERE status = 'new' AND assigned_to IS NOT NULL
+      ),
+      'breaches_24h', (
+        SELECT COUNT(*) FROM public.lead_events
+        WHERE event_type = 'sla_breach' AND created_at > NOW() - INTERVAL '24 hours'
+      )
+    )
+  );
+$$;
+
+COMMENT ON FUNCTION public.distribution_stats() IS
+  'Distribution pipeline, assignee and SLA counts in one round-trip (baseline for the API''s in-memory stats)';
+
+GRANT EXECUTE ON FUNCTION public.distribution_stats() TO service_role;
+
+COMMIT;
@@ -0,0 +1,178 @@
+-- =============================================
+-- LEAD OUTBOX
+-- Durable follow-up work (CAPI, scoring, distribution) for new leads
+-- Run this in Supabase SQL Editor (after leads_phone_unique.sql)
+-- =============================================
+
+-- Lead ingest used to schedule four BackgroundTasks per lead; they ran in
+-- the API worker after the response and were lost on every restart.
+-- insert_leads_with_outbox writes each new lead and its lead_outbox row in
+-- the same transaction, so no lead is created without its follow-up work.
+-- The dispatcher (app/lead_outbox.py) claims due rows in batches, runs the
+-- steps not yet in completed_steps and retries the rest with backoff until
+-- the attempt limit moves the row to 'dead'.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS public.lead_outbox (
+  id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+  lead_id UUID NOT NULL REFERENCES public.leads(id) ON DELETE CASCADE,
+  event_type TEXT NOT NULL DEFAULT 'lead.created',
+
+  -- The lead row as inserted (CAPI user data, budget, location)
+  payload JSONB NOT NULL DEFAULT '{}',
+
+  -- 'pending', 'processing', 'done', 'dead'
+  status TEXT NOT NULL DEFAULT 'pending',
+  attempts INTEGER NOT NULL DEFAULT 0,
+  next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  locked_until TIMESTAMPTZ,
+
+  -- Steps that already succeeded are skipped on retry ('capi', 'score', 'distribute')
+  completed_steps TEXT[] NOT NULL DEFAULT '{}',
+  last_error TEXT,
+
+  created_at TIMESTAMPTZ DEFAULT NOW(),
+  processed_at TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS idx_lead_outbox_due
+  ON public.lead_outbox(next_attempt_at)
+  WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_lead_outbox_locked
+  ON public.lead_outbox(locked_until)
+  WHERE status = 'processing';
+CREATE INDEX IF NOT EXISTS idx_lead_outbox_dead
+  ON public.lead_outbox(created_at DESC)
+  WHERE status = 'dead';
+
+ALTER TABLE public.lead_outbox ENABLE ROW LEVEL SECURITY;
+GRANT ALL ON public.lead_outbox TO service_role;
+
+COMMENT ON TABLE public.lead_outbox IS 'Follow-up work for newly ingested leads awaiting (re)processing, plus dead letters';
+
+-- =============================================
+-- INSERT LEADS + OUTBOX ROWS
+-- =============================================
+-- Phones that already exist are skipped (leads_phone_normalized_key) and
+-- get no outbox row; only the leads actually inserted are returned.
+CREATE OR REPLACE FUNCTION public.insert_leads_with_outbox(
+  p_leads JSONB
+)
+RETURNS SETOF public.leads
+LANGUAGE sql
+SECURITY DEFINER
+VOLATILE
+SET search_path = public
+AS $$
+  WITH input AS (
+    SELECT * FROM jsonb_populate_recordset(NULL::public.leads, p_leads)
+  ),
+  inserted AS (
+    INSERT INTO public.leads (
+      id, name, phone, phone_normalized, phone_hash, email, email_hash, source,
+      utm_source, utm_medium, utm_campaign, utm_content, utm_term,
+      fbclid, gclid, fbc, fbp, event_id, message, status, smartscore, classification,
+      property_id, builder_id, budget, preferred_location, timeline_months,
+      property_type_interest, purpose, loan_required
+    )
+    SELECT
+      id, name, phone, phone_normalized, phone_hash, email, email_hash, source,
+      utm_source, utm_medium, utm_campaign, utm_content, utm_term,
+      fbclid, gclid, fbc, fbp, event_id, message, status, smartscore, classification,
+      property_id, builder_id, budget, preferred_location, timeline_months,
+      property_type_interest, purpose, loan_required
+    FROM input
+    ON CONFLICT (phone_normalized) DO NOTHING
+    RETURNING *
+  ),
+  outbox AS (
+    INSERT INTO public.lead_outbox (lead_id, payload)
+    SELECT i.id, to_jsonb(i) FROM inserted i
+  )
+  SELECT * FROM inserted;
+$$;
+
+COMMENT ON FUNCTION public.insert_leads_with_outbox IS
+  'Insert new leads (skipping existing phones) together with their lead_outbox rows in one transaction';
+
+-- =============================================
+-- CLAIM
+-- =============================================
+CREATE OR REPLACE FUNCTION public.claim_lead_outbox(
+  p_limit INTEGER DEFAULT 100,
+  p_lease_seconds INTEGER DEFAULT 120
+)
+RETURNS SETOF public.lead_outbox
+LANGUAGE sql
+SECURITY DEFINER
+VOLATILE
+SET search_path = public
+AS $$
+  WITH due AS (
+    SELECT id
+    FROM public.lead_outbox
+    WHERE (status = 'pending' AND next_attempt_at <= NOW())
+       OR (status = 'processing' AND locked_until < NOW())
+    ORDER BY next_attempt_at
+    LIMIT p_limit
+    FOR UPDATE SKIP LOCKED
+  )
+  UPDATE public.lead_outbox o
+  SET status = 'processing',
+      locked_until = NOW() + make_interval(secs => p_lease_seconds)
+  FROM due
+  WHERE o.id = due.id
+  RETURNING o.*;
+$$;
+
+COMMENT ON FUNCTION public.claim_lead_outbox IS
+  'Lease due lead follow-ups to a dispatcher; rows of crashed dispatchers are reclaimed after the lease';
+
+-- =============================================
+-- RECORD OUTCOMES
+-- =============================================
+CREATE OR REPLACE FUNCTION public.apply_lead_outbox_results(
+  p_results JSONB
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+SECURITY DEFINER
+VOLATILE
+SET search_path = public
+AS $$
+DECLARE
+  updated INTEGER;
+BEGIN
+  UPDATE public.lead_outbox o
+  SET status = r.status,
+      attempts = COALESCE(r.attempts, o.attempts),
+      next_attempt_at = COALESCE(r.next_attempt_at, o.next_attempt_at),
+      completed_steps = COALESCE(r.completed_steps, o.completed_steps),
+      last_error = r.last_error,
+      processed_at = r.processed_at,
+      locked_until = NULL
+  FROM jsonb_to_recordset(p_results) AS r(
+    id UUID,
+    status TEXT,
+    attempts INTEGER,
+    next_attempt_at TIMESTAMPTZ,
+    completed_steps TEXT[],
+    last_error TEXT,
+    processed_at TIMESTAMPTZ
+  )
+  WHERE o.id = r.id;
+
+  GET DIAGNOSTICS updated = ROW_COUNT;
+  RETURN updated;
+END;
+$$;
+
+COMMENT ON FUNCTION public.apply_lead_outbox_results IS
+  'Record a batch of lead follow-up outcomes (done, rescheduled or dead)';
+
+GRANT EXECUTE ON FUNCTION public.insert_leads_with_outbox(JSONB) TO service_role;
+GRANT EXECUTE ON FUNCTION public.claim_lead_outbox(INTEGER, INTEGER) TO service_role;
+GRANT EXECUTE ON FUNCTION public.apply_lead_outbox_results(JSONB) TO service_role;
+
+COMMIT;
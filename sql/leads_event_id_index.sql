@@ -0,0 +1,18 @@
+-- =============================================
+-- LEADS EVENT ID INDEX
+-- Lookup index for leads.event_id
+-- Run this in Supabase SQL Editor (after lead_outbox.sql)
+-- =============================================
+
+-- Meta Lead Ads leads store their leadgen id as event_id (it is also the
+-- CAPI dedup id). Each leadgen webhook checks its ids with one
+-- event_id=in.(...) query before fetching anything from the Graph API, so
+-- redelivered webhooks don't refetch or re-ingest leads.
+
+BEGIN;
+
+CREATE INDEX IF NOT EXISTS idx_leads_event_id
+  ON public.leads(event_id)
+  WHERE event_id IS NOT NULL;
+
+COMMIT;
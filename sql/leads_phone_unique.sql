@@ -0,0 +1,22 @@
+-- =============================================
+-- LEADS PHONE UNIQUE CONSTRAINT
+-- Full unique index on leads.phone_normalized for ON CONFLICT upserts
+-- Run this in Supabase SQL Editor (after 080_ensure_leads_columns.sql)
+-- =============================================
+
+-- Lead ingest answers "definitely new" from an in-process Bloom filter and
+-- inserts without looking the phone up first, so the database has to
+-- reject the duplicates the filter can't see (leads written by other
+-- replicas or other paths). PostgREST's on_conflict can't name the
+-- partial idx_leads_phone_normalized index (ON CONFLICT would need its
+-- WHERE predicate), so it is replaced by a plain unique index. NULL phones
+-- are still allowed any number of times: NULLs never conflict.
+
+BEGIN;
+
+CREATE UNIQUE INDEX IF NOT EXISTS leads_phone_normalized_key
+  ON public.leads(phone_normalized);
+
+DROP INDEX IF EXISTS public.idx_leads_phone_normalized;
+
+COMMIT;
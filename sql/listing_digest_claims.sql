@@ -0,0 +1,104 @@
+-- =============================================
+-- LISTING DIGEST CLAIMS
+-- Hands queued listing_distributions to the daily digest job
+-- Run this in Supabase SQL Editor (after match_buyers_for_listing.sql)
+-- =============================================
+
+-- distribute_listing writes digest buyers' matches as conversion_status
+-- 'queued'. The digest job claims them here a whole buyer at a time
+-- ('digest_sending', with a lease so a crashed run is picked up again),
+-- sends one message per buyer and marks the rows 'sent'. Overlapping
+-- runs skip each other's locked rows, so nobody gets the same digest
+-- twice. Contact details, channels and listing fields come back in the
+-- same call.
+
+BEGIN;
+
+ALTER TABLE public.listing_distributions
+  ADD COLUMN IF NOT EXISTS digest_claimed_at TIMESTAMPTZ;
+
+CREATE INDEX IF NOT EXISTS idx_listing_distributions_digest
+  ON public.listing_distributions(buyer_id)
+  WHERE conversion_status IN ('queued', 'digest_sending');
+
+CREATE OR REPLACE FUNCTION public.claim_digest_distributions(
+  p_frequency TEXT DEFAULT 'daily_digest',
+  p_buyer_limit INTEGER DEFAULT 1000,
+  p_lease_seconds INTEGER DEFAULT 900
+)
+RETURNS TABLE(
+  distribution_id UUID,
+  buyer_id UUID,
+  listing_id UUID,
+  match_score DECIMAL(5,2),
+  match_factors JSONB,
+  buyer_email TEXT,
+  buyer_phone TEXT,
+  preferred_channels TEXT[],
+  listing JSONB
+)
+LANGUAGE sql
+SECURITY DEFINER
+VOLATILE
+SET search_path = public
+AS $$
+  WITH due_buyers AS (
+    SELECT DISTINCT d.buyer_id
+    FROM public.listing_distributions d
+    JOIN public.buyer_match_preferences mp ON mp.buyer_id = d.buyer_id
+    WHERE mp.notification_frequency = p_frequency
+      AND COALESCE(mp.active, true)
+      AND (d.conversion_status = 'queued'
+           OR (d.conversion_status = 'digest_sending'
+               AND d.digest_claimed_at < NOW() - make_interval(secs => p_lease_seconds)))
+    LIMIT p_buyer_limit
+  ),
+  claimable AS (
+    SELECT d.id
+    FROM public.listing_distributions d
+    JOIN due_buyers b ON b.buyer_id = d.buyer_id
+    WHERE d.conversion_status = 'queued'
+       OR (d.conversion_status = 'digest_sending'
+           AND d.digest_claimed_at < NOW() - make_interval(secs => p_lease_seconds))
+    FOR UPDATE OF d SKIP LOCKED
+  ),
+  claimed AS (
+    UPDATE public.listing_distributions d
+    SET conversion_status = 'digest_sending',
+        digest_claimed_at = NOW()
+    FROM claimable c
+    WHERE d.id = c.id
+    RETURNING d.id, d.buyer_id, d.listing_id, d.match_score, d.match_factors
+  )
+  SELECT
+    c.id,
+    c.buyer_id,
+    c.listing_id,
+    c.match_score,
+    c.match_factors,
+    p.email,
+    p.phone,
+    COALESCE(mp.preferred_channels, ARRAY['email']),
+    jsonb_build_object(
+      'id', pr.id,
+      'title', pr.title,
+      'price', pr.price,
+      'location', pr.location,
+      'locality', pr.locality,
+      'city', pr.city,
+      'bedrooms', pr.bedrooms,
+      'listing_status', pr.listing_status
+    )
+  FROM claimed c
+  JOIN public.profiles p ON p.id = c.buyer_id
+  JOIN public.properties pr ON pr.id = c.listing_id
+  LEFT JOIN public.buyer_match_preferences mp ON mp.buyer_id = c.buyer_id
+  ORDER BY c.buyer_id, c.match_score DESC;
+$$;
+
+COMMENT ON FUNCTION public.claim_digest_distributions(TEXT, INTEGER, INTEGER) IS
+  'Claims queued listing_distributions for digest buyers (whole buyers, leased) and returns them with contact and listing details';
+
+GRANT EXECUTE ON FUNCTION public.claim_digest_distributions(TEXT, INTEGER, INTEGER) TO service_role;
+
+COMMIT;
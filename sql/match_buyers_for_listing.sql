@@ -0,0 +1,170 @@
+-- =============================================
+-- SET-BASED BUYER MATCHING
+-- Scores every eligible buyer for a listing in one query
+-- Run this in Supabase SQL Editor (after 036_smart_distribution.sql)
+-- =============================================
+
+-- distribute_listing used to load every buyer_profiles row and then, per
+-- buyer, read buyer_match_preferences and call calculate_match_score:
+-- 2N+1 round-trips per listing. This function applies the same weights
+-- as calculate_match_score to all buyers at once (behavior is aggregated
+-- in a single GROUP BY) and returns only buyers at or above their own
+-- min_match_score, best match first. When p_buyer_ids is given (the
+-- candidates from the in-process buyer preference index) only those
+-- buyers are scored.
+
+BEGIN;
+
+DROP FUNCTION IF EXISTS public.match_buyers_for_listing(UUID);
+
+CREATE OR REPLACE FUNCTION public.match_buyers_for_listing(
+  p_listing_id UUID,
+  p_buyer_ids UUID[] DEFAULT NULL
+)
+RETURNS TABLE(
+  buyer_id UUID,
+  buyer_email TEXT,
+  buyer_phone TEXT,
+  match_score DECIMAL(5,2),
+  match_factors JSONB,
+  min_match_score DECIMAL(5,2),
+  preferred_channels TEXT[],
+  notification_frequency TEXT
+)
+LANGUAGE sql
+SECURITY DEFINER
+STABLE
+SET search_path = public
+AS $$
+  WITH listing AS (
+    SELECT price, location, locality, city, property_type, bedrooms
+    FROM public.properties
+    WHERE id = p_listing_id
+  ),
+  buyers AS (
+    SELECT
+      bp.user_id,
+      bp.preferences,
+      p.email,
+      p.phone,
+      up.budget_min,
+      up.budget_max,
+      up.preferred_location,
+      up.preferred_property_type,
+      COALESCE(mp.min_match_score, 70.0) AS min_match_score,
+      COALESCE(mp.preferred_channels, ARRAY['email']) AS preferred_channels,
+      COALESCE(mp.notification_frequency, 'instant') AS notification_frequency
+    FROM public.buyer_profiles bp
+    JOIN public.profiles p ON p.id = bp.user_id
+    LEFT JOIN public.user_preferences up ON up.user_id = bp.user_id
+    LEFT JOIN public.buyer_match_preferences mp ON mp.buyer_id = bp.user_id
+    -- Buyers without a preferences row get the defaults; paused ones are skipped
+    WHERE COALESCE(mp.active, true)
+      AND (p_buyer_ids IS NULL OR bp.user_id = ANY(p_buyer_ids))
+  ),
+  behavior AS (
+    SELECT
+      ub.user_id,
+      COUNT(DISTINCT ub.property_id) AS properties_viewed,
+      STRING_AGG(DISTINCT ub.metadata->>'location', ',') AS searched_locations
+    FROM public.user_behavior ub
+    JOIN buyers b ON b.user_id = ub.user_id
+    WHERE ub.timestamp > NOW() - INTERVAL '30 days'
+    GROUP BY ub.user_id
+  ),
+  factors AS (
+    SELECT
+      b.user_id,
+      b.email,
+      b.phone,
+      b.min_match_score,
+      b.preferred_channels,
+      b.notification_frequency,
+      -- 1. Budget (25%)
+      (CASE
+        WHEN b.budget_max IS NULL OR l.price IS NULL THEN 50
+        WHEN l.price BETWEEN COALESCE(b.budget_min, 0) AND b.budget_max THEN 100
+        WHEN l.price < COALESCE(b.budget_min, 0) THEN
+          GREATEST(0, 100 - ((COALESCE(b.budget_min, 0) - l.price) / NULLIF(b.budget_min, 0)::DECIMAL * 100))
+        ELSE
+          GREATEST(0, 100 - ((l.price - b.budget_max) / NULLIF(b.budget_max, 0)::DECIMAL * 100))
+      END)::DECIMAL(5,2) AS budget_match,
+      -- 2. Location (25%)
+      (CASE
+        WHEN b.preferred_location IS NULL AND bh.searched_locations IS NULL THEN 50
+        WHEN l.location = b.preferred_location THEN 100
+        WHEN l.locality = b.preferred_location THEN 90
+        WHEN l.city = b.preferred_location THEN 70
+        WHEN bh.searched_locations IS NOT NULL AND
+             (l.location LIKE '%' || bh.searched_locations || '%' OR
+              bh.searched_locations LIKE '%' || l.location || '%') THEN 80
+        ELSE 30
+      END)::DECIMAL(5,2) AS location_match,
+      -- 3. Property type (20%)
+      (CASE
+        WHEN b.preferred_property_type IS NULL THEN 50
+        WHEN l.property_type = b.preferred_property_type THEN 100
+        WHEN l.property_type ILIKE '%' || b.preferred_property_type || '%' THEN 80
+        ELSE 20
+      END)::DECIMAL(5,2) AS property_type_match,
+      -- 4. Size by bedrooms (15%)
+      (CASE
+        WHEN l.bedrooms IS NULL THEN 50
+        WHEN (b.preferences->>'min_bedrooms') IS NULL THEN 70
+        WHEN l.bedrooms BETWEEN
+          COALESCE((b.preferences->>'min_bedrooms')::INTEGER, 0) AND
+          COALESCE((b.preferences->>'max_bedrooms')::INTEGER, 10) THEN 100
+        WHEN l.bedrooms < COALESCE((b.preferences->>'min_bedrooms')::INTEGER, 0) THEN
+          GREATEST(0, 100 - ((COALESCE((b.preferences->>'min_bedrooms')::INTEGER, 0) - l.bedrooms) * 20))
+        ELSE
+          GREATEST(0, 100 - ((l.bedrooms - COALESCE((b.preferences->>'max_bedrooms')::INTEGER, 10)) * 15))
+      END)::DECIMAL(5,2) AS size_match,
+      -- 5. Amenities from past behavior (10%)
+      (CASE WHEN COALESCE(bh.properties_viewed, 0) > 0 THEN 70 ELSE 50 END)::DECIMAL(5,2) AS amenity_match,
+      -- 6. Timing / urgency (5%)
+      (CASE COALESCE(b.preferences->>'buying_urgency', 'unknown')
+        WHEN 'immediate' THEN 100
+        WHEN 'within_3_months' THEN 80
+        WHEN 'within_6_months' THEN 60
+        ELSE 40
+      END)::DECIMAL(5,2) AS timing_match
+    FROM buyers b
+    CROSS JOIN listing l
+    LEFT JOIN behavior bh ON bh.user_id = b.user_id
+  ),
+  scored AS (
+    SELECT
+      f.*,
+      GREATEST(0, LEAST(100,
+        f.budget_match * 0.25 + f.location_match * 0.25 + f.property_type_match * 0.20 +
+        f.size_match * 0.15 + f.amenity_match * 0.10 + f.timing_match * 0.05
+      ))::DECIMAL(5,2) AS score
+    FROM factors f
+  )
+  SELECT
+    s.user_id,
+    s.email,
+    s.phone,
+    s.score,
+    jsonb_build_object(
+      'budget_match', s.budget_match,
+      'location_match', s.location_match,
+      'property_type_match', s.property_type_match,
+      'size_match', s.size_match,
+      'amenity_match', s.amenity_match,
+      'timing_match', s.timing_match
+    ),
+    s.min_match_score,
+    s.preferred_channels,
+    s.notification_frequency
+  FROM scored s
+  WHERE s.score >= s.min_match_score
+  ORDER BY s.score DESC;
+$$;
+
+COMMENT ON FUNCTION public.match_buyers_for_listing(UUID, UUID[]) IS
+  'Scores active buyers (optionally only p_buyer_ids) against a listing (same weights as calculate_match_score) and returns those at or above their min_match_score';
+
+GRANT EXECUTE ON FUNCTION public.match_buyers_for_listing(UUID, UUID[]) TO service_role;
+
+COMMIT;
@@ -0,0 +1,75 @@
+-- =============================================
+-- SLA BREACH SWEEP
+-- Batch re-assignment of leads whose SLA deadline passed untouched
+-- Run this in Supabase SQL Editor (after assign_lead.sql)
+-- =============================================
+
+-- Replaces the per-lead asyncio timers (lost on every deploy) with a
+-- periodic sweep. Each call takes up to p_limit leads that are still
+-- 'new' past their sla_deadline, skipping rows another sweeper holds, and
+-- for each one logs an sla_breach event and re-assigns it through
+-- assign_lead (which sets a fresh deadline). Leads nobody can take get
+-- their deadline pushed out one SLA window instead of being re-swept
+-- immediately. Breaches older than p_max_overdue_hours are left alone so
+-- the first sweep after a long outage doesn't reshuffle stale leads.
+
+BEGIN;
+
+CREATE INDEX IF NOT EXISTS idx_leads_sla_open
+  ON public.leads(sla_deadline)
+  WHERE status = 'new' AND assigned_to IS NOT NULL;
+
+CREATE OR REPLACE FUNCTION public.sweep_sla_breaches(
+  p_limit INTEGER DEFAULT 100,
+  p_sla_minutes JSONB DEFAULT '{"lion": 15, "monkey": 120, "dog": 480}'::JSONB,
+  p_max_overdue_hours INTEGER DEFAULT 24
+)
+RETURNS SETOF JSONB
+LANGUAGE plpgsql
+SECURITY DEFINER
+VOLATILE
+SET search_path = public
+AS $$
+DECLARE
+  v_lead RECORD;
+  v_sla_minutes INTEGER;
+  v_assignment JSONB;
+BEGIN
+  FOR v_lead IN
+    SELECT l.id, COALESCE(l.classification, 'dog') AS classification
+    FROM public.leads l
+    WHERE l.status = 'new'
+      AND l.assigned_to IS NOT NULL
+      AND l.sla_deadline <= NOW()
+      AND l.sla_deadline > NOW() - make_interval(hours => p_max_overdue_hours)
+    ORDER BY l.sla_deadline
+    LIMIT p_limit
+    FOR UPDATE SKIP LOCKED
+  LOOP
+    v_sla_minutes := COALESCE((p_sla_minutes->>v_lead.classification)::INTEGER, 120);
+
+    INSERT INTO public.lead_events (lead_id, event_type, actor_type, new_value)
+    VALUES (v_lead.id, 'sla_breach', 'system', jsonb_build_object(
+      'sla_minutes', v_sla_minutes,
+      'classification', v_lead.classification
+    ));
+
+    v_assignment := public.assign_lead(v_lead.id, p_sla_minutes, true);
+
+    IF v_assignment->>'assigned_to' IS NULL THEN
+      UPDATE public.leads
+      SET sla_deadline = NOW() + make_interval(mins => v_sla_minutes)
+      WHERE id = v_lead.id;
+    END IF;
+
+    RETURN NEXT v_assignment;
+  END LOOP;
+END;
+$$;
+
+COMMENT ON FUNCTION public.sweep_sla_breaches(INTEGER, JSONB, INTEGER) IS
+  'Logs SLA breaches for overdue new leads and re-assigns them in one batch (SKIP LOCKED, safe for concurrent sweepers)';
+
+GRANT EXECUTE ON FUNCTION public.sweep_sla_breaches(INTEGER, JSONB, INTEGER) TO service_role;
+
+COMMIT;
@@ -0,0 +1,92 @@
+-- =============================================
+-- SMARTSCORE BATCH READS + WRITE-BACK
+-- Per-lead signal window and bulk score update for /score/batch
+-- Run this in Supabase SQL Editor (after 015_agentic_marketing_funnel.sql)
+-- =============================================
+
+-- The SmartScore service scores leads in chunks of up to 200. It needs the
+-- newest N behavioral signals of every lead in the chunk; one global LIMIT
+-- lets a single chatty lead use up the whole window (and PostgREST's
+-- max-rows cap truncates it silently), so lead_recent_signals ranks
+-- signals per lead and returns them as one JSONB object keyed by lead.
+--
+-- Scores used to be written back with a PostgREST upsert on id. That is an
+-- INSERT ... ON CONFLICT DO UPDATE, and the INSERT half trips leads.name
+-- NOT NULL / leads_contact_check before the conflict is resolved, so no
+-- score was ever saved. apply_lead_scores is a plain UPDATE of existing
+-- leads; ids that no longer exist are ignored.
+
+BEGIN;
+
+-- =============================================
+-- NEWEST SIGNALS PER LEAD
+-- =============================================
+CREATE OR REPLACE FUNCTION public.lead_recent_signals(
+  p_lead_ids UUID[],
+  p_per_lead INTEGER DEFAULT 50
+)
+RETURNS JSONB
+LANGUAGE sql
+SECURITY DEFINER
+STABLE
+SET search_path = public
+AS $$
+  -- One JSONB value rather than a row set, so max-rows cannot cut it short
+  SELECT COALESCE(jsonb_object_agg(lead_id, signals), '{}'::jsonb)
+  FROM (
+    SELECT ranked.lead_id, jsonb_agg(ranked.signal ORDER BY ranked.created_at DESC) AS signals
+    FROM (
+      SELECT s.lead_id, s.created_at, to_jsonb(s) AS signal,
+             row_number() OVER (PARTITION BY s.lead_id ORDER BY s.created_at DESC) AS rn
+      FROM public.behavioral_signals s
+      WHERE s.lead_id = ANY(p_lead_ids)
+    ) ranked
+    WHERE ranked.rn <= p_per_lead
+    GROUP BY ranked.lead_id
+  ) per_lead;
+$$;
+
+COMMENT ON FUNCTION public.lead_recent_signals IS
+  'Newest p_per_lead behavioral signals for each of the given leads, as {lead_id: [signal, ...]}';
+
+-- =============================================
+-- BULK SCORE UPDATE
+-- =============================================
+CREATE OR REPLACE FUNCTION public.apply_lead_scores(
+  p_scores JSONB
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+SECURITY DEFINER
+VOLATILE
+SET search_path = public
+AS $$
+DECLARE
+  updated INTEGER;
+BEGIN
+  UPDATE public.leads l
+  SET smartscore = r.smartscore,
+      classification = r.classification,
+      score_breakdown = r.score_breakdown,
+      updated_at = COALESCE(r.updated_at, NOW())
+  FROM jsonb_to_recordset(p_scores) AS r(
+    id UUID,
+    smartscore INTEGER,
+    classification TEXT,
+    score_breakdown JSONB,
+    updated_at TIMESTAMPTZ
+  )
+  WHERE l.id = r.id;
+
+  GET DIAGNOSTICS updated = ROW_COUNT;
+  RETURN updated;
+END;
+$$;
+
+COMMENT ON FUNCTION public.apply_lead_scores IS
+  'Write a batch of SmartScore results onto existing leads (UPDATE only, never inserts)';
+
+GRANT EXECUTE ON FUNCTION public.lead_recent_signals(UUID[], INTEGER) TO service_role;
+GRANT EXECUTE ON FUNCTION public.apply_lead_scores(JSONB) TO service_role;
+
+COMMIT;
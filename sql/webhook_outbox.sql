@@ -0,0 +1,128 @@
+-- =============================================
+-- WEBHOOK OUTBOX
+-- Durable queue of outgoing webhook deliveries
+-- Run this in Supabase SQL Editor (after 046_webhooks.sql)
+-- =============================================
+
+-- trigger_webhook only inserts rows here; background dispatchers claim
+-- due rows, deliver them and record the outcome. Failed deliveries are
+-- retried with exponential backoff until they are delivered or reach
+-- the attempt limit and move to 'dead' (the dead-letter state).
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS public.webhook_outbox (
+  id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+  endpoint_id UUID NOT NULL REFERENCES public.webhook_endpoints(id) ON DELETE CASCADE,
+  event_type TEXT NOT NULL,
+
+  -- Serialized once at enqueue time; signed and sent verbatim
+  body TEXT NOT NULL,
+
+  -- 'pending', 'delivering', 'delivered', 'dead'
+  status TEXT NOT NULL DEFAULT 'pending',
+  attempts INTEGER NOT NULL DEFAULT 0,
+  next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  locked_until TIMESTAMPTZ,
+
+  last_status_code INTEGER,
+  last_error TEXT,
+
+  created_at TIMESTAMPTZ DEFAULT NOW(),
+  delivered_at TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS idx_webhook_outbox_due
+  ON public.webhook_outbox(next_attempt_at)
+  WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_webhook_outbox_locked
+  ON public.webhook_outbox(locked_until)
+  WHERE status = 'delivering';
+CREATE INDEX IF NOT EXISTS idx_webhook_outbox_dead
+  ON public.webhook_outbox(endpoint_id, created_at DESC)
+  WHERE status = 'dead';
+
+ALTER TABLE public.webhook_outbox ENABLE ROW LEVEL SECURITY;
+GRANT ALL ON public.webhook_outbox TO service_role;
+
+COMMENT ON TABLE public.webhook_outbox IS 'Outgoing webhook deliveries awaiting (re)delivery, plus dead letters';
+
+-- =============================================
+-- CLAIM
+-- =============================================
+CREATE OR REPLACE FUNCTION public.claim_webhook_outbox(
+  p_limit INTEGER DEFAULT 100,
+  p_lease_seconds INTEGER DEFAULT 60
+)
+RETURNS SETOF public.webhook_outbox
+LANGUAGE sql
+SECURITY DEFINER
+VOLATILE
+SET search_path = public
+AS $$
+  WITH due AS (
+    SELECT id
+    FROM public.webhook_outbox
+    WHERE (status = 'pending' AND next_attempt_at <= NOW())
+       OR (status = 'delivering' AND locked_until < NOW())
+    ORDER BY next_attempt_at
+    LIMIT p_limit
+    FOR UPDATE SKIP LOCKED
+  )
+  UPDATE public.webhook_outbox o
+  SET status = 'delivering',
+      locked_until = NOW() + make_interval(secs => p_lease_seconds)
+  FROM due
+  WHERE o.id = due.id
+  RETURNING o.*;
+$$;
+
+COMMENT ON FUNCTION public.claim_webhook_outbox IS
+  'Lease due webhook deliveries to a dispatcher; deliveries of crashed dispatchers are reclaimed after the lease';
+
+-- =============================================
+-- RECORD OUTCOMES
+-- =============================================
+CREATE OR REPLACE FUNCTION public.apply_webhook_outbox_results(
+  p_results JSONB
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+SECURITY DEFINER
+VOLATILE
+SET search_path = public
+AS $$
+DECLARE
+  updated INTEGER;
+BEGIN
+  UPDATE public.webhook_outbox o
+  SET status = r.status,
+      attempts = COALESCE(r.attempts, o.attempts),
+      next_attempt_at = COALESCE(r.next_attempt_at, o.next_attempt_at),
+      last_status_code = COALESCE(r.last_status_code, o.last_status_code),
+      last_error = r.last_error,
+      delivered_at = r.delivered_at,
+      locked_until = NULL
+  FROM jsonb_to_recordset(p_results) AS r(
+    id UUID,
+    status TEXT,
+    attempts INTEGER,
+    next_attempt_at TIMESTAMPTZ,
+    last_status_code INTEGER,
+    last_error TEXT,
+    delivered_at TIMESTAMPTZ
+  )
+  WHERE o.id = r.id;
+
+  GET DIAGNOSTICS updated = ROW_COUNT;
+  RETURN updated;
+END;
+$$;
+
+COMMENT ON FUNCTION public.apply_webhook_outbox_results IS
+  'Record a batch of webhook delivery outcomes (delivered, rescheduled or dead)';
+
+GRANT EXECUTE ON FUNCTION public.claim_webhook_outbox(INTEGER, INTEGER) TO service_role;
+GRANT EXECUTE ON FUNCTION public.apply_webhook_outbox_results(JSONB) TO service_role;
+
+COMMIT;
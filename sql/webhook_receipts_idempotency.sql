@@ -0,0 +1,19 @@
+-- =============================================
+-- WEBHOOK RECEIPT IDEMPOTENCY
+-- Deduplicates provider redeliveries of inbound webhooks
+-- Run this in Supabase SQL Editor (after 046_webhooks.sql)
+-- =============================================
+
+-- Inbound webhooks are buffered in memory and bulk-inserted with
+-- ON CONFLICT (provider, idempotency_key) DO NOTHING, so a redelivery
+-- that slips past the in-process dedup is still stored only once.
+
+BEGIN;
+
+ALTER TABLE public.webhook_receipts
+  ADD COLUMN IF NOT EXISTS idempotency_key TEXT;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_webhook_receipts_idempotency
+  ON public.webhook_receipts(provider, idempotency_key);
+
+COMMIT;
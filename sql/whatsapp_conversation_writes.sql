@@ -0,0 +1,79 @@
+-- =============================================
+-- WHATSAPP CONVERSATION WRITE-BEHIND
+-- Batched, version-checked conversation writes for the WhatsApp webhook
+-- Run this in Supabase SQL Editor (after 015_agentic_marketing_funnel.sql)
+-- =============================================
+
+-- The webhook answers from an in-process conversation cache and persists
+-- state afterwards (app/whatsapp_state.py). With several API replicas a
+-- cached copy can be behind the table, so every row carries the
+-- last_message_at it was read at (base_message_at):
+--
+--   * existing phone, unchanged since that read  -> updated
+--   * existing phone, changed by someone else     -> skipped (stale)
+--   * new phone (base_message_at NULL)            -> inserted; if another
+--     replica inserted the same phone first, skipped (stale)
+--
+-- Phones that were skipped are returned so the caller can drop its cached
+-- copy and re-read the conversation on the next message.
+
+BEGIN;
+
+CREATE OR REPLACE FUNCTION public.write_whatsapp_conversations(
+  p_rows JSONB
+)
+RETURNS TEXT[]
+LANGUAGE sql
+SECURITY DEFINER
+VOLATILE
+SET search_path = public
+AS $$
+  WITH input AS (
+    SELECT *
+    FROM jsonb_to_recordset(p_rows) AS r(
+      id UUID,
+      phone TEXT,
+      qualification_stage TEXT,
+      extracted_data JSONB,
+      messages JSONB,
+      last_message_at TIMESTAMPTZ,
+      window_expires_at TIMESTAMPTZ,
+      base_message_at TIMESTAMPTZ
+    )
+  ),
+  updated AS (
+    UPDATE public.whatsapp_conversations c
+    SET qualification_stage = r.qualification_stage,
+        extracted_data = r.extracted_data,
+        messages = r.messages,
+        last_message_at = r.last_message_at,
+        window_expires_at = r.window_expires_at,
+        updated_at = NOW()
+    FROM input r
+    WHERE c.phone = r.phone
+      AND r.base_message_at IS NOT NULL
+      AND c.last_message_at <= r.base_message_at
+    RETURNING c.phone
+  ),
+  inserted AS (
+    INSERT INTO public.whatsapp_conversations (
+      id, phone, qualification_stage, extracted_data, messages, last_message_at, window_expires_at
+    )
+    SELECT COALESCE(r.id, gen_random_uuid()), r.phone, r.qualification_stage, r.extracted_data,
+           r.messages, r.last_message_at, r.window_expires_at
+    FROM input r
+    WHERE r.base_message_at IS NULL
+    ON CONFLICT (phone) DO NOTHING
+    RETURNING phone
+  )
+  SELECT COALESCE(array_agg(i.phone), '{}')
+  FROM input i
+  WHERE i.phone NOT IN (SELECT phone FROM updated UNION ALL SELECT phone FROM inserted);
+$$;
+
+COMMENT ON FUNCTION public.write_whatsapp_conversations IS
+  'Write a batch of cached WhatsApp conversations; returns the phones skipped because the stored row moved on';
+
+GRANT EXECUTE ON FUNCTION public.write_whatsapp_conversations(JSONB) TO service_role;
+
+COMMIT;
@@ -0,0 +1,161 @@
+-- =============================================
+-- WORKFLOW ACTION LEASES
+-- Atomic claiming of due workflow_actions for the worker pool
+-- Run this in Supabase SQL Editor (after 040_workflow_automation.sql;
+-- then run workflow_status_updates.sql, which writes the lease columns
+-- added here and is called by claim_workflow_actions)
+-- =============================================
+
+-- A worker claims due actions by flipping them to 'running' with a lease.
+-- While it works it renews the lease; if it crashes the lease expires and
+-- any other worker may reclaim the action. FOR UPDATE SKIP LOCKED lets
+-- overlapping cron calls and multiple replicas claim concurrently without
+-- ever handing the same action to two workers.
+
+BEGIN;
+
+ALTER TABLE public.workflow_actions
+  ADD COLUMN IF NOT EXISTS claimed_by TEXT,
+  ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ,
+  ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;
+
+-- Running actions are reclaimed once their lease lapses
+CREATE INDEX IF NOT EXISTS idx_workflow_actions_lease
+  ON public.workflow_actions(lease_expires_at)
+  WHERE status = 'running';
+
+-- =============================================
+-- CLAIM
+-- =============================================
+CREATE OR REPLACE FUNCTION public.claim_workflow_actions(
+  p_worker_id TEXT,
+  p_limit INTEGER DEFAULT 50,
+  p_lease_seconds INTEGER DEFAULT 120,
+  p_max_attempts INTEGER DEFAULT 3
+)
+RETURNS SETOF public.workflow_actions
+LANGUAGE plpgsql
+SECURITY DEFINER
+VOLATILE
+SET search_path = public
+AS $$
+DECLARE
+  v_poison_actions JSONB;
+  v_poison_executions JSONB;
+BEGIN
+  IF p_worker_id IS NULL OR p_worker_id = '' THEN
+    RAISE EXCEPTION 'p_worker_id is required';
+  END IF;
+
+  -- Actions whose lease expired too many times are poison: fail them and
+  -- count them against their executions (apply_workflow_status_updates).
+  -- Rows are locked first, skipping ones another claim already holds, so
+  -- overlapping claims never count the same poison action twice
+  SELECT jsonb_agg(jsonb_build_object(
+           'id', p.id,
+           'status', 'failed',
+           'error_message', 'Lease expired after ' || p.attempts || ' attempts',
+           'completed_at', NOW()
+         ))
+  INTO v_poison_actions
+  FROM (
+    SELECT a.id, a.attempts
+    FROM public.workflow_actions a
+    WHERE a.status = 'running'
+      AND a.lease_expires_at < NOW()
+      AND a.attempts >= p_max_attempts
+    FOR UPDATE OF a SKIP LOCKED
+  ) p;
+
+  IF v_poison_actions IS NOT NULL THEN
+    SELECT jsonb_agg(jsonb_build_object('id', p.execution_id, 'failed_delta', p.n))
+    INTO v_poison_executions
+    FROM (
+      SELECT a.execution_id, COUNT(*) AS n
+      FROM public.workflow_actions a
+      JOIN jsonb_to_recordset(v_poison_actions) AS x(id UUID) ON x.id = a.id
+      GROUP BY a.execution_id
+    ) p;
+
+    PERFORM public.apply_workflow_status_updates(v_poison_actions, v_poison_executions);
+  END IF;
+
+  RETURN QUERY
+  WITH candidates AS (
+    -- Only the earliest due action of each execution, so actions of one
+    -- execution keep running in order
+    SELECT DISTINCT ON (a.execution_id) a.id, a.scheduled_for
+    FROM public.workflow_actions a
+    WHERE (a.status = 'pending' AND a.scheduled_for <= NOW())
+       OR (a.status = 'running' AND a.lease_expires_at < NOW())
+    ORDER BY a.execution_id, a.scheduled_for
+  ),
+  claimable AS (
+    SELECT a.id
+    FROM public.workflow_actions a
+    JOIN candidates c ON c.id = a.id
+    WHERE NOT EXISTS (
+      SELECT 1 FROM public.workflow_actions r
+      WHERE r.execution_id = a.execution_id
+        AND r.id <> a.id
+        AND r.status = 'running'
+        AND (r.lease_expires_at IS NULL OR r.lease_expires_at >= NOW())
+    )
+    ORDER BY c.scheduled_for
+    LIMIT p_limit
+    FOR UPDATE OF a SKIP LOCKED
+  )
+  UPDATE public.workflow_actions a
+  SET status = 'running',
+      claimed_by = p_worker_id,
+      lease_expires_at = NOW() + make_interval(secs => p_lease_seconds),
+      attempts = a.attempts + 1,
+      started_at = NOW(),
+      updated_at = NOW()
+  FROM claimable
+  WHERE a.id = claimable.id
+    -- Re-check under the row lock: another worker may have finished it
+    AND (a.status = 'pending' OR (a.status = 'running' AND a.lease_expires_at < NOW()))
+  RETURNING a.*;
+END;
+$$;
+
+COMMENT ON FUNCTION public.claim_workflow_actions IS
+  'Atomically lease up to p_limit due workflow actions (one per execution) to a worker, reclaiming expired leases';
+
+-- =============================================
+-- RENEW
+-- =============================================
+CREATE OR REPLACE FUNCTION public.renew_workflow_action_leases(
+  p_worker_id TEXT,
+  p_action_ids UUID[],
+  p_lease_seconds INTEGER DEFAULT 120
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+SECURITY DEFINER
+VOLATILE
+SET search_path = public
+AS $$
+DECLARE
+  renewed INTEGER;
+BEGIN
+  UPDATE public.workflow_actions
+  SET lease_expires_at = NOW() + make_interval(secs => p_lease_seconds),
+      updated_at = NOW()
+  WHERE id = ANY(p_action_ids)
+    AND claimed_by = p_worker_id
+    AND status = 'running';
+
+  GET DIAGNOSTICS renewed = ROW_COUNT;
+  RETURN renewed;
+END;
+$$;
+
+COMMENT ON FUNCTION public.renew_workflow_action_leases IS
+  'Extend the leases a worker holds on its in-flight workflow actions';
+
+GRANT EXECUTE ON FUNCTION public.claim_workflow_actions(TEXT, INTEGER, INTEGER, INTEGER) TO service_role;
+GRANT EXECUTE ON FUNCTION public.renew_workflow_action_leases(TEXT, UUID[], INTEGER) TO service_role;
+
+COMMIT;
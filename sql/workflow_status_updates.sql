@@ -0,0 +1,106 @@
+-- =============================================
+-- BATCHED WORKFLOW STATUS UPDATES
+-- Applies coalesced workflow_actions / workflow_executions transitions
+-- Run this in Supabase SQL Editor (after workflow_action_leases.sql,
+-- which adds the lease columns this clears)
+-- =============================================
+
+-- The workflow engine merges all updates to a row in memory and flushes
+-- them here in one call. Execution counters arrive as deltas, so several
+-- workers (or replicas) can report progress on the same execution without
+-- a read-modify-write; an execution is completed here once every action
+-- is accounted for, replacing the per-action status re-query.
+
+BEGIN;
+
+CREATE OR REPLACE FUNCTION public.apply_workflow_status_updates(
+  p_actions JSONB DEFAULT '[]'::JSONB,
+  p_executions JSONB DEFAULT '[]'::JSONB
+)
+RETURNS SETOF UUID
+LANGUAGE plpgsql
+SECURITY DEFINER
+VOLATILE
+SET search_path = public
+AS $$
+BEGIN
+  UPDATE public.workflow_actions a
+  SET status = COALESCE(u.status, a.status),
+      result = COALESCE(u.result, a.result),
+      error_message = COALESCE(u.error_message, a.error_message),
+      started_at = COALESCE(u.started_at, a.started_at),
+      completed_at = COALESCE(u.completed_at, a.completed_at),
+      external_message_id = COALESCE(u.external_message_id, a.external_message_id),
+      external_status = COALESCE(u.external_status, a.external_status),
+      lease_expires_at = CASE
+        WHEN u.status IN ('completed', 'failed', 'skipped') THEN NULL
+        ELSE a.lease_expires_at
+      END,
+      updated_at = NOW()
+  FROM jsonb_to_recordset(p_actions) AS u(
+    id UUID,
+    status TEXT,
+    result JSONB,
+    error_message TEXT,
+    started_at TIMESTAMPTZ,
+    completed_at TIMESTAMPTZ,
+    external_message_id TEXT,
+    external_status TEXT
+  )
+  WHERE a.id = u.id;
+
+  -- Returns the executions this call moved to 'completed'
+  RETURN QUERY
+  WITH updates AS (
+    SELECT u.*,
+           e.status AS old_status,
+           COALESCE(e.actions_completed, 0) + COALESCE(u.completed_delta, 0) AS new_completed,
+           COALESCE(e.actions_failed, 0) + COALESCE(u.failed_delta, 0) AS new_failed,
+           COALESCE(e.actions_total, 0) AS total
+    FROM jsonb_to_recordset(p_executions) AS u(
+      id UUID,
+      status TEXT,
+      started_at TIMESTAMPTZ,
+      completed_at TIMESTAMPTZ,
+      error_message TEXT,
+      completed_delta INTEGER,
+      failed_delta INTEGER
+    )
+    JOIN public.workflow_executions e ON e.id = u.id
+    -- Lock so concurrent deltas add up instead of overwriting each other
+    FOR UPDATE OF e
+  ),
+  applied AS (
+    UPDATE public.workflow_executions e
+    SET actions_completed = x.new_completed,
+        actions_failed = x.new_failed,
+        status = CASE
+          WHEN x.status = 'failed' THEN 'failed'
+          WHEN x.old_status IN ('completed', 'failed', 'cancelled') THEN x.old_status
+          WHEN x.new_completed + x.new_failed >= x.total THEN 'completed'
+          ELSE COALESCE(x.status, x.old_status)
+        END,
+        started_at = COALESCE(e.started_at, x.started_at),
+        completed_at = CASE
+          WHEN x.status = 'failed' THEN COALESCE(x.completed_at, NOW())
+          WHEN x.old_status NOT IN ('completed', 'failed', 'cancelled')
+            AND x.new_completed + x.new_failed >= x.total THEN NOW()
+          ELSE e.completed_at
+        END,
+        error_message = COALESCE(x.error_message, e.error_message),
+        updated_at = NOW()
+    FROM updates x
+    WHERE e.id = x.id
+    RETURNING e.id, e.status, x.old_status
+  )
+  SELECT applied.id FROM applied
+  WHERE applied.status = 'completed' AND applied.old_status <> 'completed';
+END;
+$$;
+
+COMMENT ON FUNCTION public.apply_workflow_status_updates IS
+  'Apply a batch of merged workflow action/execution updates; execution counters are deltas';
+
+GRANT EXECUTE ON FUNCTION public.apply_workflow_status_updates(JSONB, JSONB) TO service_role;
+
+COMMIT;